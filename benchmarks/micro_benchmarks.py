@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Times the code paths which grow with the number of data files (crawling, date subsetting,
+    grouping and recording progress) on path lists and fake directory trees of 1k to 500k files,
+    fits how each scales with the number of files and fails when one is super-linear.
+    Path lists are made by cloning the shipped data list (each clone is a new member of every
+    model), so they have the real mix of models, members, file lengths and CAVEATS_IN_DATA.
+
+    Usage (from the repository root):
+        python -m benchmarks.micro_benchmarks --output micro.json
+        python -m benchmarks.micro_benchmarks --sizes 1000 10000 100000 500000 --tree-sizes 1000 10000 100000 500000
+"""
+
+#  imports
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+from benchmarks import run_benchmark
+from utils import file_catalog, get_data, progress_loggers
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+MICRO_BENCHMARK_VERSION = 1  # bump when the results change so old results are not compared with new ones
+FIXTURE_FILE = "experiments/CMIP_Historical_npac/data_lists/ua_historical_latest_JASMIN.txt"
+DATA_DIR = "badc/cmip6/data/CMIP6/CMIP/"  # fixture paths are under /badc/cmip6/data/CMIP6/CMIP/
+DEFAULT_SIZES = [1000, 10000, 100000, 500000]  # files in each path list
+DEFAULT_TREE_SIZES = [1000, 10000, 100000]  # files in each fake directory tree (empty files)
+START_DATE = "19500101"  # date range subset and grouped (same as experiments/CMIP_Historical_npac/main.py)
+END_DATE = "20151231"
+MAX_SCALING_EXPONENT = 1.3  # fail when time grows faster than n ** MAX_SCALING_EXPONENT
+MIN_FIT_TIME = 0.005  # s, shorter times are left out of the fit as they are mostly fixed overheads
+TREE_COMPLETE_FILE = ".complete"  # written once all files in a fake tree exist, so it is reused
+
+
+log = logging.getLogger(__name__)
+
+
+def load_fixture_data_paths(fixture_file=FIXTURE_FILE):
+    with open(fixture_file, "r") as fixture:
+        return [line.strip() for line in fixture if line.strip()]
+
+
+def get_member(data_path):
+    #  i.e. 'r1i1p1f1' from ua_day_[model]_historical_r1i1p1f1_gn_[dates].nc
+    return os.path.basename(data_path).split("_")[-3]
+
+
+def make_data_paths(n_files, fixture_data_paths):
+    """
+    Path list of n_files made by cloning the fixture data paths with new members
+    (r1i1p1f1 becomes r1001i1p1f1 in the first clone, r2001i1p1f1 in the second, ...)
+
+    Parameters
+    ----------
+    n_files : int
+        Number of paths to return
+    fixture_data_paths : list
+        From load_fixture_data_paths
+
+    Returns
+    ----------
+    data_paths : list
+        First n_files paths of the fixture followed by its clones
+    """
+    data_paths = []
+    clone_index = 0
+    while len(data_paths) < n_files:
+        for data_path in fixture_data_paths[: n_files - len(data_paths)]:
+            if clone_index:
+                member = get_member(data_path)
+                realisation, rest = member[1:].split("i", 1)
+                new_member = "r%si%s" % (clone_index * 1000 + int(realisation), rest)
+                data_path = data_path.replace(member, new_member)
+            data_paths.append(data_path)
+        clone_index += 1
+    return data_paths
+
+
+def write_data_list(data_paths, experiment_dir, file_name):
+    """
+    Writes data paths to [experiment_dir]/data_lists/[file_name] (with a progress_logs
+    directory next to it, as the progress loggers expect)
+    """
+    for dir_name in ["data_lists", "progress_logs"]:
+        os.makedirs(os.path.join(experiment_dir, dir_name), exist_ok=True)
+    data_list_file = os.path.join(experiment_dir, "data_lists", file_name)
+    with open(data_list_file, "w") as data_list:
+        data_list.write("\n".join(data_paths) + "\n")
+    return data_list_file
+
+
+def write_fake_tree(tree_dir, data_paths):
+    """
+    Creates an empty file at each data path under tree_dir (kept for later runs)
+
+    Returns
+    ----------
+    pathname : str
+        Pathname which finds every file in the tree (like PATH_NAME in the experiments)
+    """
+    if not os.path.exists(os.path.join(tree_dir, TREE_COMPLETE_FILE)):
+        shutil.rmtree(tree_dir, ignore_errors=True)
+        for data_path in data_paths:
+            fake_data_path = os.path.join(tree_dir, data_path.lstrip("/"))
+            os.makedirs(os.path.dirname(fake_data_path), exist_ok=True)
+            open(fake_data_path, "w").close()
+        open(os.path.join(tree_dir, TREE_COMPLETE_FILE), "w").close()
+    return get_data.make_cmip6_drs_pathname(
+        os.path.join(tree_dir, DATA_DIR),
+        experiment="historical",
+        member="r*",
+        table="day",
+        variable="ua",
+        version="latest",
+    )
+
+
+def time_call(func, repeats=3, setup=None):
+    """
+    Shortest wall time of func over repeats (setup is called, untimed, before each repeat
+    and its result passed to func)
+
+    Returns
+    ----------
+    min_time : float
+    result
+        Returned by func on the last repeat
+    """
+    times = []
+    result = None
+    for _ in range(repeats):
+        argument = setup() if setup is not None else None
+        start_time = time.perf_counter()
+        result = func(argument) if setup is not None else func()
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+def time_path_list_paths(data_paths, experiment_dir, repeats=3):
+    """
+    Time of each code path which works on a list of data paths
+
+    Returns
+    ----------
+    times : dict
+        Shortest wall time (s) of each code path
+    """
+    times = {}
+    times["filter"], _ = time_call(
+        lambda: get_data.filter_data_paths(data_paths, one_realisation=True), repeats
+    )
+    data_path_retriever = get_data.GlobDataPathRetrieverFromJASMIN("", data_paths=data_paths)
+    times["date subset"], _ = time_call(
+        lambda: data_path_retriever.subset_data_paths_by_date_range(START_DATE, END_DATE),
+        repeats,
+    )
+    data_path_grouper = get_data.DataPathGrouperForJASMIN(data_paths)
+    times["group"], grouped_data_paths = time_call(
+        lambda: data_path_grouper.group_data_paths(START_DATE, END_DATE), repeats
+    )
+    data_list_file = write_data_list(
+        data_paths, experiment_dir, "ua_micro_benchmark_%s.txt" % (len(data_paths))
+    )
+    #  start from an empty journal so runs of earlier benchmarks are not timed too
+    journal_file = progress_loggers.get_progress_journal_file_path(data_list_file)
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
+    times["progress log start run"], _ = time_call(
+        lambda: progress_loggers.JournaledProgressLogger(data_list_file).close(), repeats
+    )
+    times["progress log updates"], _ = time_call(
+        lambda progress_logger: record_progress_of_groups(progress_logger, grouped_data_paths),
+        repeats,
+        setup=lambda: progress_loggers.JournaledProgressLogger(data_list_file),
+    )
+    progress_logger = progress_loggers.JournaledProgressLogger(data_list_file, new_run=False)
+    times["progress log render"], _ = time_call(progress_logger.render_progress_log_file, repeats)
+    progress_logger.close()
+    return times
+
+
+def record_progress_of_groups(progress_logger, grouped_data_paths):
+    #  the updates main() records for each group (see record_group_state and record_group_progress)
+    for data_path_group in grouped_data_paths:
+        progress_logger.record_state(data_path_group, progress_loggers.LOADED, "loaded data")
+        progress_logger.record_state(data_path_group, progress_loggers.DONE, "done!")
+    progress_logger.close()
+
+
+def time_tree_paths(pathname, catalog_path, max_workers=None, repeats=3):
+    """
+    Time of each code path which lists a directory tree
+
+    Returns
+    ----------
+    times : dict
+        Shortest wall time (s) of each code path
+    """
+    times = {}
+    times["glob"], _ = time_call(
+        lambda: get_data.GlobDataPathRetriever(pathname).retrieve_data_paths(
+            one_realisation=False
+        ),
+        repeats,
+    )
+    times["crawl"], _ = time_call(
+        lambda: get_data.ScandirDataPathCrawler(pathname, max_workers=max_workers).crawl(),
+        repeats,
+    )
+
+    def make_empty_catalog():
+        if os.path.exists(catalog_path):
+            os.remove(catalog_path)
+        return file_catalog.SQLiteFileCatalog(catalog_path)
+
+    times["catalog refresh"], _ = time_call(
+        lambda catalog: refresh_catalog(catalog, pathname, max_workers),
+        repeats,
+        setup=make_empty_catalog,
+    )
+    catalog = file_catalog.SQLiteFileCatalog(catalog_path)
+    refresh_catalog(catalog, pathname, max_workers, close=False)
+    times["catalog refresh unchanged"], _ = time_call(
+        lambda: refresh_catalog(catalog, pathname, max_workers, close=False), repeats
+    )
+    times["catalog group"], _ = time_call(
+        lambda: catalog.group_data_paths(START_DATE, END_DATE), repeats
+    )
+    catalog.close()
+    return times
+
+
+def refresh_catalog(catalog, pathname, max_workers, close=True):
+    n_rescanned = catalog.refresh(pathname, max_workers=max_workers)
+    if close:
+        catalog.close()
+    return n_rescanned
+
+
+def get_scaling_exponent(sizes, times, min_fit_time=MIN_FIT_TIME):
+    """
+    Slope of log(time) against log(size) i.e. time ~ size ** exponent
+
+    Returns
+    ----------
+    exponent : float
+        None when fewer than two sizes take at least min_fit_time
+    """
+    points = [(size, time) for size, time in zip(sizes, times) if time >= min_fit_time]
+    if len(points) < 2:
+        return None
+    log_sizes, log_times = numpy.log(numpy.array(points, dtype=float)).T
+    return float(numpy.polyfit(log_sizes, log_times, 1)[0])
+
+
+def make_scaling_results(times_by_size, max_scaling_exponent=MAX_SCALING_EXPONENT):
+    """
+    Parameters
+    ----------
+    times_by_size : dict
+        Times of each code path (from time_path_list_paths or time_tree_paths) by size
+
+    Returns
+    ----------
+    scaling_results : dict
+        Sizes, times, scaling exponent and whether it is super-linear (over
+        max_scaling_exponent) of each code path
+    """
+    sizes = sorted(times_by_size)
+    scaling_results = {}
+    for code_path in times_by_size[sizes[0]]:
+        times = [times_by_size[size][code_path] for size in sizes]
+        exponent = get_scaling_exponent(sizes, times)
+        scaling_results[code_path] = {
+            "sizes": sizes,
+            "times": times,
+            "exponent": exponent,
+            "super_linear": exponent is not None and exponent > max_scaling_exponent,
+        }
+    return scaling_results
+
+
+def run_micro_benchmarks(
+    work_dir,
+    sizes=DEFAULT_SIZES,
+    tree_sizes=DEFAULT_TREE_SIZES,
+    fixture_file=FIXTURE_FILE,
+    max_workers=None,
+    repeats=3,
+    max_scaling_exponent=MAX_SCALING_EXPONENT,
+):
+    """
+    Times every code path on each size of path list and fake directory tree
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory for the fake trees (kept so later runs can reuse them), data lists and catalogs
+    sizes : list
+        Number of paths in each path list
+    tree_sizes : list
+        Number of files in each fake directory tree
+    fixture_file : str
+        Data list the path lists are cloned from
+    max_workers : int
+        Threads listing directories (default: CRAWLER_MAX_WORKERS)
+    repeats : int
+        Times each code path is run (the shortest time is kept)
+    max_scaling_exponent : float
+        Code paths scaling faster than size ** max_scaling_exponent are marked super-linear
+
+    Returns
+    ----------
+    micro_benchmark_results : dict
+        Config, environment and the scaling results of each code path
+    """
+    fixture_data_paths = load_fixture_data_paths(fixture_file)
+    experiment_dir = os.path.join(work_dir, "experiment")
+    path_list_times = {}
+    for size in sizes:
+        path_list_times[size] = time_path_list_paths(
+            make_data_paths(size, fixture_data_paths), experiment_dir, repeats
+        )
+        log.info("path list of %s: %s" % (size, path_list_times[size]))
+    tree_times = {}
+    for size in tree_sizes:
+        pathname = write_fake_tree(
+            os.path.join(work_dir, "tree_%s" % (size)),
+            make_data_paths(size, fixture_data_paths),
+        )
+        tree_times[size] = time_tree_paths(
+            pathname,
+            os.path.join(experiment_dir, "catalog_%s.sqlite" % (size)),
+            max_workers,
+            repeats,
+        )
+        log.info("tree of %s: %s" % (size, tree_times[size]))
+    results = {}
+    for times_by_size in [path_list_times, tree_times]:
+        if times_by_size:
+            results.update(make_scaling_results(times_by_size, max_scaling_exponent))
+    return {
+        "micro_benchmark_version": MICRO_BENCHMARK_VERSION,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": run_benchmark.get_git_commit(),
+        "environment": run_benchmark.get_environment(),
+        "config": {
+            "sizes": sizes,
+            "tree_sizes": tree_sizes,
+            "fixture_file": fixture_file,
+            "max_workers": max_workers,
+            "repeats": repeats,
+            "max_scaling_exponent": max_scaling_exponent,
+        },
+        "results": results,
+    }
+
+
+def make_scaling_text(scaling_results):
+    lines = ["  %-28s %9s  %s" % ("code path", "exponent", "wall time (s) by number of files")]
+    for code_path, scaling_result in scaling_results.items():
+        lines.append(
+            "  %-28s %9s  %s%s"
+            % (
+                code_path,
+                "n/a" if scaling_result["exponent"] is None else "%.2f" % (scaling_result["exponent"]),
+                ", ".join(
+                    "%s: %.3f" % (size, time)
+                    for size, time in zip(scaling_result["sizes"], scaling_result["times"])
+                ),
+                "  SUPER-LINEAR" if scaling_result["super_linear"] else "",
+            )
+        )
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Time crawling, date subsetting, grouping and progress updates against the number of data files"
+    )
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "jsmetrics_micro_benchmark"), help="directory for the fake trees (reused between runs)")
+    parser.add_argument("--sizes", type=int, nargs="*", default=DEFAULT_SIZES, help="files in each path list")
+    parser.add_argument("--tree-sizes", type=int, nargs="*", default=DEFAULT_TREE_SIZES, help="files in each fake directory tree (none to skip)")
+    parser.add_argument("--fixture", default=FIXTURE_FILE, help="data list the path lists and trees are cloned from")
+    parser.add_argument("--max-workers", type=int, default=None, help="threads listing directories")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-scaling-exponent", type=float, default=MAX_SCALING_EXPONENT)
+    parser.add_argument("--output", default=None, help="save results to this JSON file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+    logging.basicConfig(
+        filename=os.path.join(args.work_dir, "micro_benchmark.log"),
+        level=logging.INFO,
+        filemode="w",
+    )
+    micro_benchmark_results = run_micro_benchmarks(
+        args.work_dir,
+        sizes=args.sizes,
+        tree_sizes=args.tree_sizes,
+        fixture_file=args.fixture,
+        max_workers=args.max_workers,
+        repeats=args.repeats,
+        max_scaling_exponent=args.max_scaling_exponent,
+    )
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(micro_benchmark_results, output_file, indent=1)
+    results = micro_benchmark_results["results"]
+    print(make_scaling_text(results))
+    super_linear = [code_path for code_path, result in results.items() if result["super_linear"]]
+    if super_linear:
+        print(
+            "Super-linear (exponent over %s): %s"
+            % (args.max_scaling_exponent, ", ".join(super_linear))
+        )
+        sys.exit(1)
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Runs experiments/CMIP_Historical_npac/main.py end to end on synthetic CMIP6 data
+    (see benchmarks.synthetic_cmip6) and saves the throughput and time of each stage as JSON,
+    so runs of different versions of the code (or settings) can be compared.
+
+    Usage (from the repository root):
+        python -m benchmarks.run_benchmark --work-dir /tmp/jsmetrics_benchmark --n-workers 4 --output before.json
+        python -m benchmarks.run_benchmark --work-dir /tmp/jsmetrics_benchmark --n-workers 4 --output after.json
+        python -m benchmarks.run_benchmark --compare before.json after.json
+"""
+
+#  imports
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from benchmarks import synthetic_cmip6
+from utils import get_data, instrumentation, memory_usage
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+BENCHMARK_VERSION = 1  # bump when the results change so old results are not compared with new ones
+DATA_DIR = "badc/cmip6/data/CMIP6/CMIP/"  # synthetic data is written here in the work directory
+EXPERIMENT_DIR = "experiment"  # data lists, progress logs, outputs and trace are written here in the work directory
+PACKAGES_TO_REPORT = ["numpy", "xarray", "dask", "netCDF4", "pyarrow", "jsmetrics"]
+
+
+log = logging.getLogger(__name__)
+
+
+def configure_experiment(experiment, data_dir, experiment_dir, start_year, n_years):
+    """
+    Points the globals of an experiment module at the synthetic data and a fresh experiment
+    directory (workers get these globals as they are forked from this process)
+    """
+    for dir_name in ["data_lists", "progress_logs"]:
+        os.makedirs(os.path.join(experiment_dir, dir_name), exist_ok=True)
+    output_path = os.path.join(experiment_dir, "outputs")
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.makedirs(output_path)
+    experiment.PATH_NAME = get_data.make_cmip6_drs_pathname(
+        data_dir,
+        experiment=synthetic_cmip6.EXPERIMENT,
+        member="r*",
+        table=synthetic_cmip6.TABLE,
+        variable=synthetic_cmip6.VARIABLE,
+        version="latest",
+    )
+    data_lists_dir = os.path.join(experiment_dir, "data_lists")
+    experiment.DATA_PATH_FILE = os.path.join(data_lists_dir, "ua_synthetic.txt")
+    experiment.SUBSET_DATA_PATH_FILE = os.path.join(data_lists_dir, "ua_synthetic_subset.txt")
+    experiment.FILE_CATALOG_PATH = os.path.join(data_lists_dir, "ua_synthetic.sqlite")
+    experiment.OUTPUT_PATH = output_path
+    experiment.TRACE_DIR = os.path.join(experiment_dir, "trace")
+    experiment.RECORD_TRACE = True
+    experiment.TRACK_PEAK_MEMORY = True
+    experiment.START_DATE = "%s0101" % (start_year)
+    experiment.END_DATE = "%s1231" % (start_year + n_years - 1)
+
+
+def run_benchmark(
+    work_dir,
+    n_models=len(synthetic_cmip6.SYNTHETIC_MODELS),
+    n_members=1,
+    start_year=1950,
+    n_years=10,
+    grid=None,
+    years_per_file=None,
+    n_workers=1,
+    label=None,
+):
+    """
+    Writes synthetic data to work_dir (keeping files already there), then runs the
+    CMIP_Historical_npac experiment on it from scratch
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory for the synthetic data and experiment (reuse it to skip writing the data again)
+    n_models, n_members, start_year, n_years, grid, years_per_file
+        Size of synthetic data (see synthetic_cmip6.get_model_specs and write_synthetic_cmip6_tree)
+    n_workers : int
+        Groups run at once (see experiments.CMIP_Historical_npac.main.main)
+    label : str
+        Name for these results e.g. 'before parquet'
+
+    Returns
+    ----------
+    benchmark_results : dict
+        Config, environment and results (see make_benchmark_results)
+    """
+    #  imported here so importing this module does not need the experiment's dependencies
+    from experiments.CMIP_Historical_npac import main as experiment
+
+    config = {
+        "n_models": n_models,
+        "n_members": n_members,
+        "start_year": start_year,
+        "n_years": n_years,
+        "grid": grid,
+        "years_per_file": years_per_file,
+        "n_workers": n_workers,
+        "model_specs": synthetic_cmip6.get_model_specs(n_models, grid, years_per_file),
+    }
+    data_dir = os.path.join(os.path.abspath(work_dir), DATA_DIR)
+    generate_start_time = time.perf_counter()
+    data_paths = synthetic_cmip6.write_synthetic_cmip6_tree(
+        data_dir, config["model_specs"], n_members, start_year, n_years
+    )
+    generate_time = time.perf_counter() - generate_start_time
+    log.info("%s synthetic files ready in %.1fs" % (len(data_paths), generate_time))
+    experiment_dir = os.path.join(os.path.abspath(work_dir), EXPERIMENT_DIR)
+    configure_experiment(experiment, data_dir, experiment_dir, start_year, n_years)
+    run_start_time = time.perf_counter()
+    experiment.main(n_workers=n_workers, max_memory_per_worker=None)
+    wall_time = time.perf_counter() - run_start_time
+    return make_benchmark_results(
+        config,
+        data_paths,
+        wall_time,
+        instrumentation.load_events(experiment.TRACE_DIR),
+        memory_usage.load_memory_records(experiment.OUTPUT_PATH),
+        label,
+        generate_time,
+    )
+
+
+def make_benchmark_results(
+    config, data_paths, wall_time, events, memory_records, label=None, generate_time=None
+):
+    """
+    Returns
+    ----------
+    benchmark_results : dict
+        'results' has the wall time of the run, groups per hour, MB of input per second,
+        the peak RSS of the largest group and the count, wall time, CPU time and bytes read
+        of each stage and metric (from the instrumentation events)
+    """
+    group_events = [event for event in events if event["stage"] == instrumentation.GROUP_STAGE]
+    n_groups_done = sum(
+        1 for event in group_events if str(event.get("status", "")).startswith("done")
+    )
+    input_bytes = sum(os.path.getsize(data_path) for data_path in data_paths)
+    peaks = [
+        memory_record["peak_rss"]
+        for memory_record in memory_records
+        if memory_record.get("peak_rss") is not None
+    ]
+    results = {
+        "wall_time": wall_time,
+        "generate_time": generate_time,
+        "n_files": len(data_paths),
+        "input_bytes": input_bytes,
+        "n_groups": len(group_events),
+        "n_groups_done": n_groups_done,
+        "groups_per_hour": len(group_events) / wall_time * 3600 if wall_time else None,
+        "mb_per_second": input_bytes / 1e6 / wall_time if wall_time else None,
+        "max_peak_rss": max(peaks) if peaks else None,
+        "stages": summary_to_dict(
+            instrumentation.summarise_events(
+                events, "stage", sorted(set(event["stage"] for event in events))
+            )
+        ),
+        "metrics": summary_to_dict(
+            instrumentation.summarise_events(events, "metric", instrumentation.METRIC_STAGES)
+        ),
+    }
+    return {
+        "benchmark_version": BENCHMARK_VERSION,
+        "label": label,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": get_git_commit(),
+        "environment": get_environment(),
+        "config": config,
+        "results": results,
+    }
+
+
+def summary_to_dict(summary):
+    return {
+        key: {"count": count, "wall_time": wall_time, "cpu_time": cpu_time, "bytes_read": bytes_read}
+        for key, count, wall_time, cpu_time, bytes_read in summary
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_environment():
+    package_versions = {}
+    for package_name in PACKAGES_TO_REPORT:
+        try:
+            package_versions[package_name] = getattr(
+                __import__(package_name), "__version__", None
+            )
+        except ImportError:
+            package_versions[package_name] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "host": platform.node(),
+        "n_cpus": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(),
+        "packages": package_versions,
+    }
+
+
+def compare_benchmark_results(old_results, new_results):
+    """
+    Ratio of new to old for the throughput and the wall time of each stage and metric
+
+    Returns
+    ----------
+    comparison : list
+        (name, old value, new value, new / old) for each value in both results
+
+    Raises
+    ----------
+    ValueError
+        When the results are from different BENCHMARK_VERSIONs
+    """
+    if old_results["benchmark_version"] != new_results["benchmark_version"]:
+        raise ValueError(
+            "cannot compare results of benchmark version %s with %s"
+            % (old_results["benchmark_version"], new_results["benchmark_version"])
+        )
+    old, new = old_results["results"], new_results["results"]
+    rows = [
+        (name, old[name], new[name])
+        for name in ["wall_time", "groups_per_hour", "mb_per_second", "max_peak_rss"]
+    ]
+    for summary_name in ["stages", "metrics"]:
+        for key in old[summary_name]:
+            if key in new[summary_name]:
+                rows.append(
+                    (
+                        "%s: %s wall_time" % (summary_name[:-1], key),
+                        old[summary_name][key]["wall_time"],
+                        new[summary_name][key]["wall_time"],
+                    )
+                )
+    return [
+        (name, old_value, new_value, new_value / old_value if old_value and new_value is not None else None)
+        for name, old_value, new_value in rows
+    ]
+
+
+def make_comparison_text(comparison):
+    lines = ["  %-70s %12s %12s %8s" % ("", "old", "new", "new/old")]
+    for name, old_value, new_value, ratio in comparison:
+        lines.append(
+            "  %-70s %12s %12s %8s"
+            % (
+                name[:70],
+                "n/a" if old_value is None else "%.2f" % (old_value),
+                "n/a" if new_value is None else "%.2f" % (new_value),
+                "n/a" if ratio is None else "%.2f" % (ratio),
+            )
+        )
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the CMIP Historical NPAC experiment on synthetic CMIP6 data"
+    )
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "jsmetrics_benchmark"), help="directory for the synthetic data and experiment (reused between runs)")
+    parser.add_argument("--n-models", type=int, default=len(synthetic_cmip6.SYNTHETIC_MODELS))
+    parser.add_argument("--n-members", type=int, default=1)
+    parser.add_argument("--start-year", type=int, default=1950)
+    parser.add_argument("--n-years", type=int, default=10)
+    parser.add_argument("--grid", type=int, nargs=2, metavar=("N_LAT", "N_LON"), default=None, help="grid of every model (default: a low, mid and high resolution model)")
+    parser.add_argument("--years-per-file", type=int, default=None, help="years in each file (default: 10 or 5 depending on the model)")
+    parser.add_argument("--n-workers", type=int, default=1)
+    parser.add_argument("--label", default=None)
+    parser.add_argument("--output", default=None, help="save results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), default=None, help="compare two results files instead of running")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.compare:
+        with open(args.compare[0], "r") as old_file, open(args.compare[1], "r") as new_file:
+            print(make_comparison_text(compare_benchmark_results(json.load(old_file), json.load(new_file))))
+    else:
+        os.makedirs(args.work_dir, exist_ok=True)
+        logging.basicConfig(
+            filename=os.path.join(args.work_dir, "benchmark.log"),
+            level=logging.INFO,
+            filemode="w",
+        )
+        benchmark_results = run_benchmark(
+            args.work_dir,
+            n_models=args.n_models,
+            n_members=args.n_members,
+            start_year=args.start_year,
+            n_years=args.n_years,
+            grid=args.grid,
+            years_per_file=args.years_per_file,
+            n_workers=args.n_workers,
+            label=args.label,
+        )
+        print(json.dumps(benchmark_results["results"], indent=1))
+        if args.output:
+            with open(args.output, "w") as output_file:
+                json.dump(benchmark_results, output_file, indent=1)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Writes fake CMIP6 daily ua data following the DRS directory layout and JASMIN file naming
+    (see utils.get_data), so the experiments can be run and timed away from /badc.
+    Like the real data, members are split over many files (e.g. one per 5 or 10 years), lat is
+    descending, lon is 0-360, the calendar is noleap and plev is in Pa.
+"""
+
+#  imports
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import xarray
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+EXPERIMENT = "historical"
+TABLE = "day"
+VARIABLE = "ua"
+GRID = "gn"
+VERSION = "v20190101"  # 'latest' links to this version directory like on JASMIN
+CALENDAR = "noleap"
+TIME_UNITS = "days since 1850-01-01"
+PLEV = [100000, 85000, 70000, 50000, 25000, 10000, 5000, 1000]  # Pa, as in CMIP6 'plev8'
+DAYS_PER_CHUNK = 73  # days of ua made at once (so memory does not grow with years per file)
+
+#  models written by default (cycled through when more models are asked for)
+SYNTHETIC_MODELS = [
+    {"institution": "SYNTH-A", "model": "SynthLowRes", "n_lat": 64, "n_lon": 128, "years_per_file": 10},
+    {"institution": "SYNTH-A", "model": "SynthMidRes", "n_lat": 96, "n_lon": 144, "years_per_file": 5},
+    {"institution": "SYNTH-B", "model": "SynthHighRes", "n_lat": 144, "n_lon": 192, "years_per_file": 5},
+]
+
+
+def get_model_specs(n_models=len(SYNTHETIC_MODELS), grid=None, years_per_file=None):
+    """
+    Specification of each synthetic model
+
+    Parameters
+    ----------
+    n_models : int
+        Number of models (SYNTHETIC_MODELS is cycled through, with a number added to repeated names)
+    grid : tuple
+        (n_lat, n_lon) of every model (default: the grid of each model in SYNTHETIC_MODELS)
+    years_per_file : int
+        Years in each file of every model (default: from SYNTHETIC_MODELS)
+
+    Returns
+    ----------
+    model_specs : list
+        Dict of institution, model, n_lat, n_lon and years_per_file for each model
+    """
+    model_specs = []
+    for model_index in range(n_models):
+        model_spec = dict(SYNTHETIC_MODELS[model_index % len(SYNTHETIC_MODELS)])
+        if model_index >= len(SYNTHETIC_MODELS):
+            model_spec["model"] += str(model_index // len(SYNTHETIC_MODELS) + 1)
+        if grid is not None:
+            model_spec["n_lat"], model_spec["n_lon"] = grid
+        if years_per_file is not None:
+            model_spec["years_per_file"] = years_per_file
+        model_specs.append(model_spec)
+    return model_specs
+
+
+def get_member_name(member_index):
+    return "r%si1p1f1" % (member_index + 1)
+
+
+def get_member_dir(data_dir, model_spec, member_index, version=VERSION):
+    return os.path.join(
+        data_dir,
+        model_spec["institution"],
+        model_spec["model"],
+        EXPERIMENT,
+        get_member_name(member_index),
+        TABLE,
+        VARIABLE,
+        GRID,
+        version,
+    )
+
+
+def get_file_name(model_spec, member_index, start_year, end_year):
+    return "%s_%s_%s_%s_%s_%s_%s0101-%s1231.nc" % (
+        VARIABLE,
+        TABLE,
+        model_spec["model"],
+        EXPERIMENT,
+        get_member_name(member_index),
+        GRID,
+        start_year,
+        end_year,
+    )
+
+
+def get_file_year_ranges(start_year, n_years, years_per_file):
+    """
+    (start year, end year) of each file, split on multiples of years_per_file like CMIP6
+    files (e.g. 1950-1954, 1955-1959)
+    """
+    year_ranges = []
+    year = start_year
+    end_year = start_year + n_years - 1
+    while year <= end_year:
+        file_end_year = min((year // years_per_file + 1) * years_per_file - 1, end_year)
+        year_ranges.append((year, file_end_year))
+        year = file_end_year + 1
+    return year_ranges
+
+
+def make_synthetic_ua(model_spec, member_index, start_year, end_year):
+    """
+    Daily ua with a jet that moves with the seasons and wanders day to day, plus noise.
+    Values only depend on the model, member and years so files are the same each time.
+
+    Returns
+    ----------
+    data : xarray.Dataset
+        ua (time, plev, lat, lon) with lat_bnds and lon_bnds like CMIP6 files
+    """
+    n_lat, n_lon = model_spec["n_lat"], model_spec["n_lon"]
+    seed = zlib.crc32(("%s %s %s" % (model_spec["model"], member_index, start_year)).encode())
+    rng = numpy.random.default_rng(seed)
+    time = xarray.date_range(
+        "%04d-01-01" % (start_year),
+        "%04d-12-31" % (end_year),
+        freq="D",
+        calendar=CALENDAR,
+        use_cftime=True,
+    )
+    lat_step = 180 / n_lat
+    lat = numpy.linspace(90 - lat_step / 2, -90 + lat_step / 2, n_lat)  # descending
+    lon = numpy.arange(n_lon) * 360 / n_lon
+    plev = numpy.array(PLEV, dtype="float64")
+    day_of_year = numpy.arange(time.size) % 365
+    #  jet further north in summer with a random walk on top
+    jet_lat = (
+        42
+        + 6 * numpy.sin(2 * numpy.pi * (day_of_year - 100) / 365)
+        + numpy.cumsum(rng.normal(0, 0.5, time.size)) * 0.1
+    )
+    jet_speed = 25 + 10 * numpy.exp(-(((numpy.log(plev / 25000)) / 1.2) ** 2))
+    lon_factor = 1 + 0.2 * numpy.cos(numpy.deg2rad(lon))
+    ua = numpy.empty((time.size, plev.size, n_lat, n_lon), dtype="float32")
+    for chunk_start in range(0, time.size, DAYS_PER_CHUNK):
+        chunk = slice(chunk_start, min(chunk_start + DAYS_PER_CHUNK, time.size))
+        ua_chunk = jet_speed[None, :, None, None] * numpy.exp(
+            -(((lat[None, None, :, None] - jet_lat[chunk, None, None, None]) / 8) ** 2)
+        ) * lon_factor[None, None, None, :]
+        ua[chunk] = ua_chunk + rng.normal(0, 3, ua_chunk.shape)
+    data = xarray.Dataset(
+        {
+            VARIABLE: (("time", "plev", "lat", "lon"), ua),
+            "lat_bnds": (("lat", "bnds"), numpy.stack([lat + lat_step / 2, lat - lat_step / 2], axis=1)),
+            "lon_bnds": (("lon", "bnds"), numpy.stack([lon, lon + 360 / n_lon], axis=1)),
+        },
+        coords={"time": time, "plev": plev, "lat": lat, "lon": lon},
+    )
+    data[VARIABLE].attrs = {"standard_name": "eastward_wind", "units": "m s-1"}
+    data["plev"].attrs = {"standard_name": "air_pressure", "units": "Pa", "axis": "Z", "positive": "down"}
+    data["lat"].attrs = {"standard_name": "latitude", "units": "degrees_north", "axis": "Y"}
+    data["lon"].attrs = {"standard_name": "longitude", "units": "degrees_east", "axis": "X"}
+    data.attrs = {
+        "source_id": model_spec["model"],
+        "institution_id": model_spec["institution"],
+        "experiment_id": EXPERIMENT,
+        "variant_label": get_member_name(member_index),
+        "grid_label": GRID,
+        "frequency": TABLE,
+    }
+    return data
+
+
+def write_synthetic_file(data_path, model_spec, member_index, start_year, end_year):
+    data = make_synthetic_ua(model_spec, member_index, start_year, end_year)
+    temp_data_path = data_path + ".tmp"
+    data.to_netcdf(
+        temp_data_path,
+        unlimited_dims=["time"],
+        encoding={"time": {"units": TIME_UNITS, "calendar": CALENDAR}},
+    )
+    os.replace(temp_data_path, data_path)
+    return data_path
+
+
+def write_synthetic_cmip6_tree(
+    data_dir,
+    model_specs,
+    n_members=1,
+    start_year=1950,
+    n_years=10,
+    max_workers=None,
+    overwrite=False,
+):
+    """
+    Writes synthetic data for each model and member in the CMIP6 DRS layout under data_dir
+    i.e. data_dir/[institution]/[model]/historical/[member]/day/ua/gn/v20190101/*.nc
+    with a 'latest' link to the version directory
+
+    Parameters
+    ----------
+    data_dir : str
+        Activity directory e.g. [root]/badc/cmip6/data/CMIP6/CMIP/
+    model_specs : list
+        From get_model_specs
+    n_members : int
+        Members of each model
+    start_year : int
+    n_years : int
+    max_workers : int
+        Processes writing files at once (default: one per CPU)
+    overwrite : bool
+        Write files which already exist again (default: keep them)
+
+    Returns
+    ----------
+    data_paths : list
+        Path of every file (through the 'latest' link)
+    """
+    files_to_write = []
+    data_paths = []
+    for model_spec in model_specs:
+        for member_index in range(n_members):
+            member_dir = get_member_dir(data_dir, model_spec, member_index)
+            os.makedirs(member_dir, exist_ok=True)
+            latest_dir = get_member_dir(data_dir, model_spec, member_index, version="latest")
+            if not os.path.islink(latest_dir):
+                os.symlink(VERSION, latest_dir)
+            for file_start_year, file_end_year in get_file_year_ranges(
+                start_year, n_years, model_spec["years_per_file"]
+            ):
+                file_name = get_file_name(model_spec, member_index, file_start_year, file_end_year)
+                data_paths.append(os.path.join(latest_dir, file_name))
+                data_path = os.path.join(member_dir, file_name)
+                if overwrite or not os.path.exists(data_path):
+                    files_to_write.append(
+                        (data_path, model_spec, member_index, file_start_year, file_end_year)
+                    )
+    #  files are written in fresh processes so the caller never opens netCDF files before forking workers
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for future in [
+            executor.submit(write_synthetic_file, *file_to_write) for file_to_write in files_to_write
+        ]:
+            future.result()
+    return data_paths
@@ -1,9 +1,14 @@
-from utils import get_data
+from utils import file_catalog, get_data
 
 
-def get_sspxxx_data_list(path_name, output_file_name):
+def get_sspxxx_data_list(path_name, output_file_name, use_crawler=True, max_workers=None):
     data_path_retriever = get_data.GlobDataPathRetrieverFromJASMIN(path_name)
-    data_path_retriever.retrieve_data_paths(inplace=True, one_realisation=False)
+    data_path_retriever.retrieve_data_paths(
+        inplace=True,
+        one_realisation=False,
+        use_crawler=use_crawler,
+        max_workers=max_workers,
+    )
     data_path_retriever.save_data_paths(output_file_name)
 
 
@@ -13,3 +18,10 @@ def generate_grouped_sspxxx_data_paths(path_name, date_range_start, date_range_e
         date_range_start, date_range_end
     )
     return grouped_data_paths
+
+
+def refresh_sspxxx_file_catalog(path_name, catalog_path, output_file_name, max_workers=None):
+    data_file_catalog = file_catalog.SQLiteFileCatalog(catalog_path)
+    data_file_catalog.refresh(path_name, max_workers=max_workers)
+    data_file_catalog.save_data_paths(output_file_name)
+    return data_file_catalog
@@ -7,16 +7,34 @@
 """
 
 # imports
+import contextlib
+import datetime
+import json
 import logging
 import os
+import shutil
+import tempfile
 import xarray
-from utils import compute_jsmetrics, get_data, progress_loggers
+from utils import (
+    compute_jsmetrics,
+    get_data,
+    instrumentation,
+    memory_usage,
+    output_stores,
+    pipeline,
+    process_pool,
+    progress_loggers,
+    run_manifest,
+    sharding,
+    staging_cache,
+    subset_planner,
+)
 from metric_dicts.jsmetrics_all_jet_lats_standard_npac_20to70N import METRIC_DICT
 
 import experiments.CMIP_Historical_npac.get_sspxxx_data_list as get_ssp_data
 
 
-import numpy as np  # TODO: remove
+import numpy as np
 import matplotlib.pyplot as plt  # TODO: remove
 
 # docs
@@ -29,20 +47,56 @@ __status__ = "Development"
 
 DATA_DIR = "/badc/cmip6/data/CMIP6/CMIP/"
 EXPERIMENT = "historical"
-SEARCH_CONDITIONS = "/**/**/%s/r*/day/ua/**/latest/*.nc" % (EXPERIMENT)
-PATH_NAME = DATA_DIR + SEARCH_CONDITIONS
+PATH_NAME = get_data.make_cmip6_drs_pathname(
+    DATA_DIR,
+    experiment=EXPERIMENT,
+    member="r*",
+    table="day",
+    variable="ua",
+    version="latest",
+)  # i.e. DATA_DIR/*/*/historical/r*/day/ua/*/latest/*.nc
 DATA_PATH_FILE = (
     "experiments/CMIP_Historical_npac/data_lists/ua_historical_latest_JASMIN.txt"
 )
 SUBSET_DATA_PATH_FILE = (
     "experiments/CMIP_Historical_npac/data_lists/ua_historical_latest_subset_JASMIN.txt"
 )
+USE_FILE_CATALOG = True  # keep data paths in a SQLite catalog so reruns only re-list changed directories
+FILE_CATALOG_PATH = (
+    "experiments/CMIP_Historical_npac/data_lists/ua_historical_latest_JASMIN.sqlite"
+)
 
 START_DATE = "19500101"
 END_DATE = "20151231"
 OUTPUT_PATH = "experiments/CMIP_Historical_npac/outputs"
+OUTPUT_STORE = "parquet"  # "parquet" for a dataset partitioned by metric and model (needs pyarrow) or "csv" for one file per model member and metric
 
 TEMPORARY_PLEV_SUBSET = slice(92500,70000) # TODO remove
+PUSH_DOWN_METRIC_SUBSET = True  # subset each file to the lat/lon/plev of all metrics in METRIC_DICT as it is opened (False uses TEMPORARY_PLEV_SUBSET)
+
+LAZY_LOAD = True  # keep data dask-backed and only load the subset each metric needs (False loads the whole group first)
+TIME_CHUNK_SIZE = 365  # days in each dask chunk when LAZY_LOAD
+TIME_BLOCK_YEARS = None  # run metrics with "time_blocking" in METRIC_DICT on blocks of this many years (None runs on all years at once)
+EXTEND_OUTPUTS_IN_TIME = True  # for metrics with "time_blocking" in METRIC_DICT, only compute and append times after the saved outputs (needs the parquet OUTPUT_STORE)
+USE_RUN_MANIFEST = True  # keep a fingerprint of the inputs and metric of each output (in OUTPUT_PATH/run_manifest.sqlite) so only stale outputs are computed again
+RERUN_FAILED_METRICS = False  # rerun metrics which raised an error last time even if their inputs and metric have not changed
+RUN_MANIFEST_FILE_NAME = "run_manifest.sqlite"
+RECORD_TRACE = True  # record the wall time, CPU time and bytes read of each stage of each group and metric (see utils.instrumentation)
+TRACE_DIR = "logs/cmip_Historical_npac_trace"  # events of each process, the Chrome trace (trace.json) and summary are saved here
+TRACK_PEAK_MEMORY = True  # save the peak RSS of each stage of each group to OUTPUT_PATH/memory_usage/ (see utils.memory_usage)
+TRACE_PYTHON_ALLOCATIONS = False  # also record the peak of Python and numpy allocations with tracemalloc (slower)
+
+N_WORKERS = int(os.environ.get("JSMETRICS_N_WORKERS", 1))  # groups run at once in separate processes (1 runs groups one after another)
+METRIC_WORKERS = int(os.environ.get("JSMETRICS_METRIC_WORKERS", 1))  # metrics of a group run at once in threads sharing its data (see MetricComputerWithAllMetrics.compute_all_metrics)
+MAX_MEMORY_PER_WORKER = int(os.environ.get("JSMETRICS_MAX_MEMORY_PER_WORKER", 0)) or None  # max virtual memory (MB) of each worker process e.g. 30000 (None for no limit). Caps VSZ not RSS, see process_pool.initialise_worker
+PIPELINE_GROUPS = True  # when groups run one after another (N_WORKERS of 1), read the next group in a background thread while metrics run and save outputs in a write-behind thread (see utils.pipeline)
+PIPELINE_MEMORY_BUDGET = int(os.environ.get("JSMETRICS_PIPELINE_MEMORY_BUDGET", 8000)) or None  # MB of group data read ahead or running (and outputs waiting to be saved) held at once by the pipeline (None for no limit)
+PREFETCH_GROUPS = pipeline.PREFETCH_DEPTH  # groups read ahead of the group running metrics
+WRITE_BEHIND_GROUPS = pipeline.WRITE_BEHIND_DEPTH  # groups whose outputs can wait to be saved
+USE_STAGING_CACHE = bool(int(os.environ.get("JSMETRICS_USE_STAGING_CACHE", 0)))  # copy the files of each group to node-local disk before opening them, so reruns and retries read the local copies (see utils.staging_cache)
+STAGING_DIR = os.environ.get("JSMETRICS_STAGING_DIR") or os.path.join(tempfile.gettempdir(), "jsmetrics_staging")  # node-local directory files are copied to ($TMPDIR by default)
+STAGING_QUOTA = int(os.environ.get("JSMETRICS_STAGING_QUOTA", staging_cache.STAGING_QUOTA))  # MB of staged files kept (least recently used are removed first). Needs to hold the groups of every worker on the node
+STAGING_COPY_WORKERS = staging_cache.COPY_WORKERS  # files of a group copied at once
 
 assert (
     "/data_lists/" in DATA_PATH_FILE and "/data_lists/" in SUBSET_DATA_PATH_FILE
@@ -52,9 +106,11 @@ assert (
 log = logging.getLogger(__name__)
 
 
-def set_up_progress_logger():
+def set_up_progress_logger(data_list_file=SUBSET_DATA_PATH_FILE, new_run=True):
     try:
-        progress_logger = progress_loggers.DataListProgressLogger(SUBSET_DATA_PATH_FILE)
+        progress_logger = progress_loggers.JournaledProgressLogger(
+            data_list_file, new_run=new_run
+        )
     except Exception as e:
         log.error("Unable to create progress logger. See below error message")
         log.error(e)
@@ -62,6 +118,73 @@ def set_up_progress_logger():
     return progress_logger
 
 
+def get_progress_logger_if_available(data_list_file=SUBSET_DATA_PATH_FILE, new_run=True):
+    try:
+        return set_up_progress_logger(data_list_file, new_run)
+    except Exception:
+        log.error("Continuing without a progress log")
+        return None
+
+
+def record_group_progress(progress_logger, data_path_group, ind, n_groups, status, error):
+    """
+    Logs that a group has finished and (if there is a progress log) moves each of the
+    group's paths to done or failed. Only called from the main process.
+    """
+    if error is not None:
+        status = "failed: %s" % (repr(error))
+    log.info("Group %s out of %s finished: %s" % (ind + 1, n_groups, status))
+    if progress_logger is None:
+        return
+    if status.startswith(progress_loggers.FAILED):
+        state = progress_loggers.FAILED
+    else:
+        state = progress_loggers.DONE
+    try:
+        progress_logger.record_state(data_path_group, state, status)
+    except Exception as e:
+        log.error("unable to record progress of group %s" % (ind + 1))
+        log.error(e)
+
+
+def record_group_state(data_list_file, data_path_group, state, info=""):
+    """
+    Records the progress of a group from the process running it (see
+    progress_loggers.JournaledProgressLogger.record_state). Errors recording progress are
+    logged so the group carries on.
+    """
+    if data_list_file is None:
+        return
+    progress_logger = get_progress_logger_if_available(data_list_file, new_run=False)
+    if progress_logger is None:
+        return
+    try:
+        progress_logger.record_state(data_path_group, state, info)
+    except Exception as e:
+        log.error("unable to record %s in the progress journal" % (state))
+        log.error(e)
+    finally:
+        progress_logger.close()
+
+
+def render_progress_log(shard_index=None, shard_count=None):
+    """
+    Writes the progress log of a run (or of one shard) from its progress journal,
+    i.e. to check on a run while it is going
+    """
+    shard_index, shard_count = sharding.get_shard_index_and_count(shard_index, shard_count)
+    data_list_file = SUBSET_DATA_PATH_FILE
+    if shard_count > 1:
+        data_list_file = sharding.get_shard_data_list_file(
+            SUBSET_DATA_PATH_FILE, shard_index, shard_count
+        )
+    progress_logger = set_up_progress_logger(data_list_file, new_run=False)
+    try:
+        return progress_logger.render_progress_log_file()
+    finally:
+        progress_logger.close()
+
+
 def assert_logger_and_data_list_length_equal(progress_logger, data_list):
     data_list_length = progress_logger.get_length_of_data_list()
     assert data_list_length == len(
@@ -69,113 +192,1041 @@ def assert_logger_and_data_list_length_equal(progress_logger, data_list):
     ), "Data list length not the same as the total in data paths input file"
 
 
-def main():
-    #  Step 0. Get data from JASMIN
-    get_ssp_data.get_sspxxx_data_list(PATH_NAME, DATA_PATH_FILE)
-    #  Step 1. Subset data list
-    _ = make_data_list_date_subset(start_date=START_DATE, end_date=END_DATE)
-    grouped_subset_data_paths = get_ssp_data.generate_grouped_sspxxx_data_paths(
-        SUBSET_DATA_PATH_FILE, START_DATE, END_DATE
-    )
-    #  Step 3. Run experiment from subset list one by one
-    for ind, data_path_group in enumerate(grouped_subset_data_paths):
-        data_path_group_name = os.path.split(data_path_group[0])[-1][:-21]
+def main(
+    n_workers=N_WORKERS,
+    max_memory_per_worker=MAX_MEMORY_PER_WORKER,
+    shard_index=None,
+    shard_count=None,
+):
+    """
+    Run the experiment. When run as one shard of many (e.g. one task of a SLURM job array)
+    the data lists made by prepare_shards() are used and outputs are kept in
+    OUTPUT_PATH/shards/ until merge_shards() is run.
+    """
+    shard_index, shard_count = sharding.get_shard_index_and_count(shard_index, shard_count)
+    if RECORD_TRACE:
+        start_trace(shard_index, shard_count)
+    if shard_count > 1:
+        data_list_file = sharding.get_shard_data_list_file(
+            SUBSET_DATA_PATH_FILE, shard_index, shard_count
+        )
+        if not os.path.isfile(data_list_file):
+            raise FileNotFoundError(
+                "'%s' does not exist. Run prepare_shards(%s) before running shards"
+                % (data_list_file, shard_count)
+            )
+        output_path = sharding.get_shard_output_path(OUTPUT_PATH, shard_index, shard_count)
+        os.makedirs(output_path, exist_ok=True)
+        #  Step 0/1. Read this shard's groups (data list already subset by prepare_shards)
+        grouped_subset_data_paths = get_ssp_data.generate_grouped_sspxxx_data_paths(
+            data_list_file, START_DATE, END_DATE
+        )
         log.info(
-            "Starting %s. %s out of %s. Total datsets in group: %s "
-            % (
-                data_path_group_name,
-                ind + 1,
-                len(grouped_subset_data_paths),
-                len(data_path_group),
+            "Running %s: %s groups"
+            % (sharding.get_shard_name(shard_index, shard_count), len(grouped_subset_data_paths))
+        )
+    else:
+        data_list_file = SUBSET_DATA_PATH_FILE
+        output_path = OUTPUT_PATH
+        #  Step 0/1. Get data from JASMIN and subset data list
+        with instrumentation.time_stage("prepare data list"):
+            grouped_subset_data_paths = prepare_grouped_data_paths()
+    #  Step 2. Set up progress log
+    progress_logger = get_progress_logger_if_available(data_list_file)
+    n_groups = len(grouped_subset_data_paths)
+    #  Step 2.1. Find outputs which are up to date from the run manifest (without opening any data)
+    metric_fingerprints = {
+        metric_info["name"]: run_manifest.make_metric_fingerprint(metric_info)
+        for metric_info in yield_metric_info_from_metric_dict(METRIC_DICT)
+    }
+    group_input_files = [None] * n_groups
+    group_output_states = [{}] * n_groups
+    manifest = None
+    if USE_RUN_MANIFEST:
+        manifest = run_manifest.SQLiteRunManifest(
+            os.path.join(output_path, RUN_MANIFEST_FILE_NAME)
+        )
+        group_input_files, group_output_states = get_group_output_states(
+            grouped_subset_data_paths, metric_fingerprints, output_path
+        )
+
+    def on_group_done(ind, result, error):
+        status, metric_errors = result if result else (None, {})
+        if manifest is not None and metric_errors:
+            manifest.record_outputs(
+                get_data_path_group_name(grouped_subset_data_paths[ind]),
+                group_input_files[ind],
+                {metric_name: metric_fingerprints[metric_name] for metric_name in metric_errors},
+                metric_errors,
             )
+        record_group_progress(
+            progress_logger, grouped_subset_data_paths[ind], ind, n_groups, status, error
         )
-        # Step 3.1. read but not load data
-        try:
-            data = xarray.open_mfdataset(data_path_group)
-            data = data.sel(plev=TEMPORARY_PLEV_SUBSET, time=slice(START_DATE[:4], END_DATE[:4]))
-            log.info("Data head: %s" % (data.head()))
-        except Exception as e:
-            log.error('failed to load mfdataset, trying again with h5netcdf engine')
+
+    groups_to_run = []
+    for ind, output_states in enumerate(group_output_states):
+        if all(
+            output_states.get(metric_name) == run_manifest.UP_TO_DATE
+            or (output_states.get(metric_name) == run_manifest.FAILED and not RERUN_FAILED_METRICS)
+            for metric_name in metric_fingerprints
+        ):
+            on_group_done(ind, ("done! outputs up to date", {}), None)
+        else:
+            groups_to_run.append(ind)
+    #  Step 3. Run experiment from subset list (one group at a time or in a pool of processes)
+    if n_workers > 1:
+        log.info("Running %s groups with %s workers" % (len(groups_to_run), n_workers))
+        process_pool.run_tasks_in_process_pool(
+            run_data_path_group,
+            [
+                (
+                    grouped_subset_data_paths[ind],
+                    ind,
+                    n_groups,
+                    output_path,
+                    group_output_states[ind],
+                    data_list_file,
+                )
+                for ind in groups_to_run
+            ],
+            max_workers=n_workers,
+            max_memory_per_worker=max_memory_per_worker,
+            on_task_done=lambda task_ind, result, error: on_group_done(
+                groups_to_run[task_ind], result, error
+            ),
+        )
+    elif PIPELINE_GROUPS and len(groups_to_run) > 1:
+        log.info(
+            "Running %s groups in a pipeline (%s MB memory budget)"
+            % (len(groups_to_run), PIPELINE_MEMORY_BUDGET)
+        )
+        run_data_path_groups_in_pipeline(
+            grouped_subset_data_paths,
+            groups_to_run,
+            output_path,
+            group_output_states,
+            data_list_file,
+            on_group_done,
+        )
+    else:
+        for ind in groups_to_run:
             try:
-                data = xarray.open_mfdataset(data_path_group, engine='h5netcdf')
-                data = data.sel(plev=TEMPORARY_PLEV_SUBSET, time=slice(START_DATE[:4], END_DATE[:4]))
-                log.info("Data head (h5netcdf): %s" % (data.head()))
+                result, error = (
+                    run_data_path_group(
+                        grouped_subset_data_paths[ind],
+                        ind,
+                        n_groups,
+                        output_path,
+                        group_output_states[ind],
+                        data_list_file,
+                    ),
+                    None,
+                )
             except Exception as e:
                 log.error(e)
-                continue
-        data_loaded = False
-        # Step 3.2  Subset, run & save outputs of metric
-        jsmetric_iterator = yield_metric_info_from_metric_dict(METRIC_DICT)
-        for metric_info in jsmetric_iterator:
-            metric_name = metric_info["name"]
-            variable_name = metric_info["variable_name"]
-            output_file_path = os.path.join(OUTPUT_PATH, data_path_group_name + metric_name + ".csv")
-            if os.path.exists(output_file_path):
-                log.info("output file already exists so assuming it has been calculated. File: %s" % (output_file_path))
-                continue
-            if not data_loaded:
-                data.load()
-                data_loaded = True
+                result, error = None, e
+            on_group_done(ind, result, error)
+    if manifest is not None:
+        manifest.close()
+    if progress_logger is not None:
+        progress_logger.render_progress_log_file()
+        progress_logger.close()
+    #  Step 4. Move staged outputs into the store (shard outputs are moved by merge_shards)
+    if shard_count == 1:
+        with instrumentation.time_stage("compact"):
+            output_stores.get_output_store(OUTPUT_STORE, output_path).compact()
+        if RECORD_TRACE:
+            summarise_trace()
+        if TRACK_PEAK_MEMORY:
+            report_memory_usage(n_workers)
+    instrumentation.stop_tracing()
+
+
+def start_trace(shard_index, shard_count):
+    """
+    Records each stage of this run (or shard) to TRACE_DIR (see utils.instrumentation),
+    removing the trace of the last run first
+    """
+    trace_dir = TRACE_DIR
+    if shard_count > 1:
+        trace_dir = os.path.join(TRACE_DIR, sharding.get_shard_name(shard_index, shard_count))
+    shutil.rmtree(trace_dir, ignore_errors=True)
+    instrumentation.start_tracing(trace_dir)
+
+
+def summarise_trace(trace_dir=None):
+    """
+    Writes the events of every process (and shard) in trace_dir (default: TRACE_DIR) as a
+    Chrome trace and logs the slowest models, groups, metrics and stages
+
+    Returns
+    ----------
+    summary : str
+    """
+    if trace_dir is None:
+        trace_dir = TRACE_DIR
+    events = instrumentation.load_events(trace_dir)
+    trace_file_path = instrumentation.write_chrome_trace(
+        events, os.path.join(trace_dir, instrumentation.CHROME_TRACE_FILE_NAME)
+    )
+    summary = instrumentation.make_summary_text(events)
+    log.info("Trace of %s stages saved to %s" % (len(events), trace_file_path))
+    log.info("Summary of trace:\n%s" % (summary))
+    return summary
+
+
+def get_group_output_states(grouped_data_paths, metric_fingerprints, output_path=OUTPUT_PATH):
+    """
+    Input files and the run manifest state of each output (see run_manifest.SQLiteRunManifest)
+    for each group. A shard also uses the manifest of outputs already merged into OUTPUT_PATH.
+
+    Returns
+    ----------
+    group_input_files : list
+        (path, size, mtime_ns) of each input file for each group
+    group_output_states : list
+        Dict of the state of each metric's output for each group
+    """
+    manifest_paths = [os.path.join(OUTPUT_PATH, RUN_MANIFEST_FILE_NAME)]
+    if output_path != OUTPUT_PATH:
+        manifest_paths.append(os.path.join(output_path, RUN_MANIFEST_FILE_NAME))
+    group_input_files = [
+        run_manifest.get_input_files(data_path_group) for data_path_group in grouped_data_paths
+    ]
+    group_output_states = [{} for _ in grouped_data_paths]
+    for manifest_path in manifest_paths:
+        if not os.path.exists(manifest_path):
+            continue
+        manifest = run_manifest.SQLiteRunManifest(manifest_path)
+        for ind, data_path_group in enumerate(grouped_data_paths):
+            group_output_states[ind].update(
+                manifest.get_output_states(
+                    get_data_path_group_name(data_path_group),
+                    group_input_files[ind],
+                    metric_fingerprints,
+                )
+            )
+        manifest.close()
+    return group_input_files, group_output_states
+
+
+def get_data_path_group_name(data_path_group):
+    return os.path.split(data_path_group[0])[-1][:-21]
+
+
+def prepare_grouped_data_paths():
+    """
+    Step 0. Get data from JASMIN and Step 1. subset data list, then group the subset data paths
+    """
+    if USE_FILE_CATALOG:
+        #  Step 0. Get data from JASMIN (only re-listing directories which have changed)
+        data_file_catalog = get_ssp_data.refresh_sspxxx_file_catalog(
+            PATH_NAME, FILE_CATALOG_PATH, DATA_PATH_FILE
+        )
+        #  Step 1. Subset data list
+        _ = make_data_list_date_subset_from_catalog(
+            data_file_catalog, start_date=START_DATE, end_date=END_DATE
+        )
+        grouped_subset_data_paths = data_file_catalog.group_data_paths(
+            START_DATE, END_DATE
+        )
+        data_file_catalog.close()
+    else:
+        #  Step 0. Get data from JASMIN
+        get_ssp_data.get_sspxxx_data_list(PATH_NAME, DATA_PATH_FILE)
+        #  Step 1. Subset data list
+        _ = make_data_list_date_subset(start_date=START_DATE, end_date=END_DATE)
+        grouped_subset_data_paths = get_ssp_data.generate_grouped_sspxxx_data_paths(
+            SUBSET_DATA_PATH_FILE, START_DATE, END_DATE
+        )
+    return grouped_subset_data_paths
+
+
+def prepare_shards(shard_count):
+    """
+    Run once before a job array: gets and subsets the data list, then saves a
+    size-balanced data list for each shard (see utils.sharding)
+    """
+    grouped_subset_data_paths = prepare_grouped_data_paths()
+    #  traces of shards from an earlier job array are not part of the next one
+    shutil.rmtree(TRACE_DIR, ignore_errors=True)
+    return sharding.save_shard_data_lists(
+        grouped_subset_data_paths, SUBSET_DATA_PATH_FILE, shard_count
+    )
+
+
+def merge_shards(shard_count):
+    """
+    Run once after a job array has finished: moves the outputs of every shard into
+    OUTPUT_PATH and writes the progress of all shards to the normal progress log
+    """
+    #  manifests are merged first so they are not moved over the manifest of OUTPUT_PATH
+    if USE_RUN_MANIFEST:
+        merge_shard_run_manifests(shard_count)
+    n_files_merged = sharding.merge_shard_outputs(OUTPUT_PATH)
+    log.info("%s shard output files merged into %s" % (n_files_merged, OUTPUT_PATH))
+    output_stores.get_output_store(OUTPUT_STORE, OUTPUT_PATH).compact()
+    if RECORD_TRACE:
+        summarise_trace()
+    if TRACK_PEAK_MEMORY:
+        report_memory_usage()
+    try:
+        sharding.merge_shard_progress_logs(SUBSET_DATA_PATH_FILE, shard_count).close()
+    except Exception as e:
+        log.error("Unable to merge shard progress logs")
+        log.error(e)
+    return n_files_merged
+
+
+def merge_shard_run_manifests(shard_count):
+    manifest = run_manifest.SQLiteRunManifest(os.path.join(OUTPUT_PATH, RUN_MANIFEST_FILE_NAME))
+    for shard_index in range(shard_count):
+        shard_manifest_path = os.path.join(
+            sharding.get_shard_output_path(OUTPUT_PATH, shard_index, shard_count),
+            RUN_MANIFEST_FILE_NAME,
+        )
+        if os.path.exists(shard_manifest_path):
+            n_outputs_merged = manifest.merge(shard_manifest_path)
+            os.remove(shard_manifest_path)
+            log.info("%s outputs merged from %s" % (n_outputs_merged, shard_manifest_path))
+    manifest.close()
+
+
+def run_data_path_group(
+    data_path_group,
+    ind,
+    n_groups,
+    output_path=OUTPUT_PATH,
+    output_states=None,
+    data_list_file=None,
+):
+    """
+    Open, subset, compute all metrics and save outputs for one group of data paths
+    (one model member). Runs in a worker process when main() has n_workers > 1.
+
+    Parameters
+    ----------
+    output_states : dict
+        Run manifest state of each metric's output (see run_manifest.SQLiteRunManifest.get_output_states)
+    data_list_file : str
+        Data list with the progress journal to record the group loading, running metrics
+        and saving outputs to (None to not record progress)
+
+    Returns
+    ----------
+    status : str
+        Summary of what was done for the progress log
+    metric_errors : dict
+        For each metric that was run, None if its output was saved or the error it raised
+        (for the run manifest)
+    """
+    data_path_group_name = get_data_path_group_name(data_path_group)
+    log.info(
+        "Starting %s. %s out of %s. Total datsets in group: %s "
+        % (
+            data_path_group_name,
+            ind + 1,
+            n_groups,
+            len(data_path_group),
+        )
+    )
+    data_path_group_facets = get_data.get_drs_facets_from_path(data_path_group[0])
+    if TRACK_PEAK_MEMORY and TRACE_PYTHON_ALLOCATIONS:
+        memory_usage.start_tracing_allocations()
+    peak_memory_context = (
+        instrumentation.collect_peak_memory()
+        if TRACK_PEAK_MEMORY
+        else contextlib.nullcontext()
+    )
+    with peak_memory_context as peak_memory_record:
+        with instrumentation.stage_context(
+            group=data_path_group_name, model=data_path_group_facets["model"]
+        ):
+            with instrumentation.time_stage(
+                instrumentation.GROUP_STAGE, n_files=len(data_path_group)
+            ) as stage:
+                status, metric_errors = compute_data_path_group(
+                    data_path_group,
+                    data_path_group_name,
+                    ind,
+                    output_path,
+                    output_states,
+                    data_list_file,
+                )
+                stage["status"] = status
+    if peak_memory_record is not None:
+        save_memory_record(
+            peak_memory_record, data_path_group, data_path_group_name, status, output_path
+        )
+    return status, metric_errors
+
+
+def run_data_path_groups_in_pipeline(
+    grouped_data_paths,
+    groups_to_run,
+    output_path=OUTPUT_PATH,
+    group_output_states=None,
+    data_list_file=None,
+    on_group_done=None,
+):
+    """
+    Runs groups one after another like run_data_path_group, but with the next group opened and
+    loaded in a background thread while the metrics of the current group run, and outputs and
+    metadata saved by a write-behind thread (see utils.pipeline). The data of groups read ahead
+    or running and outputs waiting to be saved are capped by PIPELINE_MEMORY_BUDGET.
+
+    Parameters
+    ----------
+    grouped_data_paths : list
+        Data paths of every group
+    groups_to_run : list
+        Index of each group to run (in order)
+    group_output_states : list
+        Run manifest state of each metric's output for each group (see get_group_output_states)
+    on_group_done : function
+        on_group_done(ind, (status, metric_errors), error) called in this thread as each group finishes
+
+    Returns
+    ----------
+    n_failed : int
+        Groups which raised an error
+    """
+    n_groups = len(grouped_data_paths)
+    if group_output_states is None:
+        group_output_states = [{}] * n_groups
+    if TRACK_PEAK_MEMORY and TRACE_PYTHON_ALLOCATIONS:
+        memory_usage.start_tracing_allocations()
+
+    def read_group(ind, memory_budget, stop_event):
+        data_path_group = grouped_data_paths[ind]
+        data_path_group_name = get_data_path_group_name(data_path_group)
+        log.info(
+            "Reading %s. %s out of %s. Total datsets in group: %s "
+            % (data_path_group_name, ind + 1, n_groups, len(data_path_group))
+        )
+        peak_memory_record = {"stages": {}, "metrics": {}} if TRACK_PEAK_MEMORY else None
+        nbytes_held = 0
+        with group_stage_context(data_path_group, peak_memory_record):
+            with instrumentation.time_stage("read group", n_files=len(data_path_group)):
+                output_end_times, data, status = read_data_path_group(
+                    data_path_group,
+                    data_path_group_name,
+                    output_path,
+                    group_output_states[ind],
+                    data_list_file,
+                )
+                if data is not None:
+                    nbytes_held = load_data_within_budget(data, memory_budget, stop_event)
+        return (peak_memory_record, output_end_times, data, status), nbytes_held
+
+    def compute_group(ind, read_value):
+        peak_memory_record, output_end_times, data, status = read_value
+        data_path_group = grouped_data_paths[ind]
+        outputs, metric_errors = [], {}
+        with group_stage_context(data_path_group, peak_memory_record):
+            with instrumentation.time_stage(
+                instrumentation.GROUP_STAGE, n_files=len(data_path_group)
+            ) as stage:
+                if status is None:
+                    outputs, metric_errors = run_metrics_on_data_path_group(
+                        data,
+                        data_path_group,
+                        get_data_path_group_name(data_path_group),
+                        ind,
+                        output_end_times,
+                        data_list_file,
+                    )
+                stage["status"] = status or "done! %s metrics run" % (len(outputs))
+        computed_value = (peak_memory_record, len(output_end_times), status, outputs, metric_errors)
+        return computed_value, sum(output.nbytes for _, _, output in outputs)
+
+    def write_group(ind, computed_value):
+        peak_memory_record, n_metrics_to_run, status, outputs, metric_errors = computed_value
+        data_path_group = grouped_data_paths[ind]
+        data_path_group_name = get_data_path_group_name(data_path_group)
+        if status is None:
+            with group_stage_context(data_path_group, peak_memory_record):
+                with instrumentation.time_stage("write group", n_outputs=len(outputs)):
+                    status, metric_errors = save_data_path_group_outputs(
+                        outputs,
+                        metric_errors,
+                        data_path_group,
+                        data_path_group_name,
+                        ind,
+                        n_metrics_to_run,
+                        output_path,
+                        data_list_file,
+                    )
+        if peak_memory_record is not None:
+            save_memory_record(
+                peak_memory_record, data_path_group, data_path_group_name, status, output_path
+            )
+        return status, metric_errors
+
+    return pipeline.run_pipeline(
+        groups_to_run,
+        read_group,
+        compute_group,
+        write_group,
+        on_item_done=on_group_done,
+        memory_budget=pipeline.MemoryBudget(PIPELINE_MEMORY_BUDGET),
+        prefetch_depth=PREFETCH_GROUPS,
+        write_behind_depth=WRITE_BEHIND_GROUPS,
+    )
+
+
+@contextlib.contextmanager
+def group_stage_context(data_path_group, peak_memory_record=None):
+    """
+    Records the stages inside this context as stages of a group, with their peak memory
+    added to peak_memory_record (when given)
+    """
+    peak_memory_context = (
+        instrumentation.collect_peak_memory(peak_memory_record)
+        if peak_memory_record is not None
+        else contextlib.nullcontext()
+    )
+    with peak_memory_context:
+        with instrumentation.stage_context(
+            group=get_data_path_group_name(data_path_group),
+            model=get_data.get_drs_facets_from_path(data_path_group[0])["model"],
+        ):
+            yield
+
+
+def load_data_within_budget(data, memory_budget, stop_event=None):
+    """
+    Loads the opened data of a group once it fits in the pipeline's memory budget, so it is
+    read while the group before it runs. With LAZY_LOAD, data larger than the whole budget is
+    not loaded (each metric reads its subset as it runs instead)
+
+    Returns
+    ----------
+    nbytes_held : int
+        Bytes of the budget held for the data (0 when it was not loaded)
+    """
+    nbytes = data.nbytes
+    if LAZY_LOAD and not memory_budget.fits(nbytes):
+        log.info(
+            "Not reading ahead %.1f MB of data larger than %s" % (nbytes / 1024**2, memory_budget)
+        )
+        return 0
+    if not memory_budget.acquire(nbytes, stop_event=stop_event):
+        return 0
+    try:
+        with instrumentation.time_stage("load", nbytes=nbytes):
+            data.load()
+    except BaseException:
+        memory_budget.release(nbytes)
+        raise
+    return nbytes
+
+
+def save_memory_record(
+    peak_memory_record, data_path_group, data_path_group_name, status, output_path
+):
+    """
+    Saves the peak memory of each stage and metric of a group with the size of its data
+    (see utils.memory_usage). The peak of the group is the peak of its 'group' stage.
+    """
+    data_path_group_facets = get_data.get_drs_facets_from_path(data_path_group[0])
+    peak_memory_record.update(
+        {
+            "group": data_path_group_name,
+            "model": data_path_group_facets["model"],
+            "member": data_path_group_facets["member"],
+            "status": status,
+            "n_files": len(data_path_group),
+            "input_bytes": sum(os.path.getsize(data_path) for data_path in data_path_group),
+        }
+    )
+    peak_memory_record["peak_rss"], peak_memory_record["peak_traced"] = peak_memory_record[
+        "stages"
+    ][instrumentation.GROUP_STAGE]
+    try:
+        memory_usage.save_memory_record(peak_memory_record, output_path, data_path_group_name)
+    except Exception as e:
+        log.error("unable to save memory record of %s" % (data_path_group_name))
+        log.error(e)
+
+
+def report_memory_usage(n_workers=N_WORKERS):
+    """
+    Relates the peak memory of every group in OUTPUT_PATH/memory_usage/ to its size and
+    recommends a SLURM --mem value for n_workers (and memory classes of groups). The report
+    is saved to OUTPUT_PATH/memory_report.json and logged.
+
+    Returns
+    ----------
+    report_text : str
+    """
+    memory_report = memory_usage.make_memory_report(
+        memory_usage.load_memory_records(OUTPUT_PATH), n_workers
+    )
+    with open(os.path.join(OUTPUT_PATH, memory_usage.MEMORY_REPORT_FILE_NAME), "w") as report_file:
+        json.dump(memory_report, report_file, indent=1)
+    report_text = memory_usage.make_memory_report_text(memory_report)
+    log.info("Memory report:\n%s" % (report_text))
+    return report_text
+
+
+def compute_data_path_group(
+    data_path_group,
+    data_path_group_name,
+    ind,
+    output_path=OUTPUT_PATH,
+    output_states=None,
+    data_list_file=None,
+):
+    """
+    Steps 3.1-3.3 of run_data_path_group (with the same parameters and return values)
+    """
+    output_end_times, data, status = read_data_path_group(
+        data_path_group, data_path_group_name, output_path, output_states, data_list_file
+    )
+    if status is not None:
+        return status, {}
+    outputs, metric_errors = run_metrics_on_data_path_group(
+        data, data_path_group, data_path_group_name, ind, output_end_times, data_list_file
+    )
+    del data
+    return save_data_path_group_outputs(
+        outputs,
+        metric_errors,
+        data_path_group,
+        data_path_group_name,
+        ind,
+        len(output_end_times),
+        output_path,
+        data_list_file,
+    )
+
+
+def read_data_path_group(
+    data_path_group,
+    data_path_group_name,
+    output_path=OUTPUT_PATH,
+    output_states=None,
+    data_list_file=None,
+):
+    """
+    Steps 3.1-3.2 of run_data_path_group: find which metrics need running, then open (but do
+    not load) the data they need
+
+    Returns
+    ----------
+    output_end_times : dict
+        For each metric to run, the time to extend its saved outputs from (see get_metrics_to_run)
+    data : xarray.Dataset
+        Opened data (None when there is nothing to run or the data could not be opened)
+    status : str
+        Summary for the progress log when the group is finished already (otherwise None)
+    """
+    output_store = output_stores.get_output_store(OUTPUT_STORE, output_path)
+    #  outputs already merged from shards count as calculated too
+    merged_output_store = output_stores.get_output_store(OUTPUT_STORE, OUTPUT_PATH)
+    # Step 3.1. Find which metrics need running (and from which time) before opening any data
+    with instrumentation.time_stage("find metrics to run"):
+        output_end_times = get_metrics_to_run(
+            data_path_group,
+            data_path_group_name,
+            [output_store, merged_output_store],
+            output_states,
+        )
+    if not output_end_times:
+        return output_end_times, None, "done! 0 metrics saved"
+    data_paths_to_open = data_path_group
+    if None not in output_end_times.values():
+        #  only extending outputs in time, so only open files with new times (and the halo)
+        data_paths_to_open = get_data_paths_after_time(
+            data_path_group, min(output_end_times.values()), get_max_halo(output_end_times)
+        )
+        log.info(
+            "Extending outputs of %s from %s using %s files"
+            % (data_path_group_name, min(output_end_times.values()), len(data_paths_to_open))
+        )
+    # Step 3.2. read but not load data (from node-local copies if USE_STAGING_CACHE)
+    data_paths_to_open = stage_data_paths(data_paths_to_open)
+    try:
+        with instrumentation.time_stage("open data", n_files=len(data_paths_to_open)):
+            data = open_data_path_group(data_paths_to_open)
+        log.info("Data head: %s" % (data.head()))
+    except Exception as e:
+        log.error('failed to load mfdataset, trying again with h5netcdf engine')
+        try:
+            with instrumentation.time_stage(
+                "open data", n_files=len(data_paths_to_open), engine="h5netcdf"
+            ):
+                data = open_data_path_group(data_paths_to_open, engine='h5netcdf')
+            log.info("Data head (h5netcdf): %s" % (data.head()))
+        except Exception as e:
+            log.error(e)
+            return output_end_times, None, "failed to open data"
+    instrumentation.add_to_peak_memory_record(
+        n_files_opened=len(data_paths_to_open), **memory_usage.get_data_sizes(data)
+    )
+    record_group_state(
+        data_list_file, data_path_group, progress_loggers.LOADED, "loaded data"
+    )
+    return output_end_times, data, None
+
+
+def run_metrics_on_data_path_group(
+    data, data_path_group, data_path_group_name, ind, output_end_times, data_list_file=None
+):
+    """
+    Steps 3.3.1-3.3.2 of run_data_path_group: subset and run each metric in output_end_times
+    on the opened data of a group
+
+    Returns
+    ----------
+    outputs : list
+        (metric name, variable name, output) of each metric run, in the order of METRIC_DICT
+    metric_errors : dict
+        For each metric that could not be run, the error it raised (for the run manifest)
+    """
+    jsmetric_computer = None
+    outputs = []
+    metric_errors = {}
+    # Step 3.3  Subset & run each metric
+    jsmetric_iterator = yield_metric_info_from_metric_dict(METRIC_DICT)
+    for metric_info in jsmetric_iterator:
+        metric_name = metric_info["name"]
+        variable_name = metric_info["variable_name"]
+        if metric_name not in output_end_times:
+            continue
+        output_end_time = output_end_times[metric_name]
+        if jsmetric_computer is None:
+            if not LAZY_LOAD:
+                with instrumentation.time_stage("load"):
+                    data.load()
                 log.info("%s sucessfully loaded" % (ind))
-            ## Temporary fix before cf-array to rename poorly named dims
-            if 'longitude' in data.coords:
-                data = data.rename({'longitude':'lon'})
-            if 'latitude' in data.coords:
-                data = data.rename({'latitude':'lat'})
-            #  Step 3.2.0 intialise the jsmetric computer
+            #  Step 3.2.0 intialise the jsmetric computer (once per group so every metric shares its
+            #  canonical data, i.e. lat/lon names, ascending coords and plev in Pa, and metrics with the same coords share a subset)
             try:
-                jsmetric_computer = compute_jsmetrics.MetricComputer(data)
+                jsmetric_computer = compute_jsmetrics.MetricComputerWithAllMetrics(
+                    data,
+                    all_metrics={
+                        metric_info_to_run["name"]: metric_info_to_run
+                        for metric_info_to_run in METRIC_DICT.values()
+                        if metric_info_to_run["name"] in output_end_times
+                    },
+                    load_subsets=LAZY_LOAD,
+                    time_block_years=TIME_BLOCK_YEARS,
+                )
             except Exception as e:
-                log.error("unable to make metric computer for %s" % (metric_name))
+                log.error("unable to make metric computer for %s" % (data_path_group_name))
                 log.error(e)
-                continue
+                break
+            #  Step 3.2.1 work out which metrics can run on this data and their subsets in one pass
+            execution_plan = jsmetric_computer.plan_metrics(jsmetric_computer.all_metrics)
+            log.info("Execution plan: %s" % (execution_plan))
+            #  Step 3.2.2 run every metric computed on all times at once (METRIC_WORKERS at a time)
+            metric_results = jsmetric_computer.compute_all_metrics(
+                metric_names=[
+                    metric_name_to_run
+                    for metric_name_to_run, metric_output_end_time in output_end_times.items()
+                    if metric_output_end_time is None and metric_name_to_run in execution_plan
+                ],
+                max_workers=METRIC_WORKERS,
+            )
+        if metric_name not in execution_plan:
+            log.error(
+                "unable to run %s: %s"
+                % (metric_name, execution_plan.unavailable_metrics[metric_name])
+            )
+            record_metric_error(
+                metric_errors,
+                metric_name,
+                ValueError(execution_plan.unavailable_metrics[metric_name]),
+            )
+            continue
 
-            #  Step 3.2.1  Subset data
+        if output_end_time is not None:
+            #  Step 3.3.1/2  Subset and run metric on times after the saved outputs only
             try:
-                subset_data = jsmetric_computer.subset_data_for_metric(metric_info)
-                log.info("subset for %s" % (metric_name))
-                log.info("Subset data coords: %s" % (subset_data.coords))
-
+                time_start_index = compute_jsmetrics.get_time_index_after(
+                    jsmetric_computer.data, output_end_time, output_stores.TIME_FORMAT
+                )
+                if time_start_index == jsmetric_computer.data["time"].size:
+                    log.info("no times after %s to add to %s" % (output_end_time, metric_name))
+                    metric_errors[metric_name] = None
+                    continue
+                output = jsmetric_computer.compute_metric_from_time_index(
+                    metric_info, time_start_index
+                )
+                log.info("%s run from %s" % (metric_name, output_end_time))
+                record_group_state(
+                    data_list_file,
+                    data_path_group,
+                    progress_loggers.METRIC_RUN,
+                    "metric run: %s from %s" % (metric_name, output_end_time),
+                )
             except Exception as e:
-                log.error("unable to subset data for %s" % (metric_name))
+                log.error("unable to extend %s" % (metric_name))
                 log.error(e)
+                record_metric_error(metric_errors, metric_name, e)
                 continue
-
-            #  Step 3.2.2  Run metric on data
-            try:
-                output = jsmetric_computer.compute_metric_from_data(
-                    metric_info, data=subset_data, to_subset=False
-                )
-
-                log.info("%s run" % (metric_name))
-                log.info("Output data variables: %s" % (output.data_vars))
-                # add metric X out of X run to progress_log file
-            except Exception as e:
+        else:
+            #  Step 3.3.1/2  Subset and run metric (run with every other metric in step 3.2.2)
+            metric_result = metric_results[metric_name]
+            if not metric_result.succeeded:
                 log.error("unable to run %s" % (metric_name))
-                log.error(e)
+                log.error(metric_result.error)
+                record_metric_error(metric_errors, metric_name, metric_result.error)
                 continue
+            output = metric_result.output
+            log.info("%s run" % (metric_name))
+            log.info("Output data variables: %s" % (output.data_vars))
+            record_group_state(
+                data_list_file,
+                data_path_group,
+                progress_loggers.METRIC_RUN,
+                "metric run: %s" % (metric_name),
+            )
+        outputs.append((metric_name, variable_name, output))
+    if jsmetric_computer is not None:
+        jsmetric_computer.clear_subset_cache()
+    return outputs, metric_errors
 
-            #  Step 3.2.3  Save outputs
-            try:
-                print("saving to:", output_file_path)
-                if metric_name == "Kerr et al. 2020 North Pacific":
-                    print('taking mean for kerr')
-                    output = output.mean('lon')
-                save_output_to_file(output, variable_name, output_file_path)
+
+def save_data_path_group_outputs(
+    outputs,
+    metric_errors,
+    data_path_group,
+    data_path_group_name,
+    ind,
+    n_metrics_to_run,
+    output_path=OUTPUT_PATH,
+    data_list_file=None,
+):
+    """
+    Step 3.3.3 of run_data_path_group: save the outputs of each metric run on a group (from
+    run_metrics_on_data_path_group) and the group's metadata
+
+    Returns
+    ----------
+    status : str
+        Summary of what was done for the progress log
+    metric_errors : dict
+        metric_errors with None added for each output saved
+    """
+    output_store = output_stores.get_output_store(OUTPUT_STORE, output_path)
+    data_path_group_facets = get_data.get_drs_facets_from_path(data_path_group[0])
+    n_metrics_saved = 0
+    for metric_name, variable_name, output in outputs:
+        #  Step 3.3.3  Save outputs
+        try:
+            print("saving to:", output_path)
+            if metric_name == "Kerr et al. 2020 North Pacific":
+                print('taking mean for kerr')
+                output = output.mean('lon')
+            with instrumentation.time_stage(
+                "save", metric=metric_name, output_nbytes=output[variable_name].nbytes
+            ):
+                save_output_to_file(
+                    output,
+                    variable_name,
+                    output_store,
+                    data_path_group_name,
+                    metric_name,
+                    data_path_group_facets,
+                )
 
                 write_metadata_for_data_path_groups(
-                    data_path_group, data_path_group_name
+                    data_path_group, data_path_group_name, output_path
                 )
-                log.info("%s output saved to %s" % (metric_name, OUTPUT_PATH))
-                # add metric X out of X run to progress_log file
-            except Exception as e:
-                log.error("unable to save output from %s" % (metric_name))
-                log.error(e)
-                continue
-            print("%s done!" % (metric_name))  # TODO: remove
-            # break  # TODO: remove
-        print("%s done!" % (ind))  # TODO: remove
+            log.info("%s output saved to %s" % (metric_name, output_path))
+            n_metrics_saved += 1
+            metric_errors[metric_name] = None
+            record_group_state(
+                data_list_file,
+                data_path_group,
+                progress_loggers.SAVED,
+                "saved: %s metrics out of %s" % (n_metrics_saved, n_metrics_to_run),
+            )
+        except Exception as e:
+            log.error("unable to save output from %s" % (metric_name))
+            log.error(e)
+            continue
+        print("%s done!" % (metric_name))  # TODO: remove
         # break  # TODO: remove
+    with instrumentation.time_stage("flush"):
+        output_store.flush()
+    print("%s done!" % (ind))  # TODO: remove
+    return "done! %s metrics saved" % (n_metrics_saved), metric_errors
+
+
+def record_metric_error(metric_errors, metric_name, error):
+    """
+    Keeps the error a metric raised for the run manifest, unless it may not happen
+    again (i.e. running out of memory)
+    """
+    if not isinstance(error, MemoryError):
+        metric_errors[metric_name] = repr(error)
+
+
+def get_metrics_to_run(
+    data_path_group, data_path_group_name, output_stores_to_check, output_states=None
+):
+    """
+    Which metrics in METRIC_DICT need running for a group, from the run manifest state of
+    each output (see run_manifest.SQLiteRunManifest.get_output_states) and the outputs already saved
+
+    Returns
+    ----------
+    output_end_times : dict
+        For each metric to run, the time to extend its saved outputs from
+        (None to compute all times)
+    """
+    if not output_states:
+        output_states = {}
+    group_end_date = get_group_end_date(data_path_group)
+    output_end_times = {}
+    for metric_info in yield_metric_info_from_metric_dict(METRIC_DICT):
+        metric_name = metric_info["name"]
+        output_state = output_states.get(metric_name)
+        if output_state == run_manifest.UP_TO_DATE or (
+            output_state == run_manifest.FAILED and not RERUN_FAILED_METRICS
+        ):
+            log.info("output is %s in the run manifest. Output: %s %s" % (output_state, data_path_group_name, metric_name))
+            continue
+        if output_state == run_manifest.STALE or not any(
+            output_store.exists(data_path_group_name, metric_name)
+            for output_store in output_stores_to_check
+        ):
+            output_end_times[metric_name] = None
+            continue
+        end_time = None
+        if EXTEND_OUTPUTS_IN_TIME and compute_jsmetrics.TIME_BLOCKING_KEY in metric_info:
+            end_times = [
+                output_store.get_end_time(data_path_group_name, metric_name)
+                for output_store in output_stores_to_check
+            ]
+            end_times = [end_time for end_time in end_times if end_time is not None]
+            if end_times:
+                end_time = max(end_times)
+        if end_time is not None and (
+            output_state == run_manifest.NEW_INPUT_FILES or end_time[:10] < group_end_date
+        ):
+            output_end_times[metric_name] = end_time
+        elif output_state in [run_manifest.NEW_INPUT_FILES, run_manifest.FAILED]:
+            #  outputs cannot be extended in time so are computed again
+            output_end_times[metric_name] = None
+        else:
+            log.info("output already exists so assuming it has been calculated. Output: %s %s" % (data_path_group_name, metric_name))
+    return output_end_times
+
+
+def get_group_end_date(data_path_group):
+    """
+    Last date (YYYY-MM-DD) a group has data for up to END_DATE (from the file names)
+    """
+    end_date = get_data.convert_to_datetime64(END_DATE, get_data.JASMIN_DATE_FORMAT)
+    file_end_dates = get_data.DataPathDateIndex(data_path_group).end_dates
+    file_end_dates = file_end_dates[~np.isnat(file_end_dates)]
+    if file_end_dates.size:
+        end_date = min(end_date, file_end_dates.max())
+    return str(end_date.astype("datetime64[D]"))
+
+
+def get_max_halo(output_end_times):
+    """
+    Largest halo (in time steps) of the metrics in output_end_times
+    """
+    return max(
+        int(metric_info[compute_jsmetrics.TIME_BLOCKING_KEY].get("halo", 0))
+        for metric_info in yield_metric_info_from_metric_dict(METRIC_DICT)
+        if metric_info["name"] in output_end_times
+    )
+
+
+def get_data_paths_after_time(data_path_group, end_time, halo):
+    """
+    Data paths with times after end_time or within two halos of daily time steps before it
+    (see compute_jsmetrics.MetricComputer.compute_metric_from_time_index)
+
+    Parameters
+    ----------
+    end_time : str
+        Time formatted like output_stores.TIME_FORMAT e.g. '1999-12-31 12:00:00'
+    halo : int
+        Number of daily time steps either side of each output needed by the metrics
+    """
+    year, month, day = [int(date_part) for date_part in end_time[:10].split("-")]
+    #  day capped at 28 as 360_day calendars have e.g. 30th February
+    from_date = datetime.date(year, month, min(day, 28)) - datetime.timedelta(
+        days=2 * halo + 1
+    )
+    date_index = get_data.DataPathDateIndex(data_path_group)
+    in_date_range = date_index.overlaps(from_date.strftime(get_data.JASMIN_DATE_FORMAT), END_DATE)
+    return [
+        data_path for data_path, in_range in zip(data_path_group, in_date_range) if in_range
+    ]
+
+
+def stage_data_paths(data_paths):
+    """
+    Copies data paths to STAGING_DIR (if USE_STAGING_CACHE) so they are opened from local disk
+
+    Returns
+    ----------
+    data_paths_to_open : list
+        Staged path of each data path (or the data path itself when it could not be staged)
+    """
+    if not USE_STAGING_CACHE:
+        return data_paths
+    with instrumentation.time_stage("stage files", n_files=len(data_paths)) as event_attributes:
+        try:
+            cache = staging_cache.StagingCache(
+                STAGING_DIR, quota_mb=STAGING_QUOTA, copy_workers=STAGING_COPY_WORKERS
+            )
+        except Exception as e:
+            log.error(
+                "unable to use staging cache in %s, opening files from their source"
+                % (STAGING_DIR)
+            )
+            log.error(e)
+            return data_paths
+        try:
+            staged_paths = cache.stage(data_paths)
+        except Exception as e:
+            log.error("unable to stage files, opening them from their source")
+            log.error(e)
+            return data_paths
+        finally:
+            cache.close()
+        event_attributes.update(
+            n_files_copied=cache.n_files_copied, bytes_copied=cache.nbytes_copied
+        )
+    log.info(
+        "Staged %s files in %s (%s copied, %.1fMB)"
+        % (len(data_paths), STAGING_DIR, cache.n_files_copied, cache.nbytes_copied / 1024**2)
+    )
+    return staged_paths
+
+
+def open_data_path_group(data_path_group, engine=None):
+    """
+    Open (but do not load) a group of data paths as one dataset subset to the
+    time range and (if PUSH_DOWN_METRIC_SUBSET) to the coords needed by METRIC_DICT
+    """
+    open_kwargs = {"chunks": {"time": TIME_CHUNK_SIZE}} if LAZY_LOAD else {}
+    if engine:
+        open_kwargs["engine"] = engine
+    time_range = (START_DATE[:4], END_DATE[:4])
+    if PUSH_DOWN_METRIC_SUBSET:
+        subset_plan = subset_planner.DataSubsetPlan.from_metric_dict(
+            METRIC_DICT, time_range=time_range
+        )
+        log.info("Subsetting each file with %s" % (subset_plan))
+        data = xarray.open_mfdataset(
+            data_path_group, preprocess=subset_plan.preprocess, **open_kwargs
+        )
+    else:
+        data = xarray.open_mfdataset(data_path_group, **open_kwargs)
+        data = data.sel(plev=TEMPORARY_PLEV_SUBSET, time=slice(*time_range))
+    return data
 
 
 def make_data_list_date_subset(start_date, end_date):
@@ -198,14 +1249,30 @@ def make_data_list_date_subset(start_date, end_date):
     return data_retriever.data_paths
 
 
+def make_data_list_date_subset_from_catalog(data_file_catalog, start_date, end_date):
+    log.info("Number of datasets found: %s" % (len(data_file_catalog)))
+    print("Number of datasets found:", len(data_file_catalog))
+    data_paths = data_file_catalog.get_data_paths(start_date, end_date)
+    log.info(
+        "Number of datasets after date range subset (%s to %s): %s"
+        % (START_DATE, END_DATE, len(data_paths))
+    )
+    print("Number of datasets after date range subset:", len(data_paths))
+    data_file_catalog.save_data_paths(
+        SUBSET_DATA_PATH_FILE, date_range_start=start_date, date_range_end=end_date
+    )
+    return data_paths
+
+
 def yield_metric_info_from_metric_dict(metric_dict):
     for metric_info in metric_dict.values():
         yield metric_info
 
-def write_metadata_for_data_path_groups(data_path_group, data_path_group_name):
-    metadata_output_path = os.path.join(OUTPUT_PATH, "metadata")
-    if not os.path.exists(metadata_output_path):
-        os.mkdir(metadata_output_path)
+def write_metadata_for_data_path_groups(
+    data_path_group, data_path_group_name, output_path=OUTPUT_PATH
+):
+    metadata_output_path = os.path.join(output_path, "metadata")
+    os.makedirs(metadata_output_path, exist_ok=True)  # may be made by several workers at once
     output_file_path = os.path.join(metadata_output_path, data_path_group_name + ".txt")
     with open(output_file_path, "w") as output_file:
         output_file.writelines("Metadata for:" + data_path_group_name + os.linesep)
@@ -217,6 +1284,8 @@ def write_metadata_for_data_path_groups(data_path_group, data_path_group_name):
         output_file.close()
 
 
-def save_output_to_file(output, max_lats_col, output_file_path):
+def save_output_to_file(
+    output, max_lats_col, output_store, data_path_group_name, metric_name, facets=None
+):
     output_to_save = output[max_lats_col]
-    output_to_save.to_dataframe().to_csv(output_file_path)
+    output_store.write(output_to_save, data_path_group_name, metric_name, facets)
@@ -6,6 +6,8 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [20, 70], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.woollings_et_al_2010,
+        "derived_field": "zonal_mean",
+        "time_blocking": {"halo": 31},  # 61 day Lanczos window
         "name": "Woollings et al. 2010 North Pacific",
         "variable_name": "jet_lat",
         "description": "",
@@ -15,6 +17,7 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [20, 70], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.barnes_polvani_2013,
+        "time_blocking": {"halo": 21},  # 41 day Lanczos window
         "name": "Barnes & Polvani 2013 North Pacific",
         "variable_name": "jet_lat",
         "description": "",
@@ -24,6 +27,8 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [0, 90], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.barnes_polvani_2015,
+        "derived_field": "zonal_mean",
+        "time_blocking": {"halo": 0},
         "name": "Barnes & Polvani 2015 North Pacific",
         "variable_name": "jet_lat",
         "description": "",
@@ -33,6 +38,7 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [20, 70], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.barnes_simpson_2017,
+        "derived_field": "plev_mean",
         "name": "Barnes & Simpson 2017 North Pacific",
         "variable_name": "jet_lat",
         "description": "",
@@ -42,6 +48,8 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [20, 70], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.grise_polvani_2017,
+        "derived_field": "zonal_mean",
+        "time_blocking": {"halo": 0},
         "name": "Grise & Polvani 2017 North Pacific",
         "variable_name": "jet_lat",
         "description": "",
@@ -51,6 +59,7 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [20, 70], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.bracegirdle_et_al_2018,
+        "derived_field": "plev_mean",
         "name": "Bracegirdle et al. 2018 North Pacific",
         "variable_name": "annual_JPOS",
         "description": "",
@@ -60,6 +69,7 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [20, 70], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.ceppi_et_al_2018,
+        "time_blocking": {"halo": 0},
         "name": "Ceppi et al. 2018 North Pacific",
         "variable_name": "jet_lat",
         "description": "",
@@ -69,6 +79,7 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [20, 70], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.zappa_et_al_2018,
+        "time_blocking": {"halo": 0},
         "name": "Zappa et al. 2018 North Pacific",
         "variable_name": "jet_lat",
         "description": "",
@@ -78,6 +89,8 @@ METRIC_DICT = {
         "coords": {"plev": [70000, 85000],  "lat": [20, 70], "lon": [120, 240]},
         "plev_units": "Pa",
         "metric": jet_statistics.kerr_et_al_2020,
+        "derived_field": "plev_mean",
+        "time_blocking": {"halo": 0},
         "name": "Kerr et al. 2020 North Pacific",
         "variable_name": "jet_lat",
         "description": "",
@@ -1,15 +1,53 @@
 #  -*- coding: utf-8 -*-
+import argparse
 import os
 import logging
-from experiments.CMIP_Historical_npac.main import main
+from experiments.CMIP_Historical_npac.main import (
+    main,
+    merge_shards,
+    prepare_shards,
+    render_progress_log,
+    report_memory_usage,
+    summarise_trace,
+)
+from utils import sharding
 
 
-def run_experiment():
+def run_experiment(
+    shard_index=None,
+    shard_count=None,
+    prepare=False,
+    merge=False,
+    progress=False,
+    trace_summary=False,
+    memory_report=False,
+):
     fmtstr = " %(asctime)s: (%(filename)s): %(levelname)s: %(funcName)s Line: %(lineno)d - %(message)s"
     datestr = "%m/%d/%Y %I:%M:%S %p "
     if not os.path.exists("logs"):
-        os.mkdir("logs")
-    log_file = "logs/cmip_Historical_npac_run.log"
+        os.makedirs("logs", exist_ok=True)
+    shard_index, shard_count = sharding.get_shard_index_and_count(shard_index, shard_count)
+    if progress:
+        #  only writes the progress log from its journal, so does not touch the run's logs
+        print(render_progress_log(shard_index, shard_count))
+        return
+    if trace_summary:
+        print(summarise_trace())
+        return
+    if memory_report:
+        print(report_memory_usage())
+        return
+    if prepare:
+        log_file = "logs/cmip_Historical_npac_prepare.log"
+    elif merge:
+        log_file = "logs/cmip_Historical_npac_merge.log"
+    elif shard_count > 1:
+        #  one log per shard so tasks in a job array do not overwrite each other
+        log_file = "logs/cmip_Historical_npac_run_%s.log" % (
+            sharding.get_shard_name(shard_index, shard_count)
+        )
+    else:
+        log_file = "logs/cmip_Historical_npac_run.log"
     #  basic logging config
     logging.basicConfig(
         filename=log_file,
@@ -20,7 +58,12 @@ def run_experiment():
     )
     logging.info("Started CMIP Historical NPAC experiment")
     try:
-        main()
+        if prepare:
+            prepare_shards(shard_count)
+        elif merge:
+            merge_shards(shard_count)
+        else:
+            main(shard_index=shard_index, shard_count=shard_count)
     except Exception as e:
         print("experiment failed. Check %s" % (log_file))
         print(e)
@@ -29,5 +72,57 @@ def run_experiment():
     logging.info("Finished CMIP Historical NPAC experiment")
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run CMIP Historical NPAC experiment")
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=None,
+        help="shard to run (default: SLURM_ARRAY_TASK_ID, or run everything)",
+    )
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=None,
+        help="number of shards (default: SLURM_ARRAY_TASK_COUNT, or 1)",
+    )
+    run_mode = parser.add_mutually_exclusive_group()
+    run_mode.add_argument(
+        "--prepare",
+        action="store_true",
+        help="get and subset the data list, then save a data list per shard (run before the job array)",
+    )
+    run_mode.add_argument(
+        "--merge",
+        action="store_true",
+        help="merge shard outputs and progress logs into outputs/ (run after the job array)",
+    )
+    run_mode.add_argument(
+        "--progress",
+        action="store_true",
+        help="write the progress log of a run (or shard) from its progress journal and print its path",
+    )
+    run_mode.add_argument(
+        "--trace-summary",
+        action="store_true",
+        help="write the Chrome trace of the last run (and its shards) and print the slowest models, metrics and stages",
+    )
+    run_mode.add_argument(
+        "--memory-report",
+        action="store_true",
+        help="relate the peak memory of each group to its size and print the recommended sbatch --mem (for JSMETRICS_N_WORKERS workers)",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    run_experiment()
+    args = parse_args()
+    run_experiment(
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        prepare=args.prepare,
+        merge=args.merge,
+        progress=args.progress,
+        trace_summary=args.trace_summary,
+        memory_report=args.memory_report,
+    )
@@ -4,14 +4,26 @@
     Contains the MetricComputer class and functions that run inside that class for subsetting and compute metrics from standardised netcdf data
 """
 
+import collections
+import contextvars
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy
+import xarray
+
+from utils import derived_fields, instrumentation, metric_planner, subset_planner
 
 __author__ = "Thomas Keel"
 __email__ = "thomas.keel.18@ucl.ac.uk"
 __status__ = "Development"
 
 
-ROUNDING_THRESHOLD = 3 # number of decimal places to round for coord check. Previously had a problem with 70000.00001 
+ROUNDING_THRESHOLD = metric_planner.ROUNDING_THRESHOLD # number of decimal places to round coords to. Previously had a problem with 70000.00001
+SUBSET_CACHE_SIZE = 4 # number of metric subsets (with different coords) kept in memory by MetricComputer
+TIME_BLOCKING_KEY = "time_blocking" # metric dict entries with {"halo": n_time_steps} can be run in blocks of years
 
 EQUIVALENT_PLEV_UNITS = {
     "Pa": ["Pa", "Pascals", "mbar", "millibars"],
@@ -19,6 +31,13 @@ EQUIVALENT_PLEV_UNITS = {
     "mbar": ["Pa", "Pascals", "mbar", "millibars"],
     "millibars": ["Pa", "Pascals", "mbar", "millibars"],
 }
+PLEV_UNITS_IN_PA = {"Pa": 1, "Pascals": 1, "mbar": 100, "millibars": 100, "hPa": 100} # EQUIVALENT_PLEV_UNITS (and hPa) in Pa, to convert plev between them
+CANONICAL_PLEV_UNITS = "Pa" # plev is converted to these units (the "plev_units" of the metric dicts)
+LON_CONVENTION = "0-360" # lon is wrapped to "0-360" or "-180-180" (the metric dicts use 0-360)
+METRIC_WORKERS = 1 # metrics run at once by MetricComputerWithAllMetrics.compute_all_metrics (1 runs them one after another)
+
+
+log = logging.getLogger(__name__)
 
 
 class MetricComputer:
@@ -31,11 +50,45 @@ class MetricComputer:
     (see https://www.datacamp.com/community/tutorials/docstrings-python for docstring format)
     """
 
-    def __init__(self, data):
-        """ """
+    def __init__(
+        self,
+        data,
+        subset_cache_size=SUBSET_CACHE_SIZE,
+        load_subsets=False,
+        time_block_years=None,
+        lon_convention=LON_CONVENTION,
+        derived_field_cache_size=derived_fields.DERIVED_FIELD_CACHE_SIZE,
+    ):
+        """
+        Parameters
+        ----------
+        data : xarray.Dataset
+            Climate data to compute metrics from
+        subset_cache_size : int
+            Number of subsets (with different coords) to keep for reuse by metrics (0 to not cache)
+        load_subsets : Boolean
+            Load each subset into memory before it is used (for when data is dask-backed,
+            so only the subset for each metric is read rather than all of data)
+        time_block_years : int
+            Years of data per block for metrics that can be run in time blocks
+            (see compute_metric_in_time_blocks). None runs every metric on all times at once
+        lon_convention : str
+            "0-360" or "-180-180" to wrap lon to (see canonicalize_data)
+        derived_field_cache_size : float
+            MB of derived fields (i.e. zonal means shared by metrics, see derived_fields) to
+            keep for reuse by metrics (0 to let each metric reduce its own subset)
+        """
         self.data = data
+        self.subset_cache_size = subset_cache_size
+        self.load_subsets = load_subsets
+        self.time_block_years = time_block_years
+        self.lon_convention = lon_convention
+        self._subset_cache = collections.OrderedDict()
+        self._subset_cache_lock = threading.Lock()  # metrics may be subset from several threads
+        self.derived_field_cache = derived_fields.DerivedFieldCache(derived_field_cache_size)
         self.get_variable_list()
-        self.swap_all_coords()
+        self.canonicalize_coords()
+        self.coord_index = metric_planner.CoordIndex(self.data)
 
     def get_variable_list(self):
         """ """
@@ -44,11 +97,30 @@ class MetricComputer:
             if "_bnds" not in var:
                 self.variable_list.append(var)
 
-    def swap_all_coords(self):
-        """ """
-        for coord in self.data.coords:
-            if not self.data[coord].count() == 1:
-                self.data = swap_coord_order(self.data, coord)
+    def canonicalize_coords(self):
+        """
+        Names, orders and units of coords made the same for every model (once, so every
+        metric subsets the same canonical data)
+        """
+        with instrumentation.time_stage("canonicalize"):
+            self.data = canonicalize_data(self.data, lon_convention=self.lon_convention)
+
+    def plan_metrics(self, metric_dict, ignore_coords=None):
+        """
+        Which metrics of a metric dict can be run on this data and the subset of each
+        (see metric_planner.plan_metrics)
+
+        Returns
+        ----------
+        execution_plan : metric_planner.MetricExecutionPlan
+        """
+        return metric_planner.plan_metrics(self.coord_index, metric_dict, ignore_coords)
+
+    def get_subset_indexers(self, metric_info, ignore_coords=None):
+        """
+        isel indexers of the subset of a metric (worked out once for each set of coords)
+        """
+        return metric_planner.get_subset_indexers(self.coord_index, metric_info, ignore_coords)
 
     def subset_data_for_metric(self, metric_info, ignore_coords={}):
         """
@@ -64,7 +136,63 @@ class MetricComputer:
         subset: xarray.Dataset
             Subset of data using info from the jetstream metric dict
         """
-        return subset_data_using_metric_coords(self.data, metric_info, ignore_coords)
+        subset_key = make_subset_cache_key(metric_info, ignore_coords)
+        with instrumentation.time_stage("subset", metric=metric_info["name"]) as stage:
+            with self._subset_cache_lock:
+                subset = self._subset_cache.get(subset_key)
+                if subset is not None:
+                    self._subset_cache.move_to_end(subset_key)
+                    stage["cached"] = True
+            if subset is None:
+                subset = self.data.isel(self.get_subset_indexers(metric_info, ignore_coords))
+                if self.subset_cache_size:
+                    with self._subset_cache_lock:
+                        self._subset_cache[subset_key] = subset
+                        while len(self._subset_cache) > self.subset_cache_size:
+                            self._subset_cache.popitem(last=False)
+            #  metrics run in time blocks load one block at a time instead
+            if self.load_subsets and not self.uses_time_blocks(metric_info):
+                with instrumentation.time_stage("load", metric=metric_info["name"]):
+                    subset.load()  # in place so the cached subset is loaded too
+            stage["subset_nbytes"] = subset.nbytes
+        #  shallow copy so that variables added by a metric are not seen by the next metric
+        return subset.copy(deep=False)
+
+    def uses_time_blocks(self, metric_info):
+        """
+        Whether a metric will be run in blocks of time (see compute_metric_in_time_blocks)
+        """
+        return bool(self.time_block_years) and TIME_BLOCKING_KEY in metric_info
+
+    def clear_subset_cache(self):
+        """
+        Removes all subsets and derived fields kept for reuse by metrics (i.e. when all metrics have run)
+        """
+        with self._subset_cache_lock:
+            self._subset_cache.clear()
+        self.derived_field_cache.clear()
+
+    def get_derived_field(self, metric_info, data):
+        """
+        The reduction of a metric's subset named by its "derived_field" entry (i.e. the zonal
+        mean), made once and shared by every metric asking for it (see derived_fields).
+        Metrics without the entry are given their subset as it is
+        """
+        if (
+            derived_fields.DERIVED_FIELD_KEY not in metric_info
+            or not self.derived_field_cache.max_size_mb
+        ):
+            return data
+        operation = metric_info[derived_fields.DERIVED_FIELD_KEY]
+        with instrumentation.time_stage(
+            "derive", metric=metric_info["name"], operation=operation
+        ) as stage:
+            derived_field = self.derived_field_cache.get(
+                data, operation, metric_info["variables"]
+            )
+            stage["derived_nbytes"] = derived_field.nbytes
+        #  shallow copy so that variables added by a metric are not seen by the next metric
+        return derived_field.copy(deep=False)
 
     def compute_metric_from_data(
         self, metric_info, data=None, to_subset=True, ignore_coords={}
@@ -86,7 +214,95 @@ class MetricComputer:
         """
         if to_subset:
             data = self.subset_data_for_metric(metric_info, ignore_coords)
-        return compute_metric_using_metric_info(data, metric_info)
+        derived_data = self.get_derived_field(metric_info, data)
+        with instrumentation.time_stage("run metric", metric=metric_info["name"]):
+            if self.uses_time_blocks(metric_info):
+                result = compute_metric_in_time_blocks(
+                    derived_data,
+                    metric_info,
+                    self.time_block_years,
+                    load_blocks=self.load_subsets,
+                )
+            else:
+                result = compute_metric_using_metric_info(derived_data, metric_info)
+        return derived_fields.drop_reduced_coords(result, data, derived_data)
+
+    def compute_metric_from_time_index(self, metric_info, time_start_index):
+        """
+        Computes a metric for the time steps from time_start_index onwards only (i.e. to extend
+        outputs already saved up to that time step). The last halo time steps before
+        time_start_index (from metric_info["time_blocking"]["halo"]) are computed again too,
+        as they were computed without the times after them. Only these time steps and a halo
+        before them are subset and read, and the result is the same as those time steps of the
+        metric run on all times at once. The subset is not kept for reuse by other metrics.
+
+        Parameters
+        ----------
+        metric_info : dict
+            jetstream metric information about metric name, subsetting, required variables, function location
+        time_start_index : int
+            Index of first time step in self.data to compute outputs for
+
+        Returns
+        ----------
+        result : xarray.Dataset
+            Result from metric from time_start_index - halo onwards
+
+        Raises
+        ----------
+        ValueError
+            When the metric has no "time_blocking" entry (i.e. each output depends on all times)
+        """
+        if TIME_BLOCKING_KEY not in metric_info:
+            raise ValueError(
+                "cannot compute %s from a time step as it has no '%s' entry"
+                % (metric_info["name"], TIME_BLOCKING_KEY)
+            )
+        halo = int(metric_info[TIME_BLOCKING_KEY].get("halo", 0))
+        output_start_index = max(time_start_index - halo, 0)
+        with instrumentation.time_stage("subset", metric=metric_info["name"]):
+            data = self.data.isel(self.get_subset_indexers(metric_info))
+            if "time" in data.dims:
+                data = flatten_dims(
+                    data.isel(time=slice(max(output_start_index - halo, 0), None))
+                )
+        derived_data = self.get_derived_field(metric_info, data)
+        with instrumentation.time_stage(
+            "run metric", metric=metric_info["name"], n_times=data["time"].size
+        ):
+            if self.uses_time_blocks(metric_info):
+                result = compute_metric_in_time_blocks(
+                    derived_data, metric_info, self.time_block_years, load_blocks=self.load_subsets
+                )
+            else:
+                if self.load_subsets:
+                    with instrumentation.time_stage("load", metric=metric_info["name"]):
+                        derived_data = derived_data.load()
+                result = compute_metric_using_metric_info(derived_data, metric_info)
+        result = derived_fields.drop_reduced_coords(result, data, derived_data)
+        return result.sel(time=slice(self.data["time"].values[output_start_index], None))
+
+
+def get_time_index_after(data, time_value, time_format):
+    """
+    Index of the first time step in data after time_value (data["time"].size if there is none)
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        Data with a time coord (in time order)
+    time_value : str
+        Time formatted with time_format e.g. '1999-12-31 12:00:00'
+    time_format : str
+        Format for strftime which sorts like the times e.g. '%Y-%m-%d %H:%M:%S'
+        (so works for cftime calendars)
+
+    Returns
+    ----------
+    time_index : int
+    """
+    times = data["time"].dt.strftime(time_format).values
+    return int(numpy.searchsorted(times, time_value, side="right"))
 
 
 def subset_data_using_metric_coords(data, metric_info, ignore_coords=None):
@@ -122,58 +338,202 @@ def subset_data_using_metric_coords(data, metric_info, ignore_coords=None):
                     and float(subset[coord].data) == min_val
                 ):
                     continue
-                elif min_val > max_val:
-                    min_val += 0.01
+                max_val += metric_planner.SUBSET_TOLERANCE
+                if min_val > max_val:
                     subset = roll_coords_by_min_max_coord(
                         subset, coord, min_val, max_val
                     )
                 else:
-                    max_val += 0.01
                     selection = {coord: slice(min_val, max_val)}
                     subset = subset.sel(selection)
         subset = flatten_dims(subset)
     return subset
 
 
+def make_subset_cache_key(metric_info, ignore_coords=None):
+    """
+    Makes a key which is the same for any metrics that subset the data in the same way
+    i.e. same coords and min/max values (regardless of dict order or int/float values)
+
+    Parameters
+    ----------
+    metric_info : dict
+        jetstream metric information about metric name, subsetting, required variables, function location
+    ignore_coords : array-like
+        coordiantes to not subset
+
+    Returns
+    ----------
+    subset_key : tuple
+        Sorted (coord, min_val, max_val) for each coord to subset
+    """
+    return metric_planner.make_subset_key(metric_info, ignore_coords)
+
+
 def get_coords_to_subset(ignore_coords, metric_info):
-    if ignore_coords:
-        coords_to_subset = set(metric_info["coords"].keys())
-        coords_to_subset = coords_to_subset.difference(set(ignore_coords))
-        coords_to_subset = list(coords_to_subset)
+    return metric_planner.get_coords_to_subset(ignore_coords, metric_info)
+
+
+def canonicalize_data(data, lon_convention=LON_CONVENTION, plev_units=CANONICAL_PLEV_UNITS):
+    """
+    Makes the coords of data the same for every model so metrics can subset them in the same way:
+    'latitude'/'longitude' are renamed to 'lat'/'lon', every dimension coord is put in ascending
+    order, lon is wrapped to lon_convention and plev is converted to plev_units.
+    Only coord values (held in memory as indexes) are read, and descending coords are reversed
+    with a strided view rather than a copy, so dask-backed data stays lazy.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        Climate data
+    lon_convention : str
+        "0-360" or "-180-180"
+    plev_units : str
+        One of PLEV_UNITS_IN_PA
+
+    Returns
+    ----------
+    canonical_data : xarray.Dataset
+
+    Usage
+    ----------
+    canonical_data = canonicalize_data(data)
+    """
+    data = rename_coords_to_canonical_names(data)
+    for coord in list(data.indexes):
+        if coord in data.dims and data.indexes[coord].is_monotonic_decreasing:
+            data = swap_coord_order(data, coord)
+    data = round_coords(data)
+    if "lon" in data.indexes:
+        data = wrap_lon_to_convention(data, lon_convention)
+    if "plev" in data.coords:
+        data = normalize_plev_units(data, plev_units)
+    return data
+
+
+def round_coords(data, decimals=ROUNDING_THRESHOLD):
+    """
+    Rounds float dimension coords (once, so metrics always see the same values as are
+    checked against their coords i.e. 70000 not 70000.00001)
+    """
+    rounded_coords = {}
+    for coord in data.indexes:
+        values = data.indexes[coord].values
+        if coord in data.dims and values.dtype.kind == "f":
+            rounded_values = values.round(decimals)
+            if not numpy.array_equal(rounded_values, values):
+                rounded_coords[coord] = (coord, rounded_values, data[coord].attrs)
+    if rounded_coords:
+        data = data.assign_coords(rounded_coords)
+    return data
+
+
+def rename_coords_to_canonical_names(data):
+    """
+    Renames coords with other names used by some models (i.e. 'longitude') to the
+    names used in the metric dicts (see subset_planner.COORD_ALIASES)
+    """
+    renames = {}
+    for coord, coord_names in subset_planner.COORD_ALIASES.items():
+        if coord in data.variables:
+            continue
+        for coord_name in coord_names:
+            if coord_name in data.variables:
+                renames[coord_name] = coord
+                break
+    if renames:
+        data = data.rename(renames)
+    return data
+
+
+def wrap_lon_to_convention(data, lon_convention=LON_CONVENTION):
+    """
+    Wraps lon values to 0-360 or -180-180 and puts them in ascending order
+    (which only selects data again when the values were not already in that convention)
+
+    Raises
+    ----------
+    ValueError
+        When lon_convention is not "0-360" or "-180-180"
+    """
+    lon = data.indexes["lon"].values.astype(float)
+    if lon_convention == "0-360":
+        wrapped_lon = lon % 360
+    elif lon_convention == "-180-180":
+        wrapped_lon = (lon + 180) % 360 - 180
     else:
-        coords_to_subset = list(metric_info["coords"].keys())
-    return coords_to_subset
+        raise ValueError("'%s' is not a lon convention, use '0-360' or '-180-180'" % (lon_convention))
+    if numpy.array_equal(wrapped_lon, lon):
+        return data
+    order = numpy.argsort(wrapped_lon, kind="stable")
+    data = data.isel(lon=order)
+    return data.assign_coords(lon=("lon", wrapped_lon[order], data["lon"].attrs))
 
 
-def check_plev_units(self, metric_info):
-    if self.data["plev"].units in EQUIVALENT_PLEV_UNITS.keys():
-        pass
+def normalize_plev_units(data, plev_units=CANONICAL_PLEV_UNITS):
+    """
+    Converts plev from any of PLEV_UNITS_IN_PA to plev_units. plev without units is
+    assumed to be in plev_units already and unknown units are left as they are.
+    """
+    data_plev_units = data["plev"].attrs.get("units")
+    if data_plev_units is None or data_plev_units == plev_units:
+        return data
+    if data_plev_units not in PLEV_UNITS_IN_PA or plev_units not in PLEV_UNITS_IN_PA:
+        log.warning("cannot convert plev from '%s' to '%s'" % (data_plev_units, plev_units))
+        return data
+    scale = PLEV_UNITS_IN_PA[data_plev_units] / PLEV_UNITS_IN_PA[plev_units]
+    plev = data["plev"]
+    return data.assign_coords(
+        plev=(plev.dims, plev.values * scale, dict(plev.attrs, units=plev_units))
+    )
 
 
 def roll_coords_by_min_max_coord(data, coord, min_val, max_val):
     """
-    Roll coords by a min and maximum value. Useful for longitude if coords to subset cross 0. i.e. 60W-60E
-    """
-    assert min_val > max_val, "Can only roll coords if min_val is more than max_val"
-    idx = numpy.searchsorted(data[coord], min_val - max_val, side="left")
-
-    try:
-        rolled_data = data.roll({coord: idx}, roll_coords=True)\
-        .sel({coord: slice(min_val, max_val)})\
-        .sortby(coord) # TODO: check 0.1 as it was added to ensure that the slice does not exclude vals
-            
-    except:
-        min_difference_array = numpy.absolute(data['lon']-min_val)
-        max_difference_array = numpy.absolute(data['lon']-max_val)
-        # find the index of minimum element from the array
-        closest_to_min_index = int(min_difference_array.argmin())
-        closest_to_max_index = int(max_difference_array.argmin())
-        min_lon = data['lon'][closest_to_min_index]
-        max_lon = data['lon'][closest_to_max_index]
-        rolled_data = data.roll({coord: idx}, roll_coords=True)\
-        .sel({coord: slice(min_lon, max_lon)})\
-        .sortby(coord)
-    return rolled_data
+    Subsets a coord to a range which wraps around, i.e. lon of 300 to 60 (60W-60E), without
+    rolling or copying the data: the values from the start of the coord up to max_val and from
+    min_val to the end are taken with two isel slices and joined (in ascending order, as sorting
+    the rolled data did). Stays lazy for dask-backed data and works for any cyclic coord.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        Data to subset
+    coord : str
+        Dimension coord to subset e.g. 'lon'
+    min_val : float
+        Values from min_val upwards are kept
+    max_val : float
+        Values up to max_val are kept
+
+    Returns
+    ----------
+    subset : xarray.Dataset
+
+    Raises
+    ----------
+    ValueError
+        When min_val is not more than max_val (so the range does not wrap around)
+    """
+    if min_val <= max_val:
+        raise ValueError("Can only roll coords if min_val is more than max_val")
+    dim = data[coord].dims[0]
+    data = swap_coord_order(data, coord)
+    coord_values = numpy.asarray(data[coord].values)
+    if numpy.any(numpy.diff(coord_values) < 0):
+        data = data.sortby(coord)
+        coord_values = numpy.asarray(data[coord].values)
+    parts = [
+        data.isel({dim: coord_slice})
+        for coord_slice in metric_planner.get_wraparound_slices(coord_values, min_val, max_val)
+        if coord_slice.stop > coord_slice.start
+    ]
+    if len(parts) < 2:
+        return parts[0] if parts else data.isel({dim: slice(0, 0)})
+    #  variables without the coord's dim are taken from the first part as they are
+    return xarray.concat(
+        parts, dim=dim, data_vars="minimal", coords="minimal", compat="override", join="override"
+    )
 
 
 def flatten_dims(data):
@@ -189,7 +549,7 @@ def flatten_dims(data):
 
 def swap_coord_order(data, coord, ascending=True):
     """
-    Will reverse the dimension if a higher number is first
+    Will reverse the dimension if a higher number is first (with a view, not a copy, of the data)
 
     Parameters
     ----------
@@ -207,8 +567,9 @@ def swap_coord_order(data, coord, ascending=True):
     if not ascending:
         first_val = -1
         last_val = 0
-    if data[coord][first_val] > data[coord][last_val]:
-        data = data.reindex(**{coord: list(reversed(data[coord]))})
+    coord_values = data.indexes[coord] if coord in data.indexes else data[coord].values
+    if coord_values[first_val] > coord_values[last_val]:
+        data = data.isel({coord: slice(None, None, -1)})
     return data
 
 
@@ -242,6 +603,92 @@ def compute_metric_using_metric_info(
     return result
 
 
+def compute_metric_in_time_blocks(data, metric_info, block_years, load_blocks=False):
+    """
+    Runs a metric on blocks of whole years at a time so memory is bounded by the block size.
+    Each block is given an extra halo of time steps either side (from metric_info["time_blocking"]["halo"],
+    e.g. half the window of a Lanczos filter) which is trimmed off before the blocks are joined,
+    so results are the same as running the metric on all times at once.
+    Only outputs with a time dimension that are not inputs to the metric are kept
+    (e.g. 'jet_lat' but not 'ua' or a seasonal climatology)
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        Data to calculate metric from (already subset)
+    metric_info : dict
+        jetstream metric information about metric name, subsetting, required variables, function location
+    block_years : int
+        Number of years in each block (before the halo is added)
+    load_blocks : Boolean
+        Load each block into memory before running the metric (i.e. for dask-backed data)
+
+    Returns
+    ----------
+    result : xarray.Dataset
+        Result from metric for all times
+
+    Raises
+    ----------
+    ValueError
+        When the metric output has no time dimension to join the blocks on
+    """
+    halo = int(metric_info[TIME_BLOCKING_KEY].get("halo", 0))
+    block_bounds = get_time_block_bounds(data["time"].dt.year.values, block_years)
+    n_times = data["time"].size
+    block_results = []
+    for block_start, block_end in block_bounds:
+        block = data.isel(
+            time=slice(max(block_start - halo, 0), min(block_end + halo, n_times))
+        )
+        if load_blocks:
+            with instrumentation.time_stage("load", metric=metric_info["name"]):
+                block = block.load()
+        block_result = compute_metric_using_metric_info(block, metric_info)
+        if "time" not in block_result.dims:
+            raise ValueError(
+                "cannot run %s in time blocks as output has no time dimension"
+                % (metric_info["name"])
+            )
+        block_result = block_result[
+            [
+                var
+                for var in block_result.data_vars
+                if "time" in block_result[var].dims and var not in metric_info["variables"]
+            ]
+        ]
+        #  trim the halo by time value in case the metric does not keep every time step
+        block_result = block_result.sel(
+            time=slice(data["time"].values[block_start], data["time"].values[block_end - 1])
+        )
+        block_results.append(block_result)
+    return xarray.concat(block_results, dim="time")
+
+
+def get_time_block_bounds(years, block_years):
+    """
+    Split time steps into blocks of whole years
+
+    Parameters
+    ----------
+    years : numpy.ndarray
+        Year of each time step (in time order)
+    block_years : int
+        Number of years in each block
+
+    Returns
+    ----------
+    block_bounds : list
+        (start_index, end_index) of each block (end_index is exclusive)
+    """
+    year_starts = numpy.flatnonzero(numpy.diff(years, prepend=years[0] - 1) != 0)
+    block_starts = list(year_starts[:: int(block_years)]) + [len(years)]
+    return [
+        (int(block_start), int(block_end))
+        for block_start, block_end in zip(block_starts[:-1], block_starts[1:])
+    ]
+
+
 def check_all_variables_available(data, metric):
     """
     Checks if all variables required to compute metric
@@ -260,18 +707,15 @@ def check_all_coords_available(data, metric_info, return_coord_error=True):
     """
     coord_error_message = ""
     metric_usable = True
-    try:
-        assert (
-            len(metric_info["coords"]) >= 1
-        ), "Metric dictionary has less than 1 coordinate"
-    except Exception as e:
-        raise e(metric_usable, "Metric has no coordinates to subset")
+    if len(metric_info["coords"]) < 1:
+        raise ValueError("Metric has no coordinates to subset")
 
     # Loop over each coordinate in all metric dictionary and check if the coords exist in data and can be used for the metric calculation
+    coord_index = metric_planner.CoordIndex(data)
     for coord in metric_info["coords"].keys():
-        if coord in data.coords:
+        if coord in coord_index:
             coord_vals = metric_info["coords"][coord]
-            coord_available = check_if_coord_vals_meet_reqs(data, coord, coord_vals)
+            coord_available = coord_index.meets_reqs(coord, coord_vals)
             # if coord fails check, provide user information why
             if return_coord_error and not coord_available:
                 coord_error_message += " '%s' needs to be between %s and %s." % (
@@ -292,42 +736,55 @@ def check_all_coords_available(data, metric_info, return_coord_error=True):
 def check_if_coord_vals_meet_reqs(data, coord, coord_vals):
     """
     Checks if the data has the correct coordinate values required
-    for the metric.
+    for the metric (without changing the data, see metric_planner.CoordIndex.meets_reqs).
     # TODO: expand to be more strict about plev!!
     """
-    # Round all values to a global precision
-    min_val = round(float(coord_vals[0]), ROUNDING_THRESHOLD)
-    max_val = round(float(coord_vals[1]), ROUNDING_THRESHOLD)
-    data[coord] = data[coord].astype(float).round(ROUNDING_THRESHOLD)
-    
-    # check for rolled data (TODO: new func?)
-    if min_val > max_val:
-        coord_val_avaialable_top = data[coord].loc[min_val : data[coord].max()]
-        coord_val_avaialable_bottom = data[coord].loc[data[coord].min() : max_val]
-        if len(coord_val_avaialable_top) != 0 or len(coord_val_avaialable_bottom) != 0:
-            return True
-        else:
-            return False
+    return metric_planner.CoordIndex(data).meets_reqs(coord, coord_vals)
 
-    # check that the data is more than one value
-    elif data[coord].count() > 1:
-        coord_val_avaialable = data[coord].loc[min_val:max_val]
-        if len(coord_val_avaialable) != 0:
-            return True
-        return False
-    else:
-        return data[coord].values >= min_val and data[coord].values <= max_val
+
+class MetricResult:
+    """
+    Output of a metric run by MetricComputerWithAllMetrics.compute_all_metrics, or the error it raised
+    """
+
+    def __init__(self, metric_name, output=None, error=None):
+        self.metric_name = metric_name
+        self.output = output
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.succeeded:
+            return "MetricResult(%s)" % (self.metric_name)
+        return "MetricResult(%s, error=%r)" % (self.metric_name, self.error)
+
+
+#  computer used by metrics run in worker processes (inherited when they are forked, see compute_all_metrics)
+_worker_metric_computer = None
 
 
 class MetricComputerWithAllMetrics(MetricComputer):
-    def __init__(self, data, all_metrics=None):
-        super().__init__(data)
+    def __init__(self, data, all_metrics=None, **kwargs):
+        """
+        Parameters
+        ----------
+        data : xarray.Dataset
+            Climate data to compute metrics from
+        all_metrics : dict
+            Metric name -> metric info of every metric to compute
+        **kwargs
+            Passed to MetricComputer e.g. load_subsets=True
+        """
+        super().__init__(data, **kwargs)
         self.all_metrics = all_metrics
 
     @classmethod
-    def with_available_metrics(cls, data, all_metrics):
-        data_with_available_metrics = cls(data)
-        data_with_available_metrics.get_available_metrics(all_metrics)
+    def with_available_metrics(cls, data, all_metrics, **kwargs):
+        data_with_available_metrics = cls(data, all_metrics, **kwargs)
+        data_with_available_metrics.get_available_metrics()
         return data_with_available_metrics
 
     def get_available_metrics(self, return_coord_error=False):
@@ -337,17 +794,123 @@ class MetricComputerWithAllMetrics(MetricComputer):
         print("%s metrics available for this dataset:" % (len(self.available_metrics)))
         print("Metrics available:", self.available_metrics)
 
-    def compute_all_metrics(self):
+    def compute_all_metrics(self, metric_names=None, max_workers=METRIC_WORKERS, use_processes=False):
+        """
+        Will go through and compute all metrics which are available, running up to max_workers
+        at once on the same canonical data. Each subset is made (and loaded) once before
+        the metrics run, so metrics with the same coords share it.
+
+        Parameters
+        ----------
+        metric_names : list
+            Names (keys of all_metrics) of metrics to compute (default: all of them)
+        max_workers : int
+            Metrics run at once (1 runs them one after another in this thread)
+        use_processes : Boolean
+            Run metrics in forked processes rather than threads (for metrics which hold the GIL,
+            outputs are copied back to this process)
+
+        Returns
+        ----------
+        metric_results : collections.OrderedDict
+            Metric name -> MetricResult for each metric (in the order of all_metrics), with the
+            error of any metric which could not be run rather than raising it
+
+        Raises
+        ----------
+        KeyError
+            When there is no dictionary of all metrics
+        """
+        if self.all_metrics is None:
+            raise KeyError("A dictionary of all metrics is required to compute all metrics")
+        if metric_names is None:
+            metric_names = list(self.all_metrics)
+        execution_plan = self.plan_metrics(
+            {metric_name: self.all_metrics[metric_name] for metric_name in metric_names}
+        )
+        metric_results = {
+            metric_name: MetricResult(
+                metric_name,
+                error=ValueError(
+                    "cannot calculate %s metric from data provided. %s" % (metric_name, message)
+                ),
+            )
+            for metric_name, message in execution_plan.unavailable_metrics.items()
+        }
+        #  make each subset once before metrics run at once (errors are kept when the metric runs)
+        subset_keys = set()
+        for metric_plan in execution_plan:
+            if metric_plan.subset_key not in subset_keys and not self.uses_time_blocks(
+                metric_plan.metric_info
+            ):
+                subset_keys.add(metric_plan.subset_key)
+                try:
+                    self.subset_data_for_metric(metric_plan.metric_info)
+                except Exception:
+                    pass
+        runnable_metric_names = [
+            metric_name for metric_name in metric_names if metric_name in execution_plan
+        ]
+        if (max_workers is None or max_workers > 1) and len(runnable_metric_names) > 1:
+            metric_results.update(
+                self._compute_metrics_in_pool(runnable_metric_names, max_workers, use_processes)
+            )
+        else:
+            for metric_name in runnable_metric_names:
+                metric_results[metric_name] = self.compute_metric_result(metric_name)
+        return collections.OrderedDict(
+            (metric_name, metric_results[metric_name]) for metric_name in metric_names
+        )
+
+    def _compute_metrics_in_pool(self, metric_names, max_workers, use_processes):
+        global _worker_metric_computer
+        if use_processes:
+            _worker_metric_computer = self
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+            )
+            compute_metric_result = compute_metric_result_in_worker
+        else:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            compute_metric_result = self.compute_metric_result
+        try:
+            with executor:
+                #  threads are given the instrumentation context (i.e. the group) of this thread
+                futures = {
+                    metric_name: (
+                        executor.submit(compute_metric_result, metric_name)
+                        if use_processes
+                        else executor.submit(
+                            contextvars.copy_context().run, compute_metric_result, metric_name
+                        )
+                    )
+                    for metric_name in metric_names
+                }
+                metric_results = {}
+                for metric_name, future in futures.items():
+                    try:
+                        metric_results[metric_name] = future.result()
+                    except Exception as e:
+                        #  i.e. the worker process died
+                        metric_results[metric_name] = MetricResult(metric_name, error=e)
+        finally:
+            _worker_metric_computer = None
+        return metric_results
+
+    def compute_metric_result(self, metric_name):
         """
-        will go through and compute all metric which are available
+        Runs a metric of all_metrics (see compute_metric_from_data)
+
+        Returns
+        ----------
+        metric_result : MetricResult
+            With the output of the metric or the error it raised
         """
-        if not hasattr(self, "available_metrics"):
-            try:
-                self.get_available_metrics()
-            except Exception as e:
-                raise KeyError(
-                    "A dictionary of all metrics is required. Error is: %s " % (e)
-                )
+        try:
+            output = self.compute_metric_from_data(self.all_metrics[metric_name])
+        except Exception as e:
+            return MetricResult(metric_name, error=e)
+        return MetricResult(metric_name, output=output)
 
     def sel(self, inplace=False, **kwargs):
         """
@@ -376,6 +939,10 @@ class MetricComputerWithAllMetrics(MetricComputer):
             return MetricComputerWithAllMetrics(new_data, self.all_metrics)
 
 
+def compute_metric_result_in_worker(metric_name):
+    return _worker_metric_computer.compute_metric_result(metric_name)
+
+
 def get_available_metric_list(data, all_metrics=None, return_coord_error=False):
     """
     Checks which variables can be used by the data
@@ -403,19 +970,23 @@ def get_available_metric_list(data, all_metrics=None, return_coord_error=False):
 
     """
     available_metrics = []
-    for metric_name in all_metrics:
-        metric_is_usuable = {metric_name: "usuable"}
-        if check_all_variables_available(data, metric=all_metrics[metric_name]):
-            # check that all coords exists in xarray data i.e. plev, lat, etc.
-            metric_usable, coord_error_message = check_all_coords_available(
-                data, all_metrics[metric_name], return_coord_error
-            )
-            # will make return error message
-            if return_coord_error and len(coord_error_message) > 0:
-                metric_is_usuable = {
-                    metric_name: "To use this metric" + coord_error_message
+    coord_index = metric_planner.CoordIndex(data)
+    for metric_name, metric_info in all_metrics.items():
+        missing, unmet_coord_ranges = metric_planner.get_metric_requirement_errors(
+            coord_index, metric_info
+        )
+        # i.e. plev, lat, etc. or a variable do not exist in data
+        if missing:
+            continue
+        if not unmet_coord_ranges:
+            available_metrics.append({metric_name: "usuable"})
+        # will make return error message
+        elif return_coord_error:
+            available_metrics.append(
+                {
+                    metric_name: "To use this metric "
+                    + metric_planner.make_requirement_error_message([], unmet_coord_ranges)
                 }
-            if metric_usable:
-                available_metrics.append(metric_is_usuable)
+            )
 
     return available_metrics
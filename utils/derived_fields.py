@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Reductions of a metric's subset shared by many jet latitude metrics (i.e. the mean over plev
+    and the zonal mean), made once per subset and kept in a size-bounded LRU cache so each metric
+    can start from the reduced field instead of the full 4-D subset.
+    Reduced coords are kept with one value (their mean), so a metric reducing them again gets the
+    same values as when it is given the full subset.
+"""
+
+# imports
+import collections
+import hashlib
+import threading
+
+import numpy
+from jsmetrics.core.check_data import sort_xarray_data_coords
+from jsmetrics.utils import windspeed_utils
+
+# docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+DERIVED_FIELD_KEY = "derived_field"  # metric dict entries with e.g. "derived_field": "zonal_mean" are given that reduction of their subset
+DERIVED_FIELD_CACHE_SIZE = 2000  # MB of derived fields kept by each cache
+
+
+#  operations sort lat and lon first like the jet_statistics metrics do, so the values they
+#  reduce are in the same order (float32 sums depend on it)
+@sort_xarray_data_coords(coords=["lat", "lon"])
+def get_plev_mean(data):
+    """
+    Mean over plev (as jet_statistics metrics which only use one plev do)
+    """
+    if "plev" not in data.dims or data["plev"].size == 1:
+        return data
+    return keep_reduced_coords(data.mean("plev"), data, ["plev"])
+
+
+@sort_xarray_data_coords(coords=["lat", "lon"])
+def get_zonal_mean(data):
+    """
+    Mean over lon and plev (as jsmetrics.utils.windspeed_utils.get_zonal_mean), keeping
+    lon as a dim of size one for metrics which take the zonal mean themselves
+    """
+    reduced_dims = [dim for dim in ["lon", "plev"] if dim in data.dims]
+    return keep_reduced_coords(
+        windspeed_utils.get_zonal_mean(data), data, reduced_dims, dims_to_keep=["lon"]
+    )
+
+
+#  operation name -> function reducing a subset
+DERIVED_FIELD_OPERATIONS = {
+    "plev_mean": get_plev_mean,
+    "zonal_mean": get_zonal_mean,
+}
+
+
+def keep_reduced_coords(reduced_data, data, reduced_dims, dims_to_keep=()):
+    """
+    Adds coords reduced from data back to reduced_data with one value (the mean of the coord)
+    so metrics can still check them. Coords in dims_to_keep are added as dims of size one
+    (in the same order as in data) and the rest as scalar coords
+    """
+    for dim in reduced_dims:
+        if dim in reduced_data.dims:
+            continue
+        coord_value = float(numpy.mean(data.indexes[dim].values))
+        if dim in dims_to_keep:
+            reduced_data = reduced_data.expand_dims({dim: [coord_value]})
+        else:
+            reduced_data = reduced_data.assign_coords({dim: coord_value})
+        reduced_data[dim].attrs = data[dim].attrs
+    return reduced_data.transpose(*[dim for dim in data.dims if dim in reduced_data.dims])
+
+
+def drop_reduced_coords(result, data, derived_field):
+    """
+    Drops the scalar coords a derived field added (see keep_reduced_coords) from the result
+    of a metric run on it, so the result is the same as the metric run on data
+    """
+    reduced_coords = [
+        coord
+        for coord in derived_field.coords
+        if coord in data.dims and coord not in derived_field.dims
+    ]
+    return result.drop_vars(
+        [coord for coord in reduced_coords if coord in result.coords and coord not in result.dims]
+    )
+
+
+def get_dataset_fingerprint(data):
+    """
+    Fingerprint of a dataset from its metadata only (sizes, coord values, variables, the dask
+    names of dask-backed variables and the files they are read from), so it is cheap to make
+    and two subsets of the same data are told apart
+
+    Returns
+    ----------
+    fingerprint : str
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(repr(sorted(data.sizes.items())).encode())
+    for name in sorted(data.variables):
+        variable = data.variables[name]
+        fingerprint.update(
+            repr((name, variable.dims, variable.dtype.str, variable.encoding.get("source"))).encode()
+        )
+        if name in data.indexes:
+            fingerprint.update(numpy.asarray(data.indexes[name].values).tobytes())
+        elif variable.chunks is not None:
+            fingerprint.update(variable.data.name.encode())
+    return fingerprint.hexdigest()
+
+
+class DerivedFieldCache:
+    """
+    LRU cache of derived fields keyed by the fingerprint of the data they were made from and
+    the operation, holding up to max_size_mb (fields larger than this are made but not kept).
+    Fields can be asked for from several threads at once and each is only made once.
+    Only share a cache between subsets of one dataset, as in-memory data of two datasets with
+    the same coords has the same fingerprint.
+    """
+
+    def __init__(self, max_size_mb=DERIVED_FIELD_CACHE_SIZE):
+        self.max_size_mb = max_size_mb
+        self._fields = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def __len__(self):
+        return len(self._fields)
+
+    @property
+    def size_mb(self):
+        return self._nbytes / 1024**2
+
+    def get(self, data, operation, variables=None):
+        """
+        Parameters
+        ----------
+        data : xarray.Dataset
+            Subset to reduce
+        operation : str
+            One of DERIVED_FIELD_OPERATIONS
+        variables : list
+            Variables of data to reduce (default: all)
+
+        Returns
+        ----------
+        derived_field : xarray.Dataset
+
+        Raises
+        ----------
+        KeyError
+            When operation is not in DERIVED_FIELD_OPERATIONS
+        """
+        if operation not in DERIVED_FIELD_OPERATIONS:
+            raise KeyError(
+                "'%s' is not a derived field, use one of %s"
+                % (operation, list(DERIVED_FIELD_OPERATIONS))
+            )
+        if variables is not None:
+            data = data[list(variables)]
+        key = (get_dataset_fingerprint(data), operation)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._fields:
+                    self._fields.move_to_end(key)
+                    return self._fields[key]
+            derived_field = DERIVED_FIELD_OPERATIONS[operation](data)
+            self._add(key, derived_field)
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return derived_field
+
+    def _add(self, key, derived_field):
+        nbytes = derived_field.nbytes
+        if nbytes > self.max_size_mb * 1024**2:
+            return
+        with self._lock:
+            self._fields[key] = derived_field
+            self._nbytes += nbytes
+            while self._nbytes > self.max_size_mb * 1024**2:
+                _, evicted_field = self._fields.popitem(last=False)
+                self._nbytes -= evicted_field.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._fields.clear()
+            self._nbytes = 0
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Persistent catalog of data files stored in SQLite.
+    Built originally for keeping track of the CMIP6 ensemble on NERC's JASMIN supercomputer
+    without re-crawling /badc every run.
+"""
+
+#  imports
+import itertools
+import json
+import os
+import re
+
+import numpy
+import sqlite3
+import time
+
+from utils import get_data
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+#  bump when the files/directories tables change so old catalogs are rebuilt
+CATALOG_VERSION = 2
+
+#  a directory modified this close to when it was listed may change again within the same
+#  mtime tick, so its listing is not reused (same idea as git's "racy" index entries)
+RACY_MTIME_WINDOW_NS = 2 * 10**9
+
+FILE_COLUMNS = [
+    "path",
+    "crawl_order",
+    "directory",
+    "file_name",
+    "group_key",
+    "institution",
+    "model",
+    "experiment",
+    "member",
+    "table_id",
+    "variable",
+    "grid",
+    "version",
+    "start_date",
+    "end_date",
+    "size",
+    "mtime_ns",
+]
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    crawl_order INTEGER,
+    directory TEXT,
+    file_name TEXT,
+    group_key TEXT,
+    institution TEXT,
+    model TEXT,
+    experiment TEXT,
+    member TEXT,
+    table_id TEXT,
+    variable TEXT,
+    grid TEXT,
+    version TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_by_dates ON files (start_date, end_date);
+CREATE INDEX IF NOT EXISTS files_by_group ON files (group_key, start_date);
+CREATE INDEX IF NOT EXISTS files_by_model ON files (model, member);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    entries TEXT
+);
+"""
+
+#  dates are stored as YYYY-MM-DD whatever format the file name uses, so they compare as strings
+#  files overlapping a date range (i.e. start date in range, end date in range, or file covers range)
+DATE_RANGE_CONDITION = """
+    ((start_date >= :range_start AND start_date <= :range_end)
+    OR (end_date >= :range_start AND end_date <= :range_end)
+    OR (start_date <= :range_start AND end_date >= :range_end))
+"""
+
+
+class CachedScandirDataPathCrawler(get_data.ScandirDataPathCrawler):
+    """
+    ScandirDataPathCrawler that reuses a cached listing of any directory whose mtime has not
+    changed since it was last listed. Directories that have changed are listed again.
+    """
+
+    def __init__(self, pathname, cached_listings=None, max_workers=None):
+        """
+        Parameters
+        ----------
+        pathname : str
+            Path to data directory for data files search (including wildcards for glob)
+        cached_listings : dict
+            Directory -> (mtime_ns, [(name, is_dir), ...]) from a previous crawl
+        max_workers : int
+            Number of threads used to list directories (default: CRAWLER_MAX_WORKERS)
+        """
+        super().__init__(pathname, max_workers=max_workers)
+        if not cached_listings:
+            cached_listings = {}
+        self.cached_listings = cached_listings
+        self.visited_listings = {}
+        self.rescanned_directories = set()
+
+    def _scandir(self, directory):
+        try:
+            mtime_ns = os.stat(directory or os.curdir).st_mtime_ns
+        except OSError:
+            return []
+        cached_listing = self.cached_listings.get(directory)
+        if cached_listing and cached_listing[0] == mtime_ns:
+            entries = cached_listing[1]
+        else:
+            entries = super()._scandir(directory)
+            self.rescanned_directories.add(directory)
+            if time.time_ns() - mtime_ns < RACY_MTIME_WINDOW_NS:
+                mtime_ns = None  # do not trust this listing next time
+        self.visited_listings[directory] = (mtime_ns, entries)
+        return entries
+
+
+class SQLiteFileCatalog:
+    """
+    Catalog of data files with one row per file holding its CMIP6 DRS facets,
+    start/end date, size and mtime. Refreshes only re-list directories whose mtime
+    has changed, and date-range subsetting and grouping are indexed queries.
+    """
+
+    def __init__(self, catalog_path):
+        """
+        Parameters
+        ----------
+        catalog_path : str
+            Path to SQLite database file (will be created if it does not exist)
+
+        Raises
+        ----------
+        TypeError
+            When 'catalog_path' is not a str
+        """
+        if not isinstance(catalog_path, str):
+            raise TypeError("'catalog_path' input needs to be string type")
+        self.catalog_path = catalog_path
+        self._connection = sqlite3.connect(catalog_path)
+        user_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if user_version != CATALOG_VERSION:
+            self._connection.executescript(
+                "DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS directories;"
+            )
+            self._connection.execute("PRAGMA user_version = %s" % (CATALOG_VERSION))
+        self._connection.executescript(CATALOG_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def refresh(self, pathname, max_workers=None):
+        """
+        Will crawl pathname reusing the stored listing of every directory which has not
+        changed (by mtime) and update the catalog with the files found
+
+        Parameters
+        ----------
+        pathname : str
+            Path to data directory for data files search (including wildcards for glob)
+        max_workers : int
+            Number of threads used to list directories
+
+        Returns
+        ----------
+        n_rescanned : int
+            Number of directories that had to be listed again
+        """
+        crawler = CachedScandirDataPathCrawler(
+            pathname, self._get_cached_listings(), max_workers=max_workers
+        )
+        data_paths = crawler.crawl()
+        known_files = self._get_known_files(crawler.rescanned_directories)
+        rows = make_file_rows(data_paths, known_files)
+        with self._connection:
+            self._connection.execute("DELETE FROM files")
+            self._connection.executemany(
+                "INSERT INTO files VALUES (%s)" % (", ".join(["?"] * len(FILE_COLUMNS))),
+                rows,
+            )
+            self._connection.execute("DELETE FROM directories")
+            self._connection.executemany(
+                "INSERT INTO directories VALUES (?, ?, ?)",
+                [
+                    (directory, mtime_ns, json.dumps(entries))
+                    for directory, (mtime_ns, entries) in crawler.visited_listings.items()
+                ],
+            )
+        return len(crawler.rescanned_directories)
+
+    def _get_cached_listings(self):
+        cached_listings = {}
+        for directory, mtime_ns, entries in self._connection.execute(
+            "SELECT path, mtime_ns, entries FROM directories"
+        ):
+            cached_listings[directory] = (
+                mtime_ns,
+                [tuple(entry) for entry in json.loads(entries)],
+            )
+        return cached_listings
+
+    def _get_known_files(self, rescanned_directories):
+        """
+        Size and mtime of files already in the catalog which are in unchanged directories
+        """
+        known_files = {}
+        for path, directory, size, mtime_ns in self._connection.execute(
+            "SELECT path, directory, size, mtime_ns FROM files"
+        ):
+            if directory not in rescanned_directories:
+                known_files[path] = (size, mtime_ns)
+        return known_files
+
+    def get_data_paths(
+        self,
+        date_range_start=None,
+        date_range_end=None,
+        one_realisation=False,
+        date_format=get_data.JASMIN_DATE_FORMAT,
+    ):
+        """
+        Get data paths in the order they were found, optionally subset by a date range
+
+        Parameters
+        ----------
+        date_range_start : str
+            Start date to subset data paths by. Must be in JASMIN file date format (i.e. YYYYMMDD)
+        date_range_end : str
+            End date to subset data paths by. Must be in JASMIN file date format (i.e. YYYYMMDD)
+        one_realisation : Boolean
+            Will only keep the first realisation found for each model
+        date_format : str
+            Format of date_range_start and date_range_end (default: JASMIN_DATE_FORMAT)
+
+        Returns
+        ----------
+        data_paths : list
+            Paths to data (within the date range if given)
+        """
+        query = "SELECT path FROM files"
+        parameters = {}
+        if date_range_start is not None and date_range_end is not None:
+            query += " WHERE" + DATE_RANGE_CONDITION
+            parameters = make_date_range_parameters(
+                date_range_start, date_range_end, date_format
+            )
+        query += " ORDER BY crawl_order"
+        data_paths = [row[0] for row in self._connection.execute(query, parameters)]
+        return get_data.filter_data_paths(data_paths, one_realisation=one_realisation)
+
+    def group_data_paths(
+        self, date_range_start, date_range_end, date_format=get_data.JASMIN_DATE_FORMAT
+    ):
+        """
+        Will group data paths in a given date range by their path without dates
+        For using in xarray.open_mfdataset() i.e. 'multi-file' open
+
+        Parameters
+        ----------
+        date_range_start : str
+            Start date to subset data paths by. Must be in JASMIN file date format (i.e. YYYYMMDD)
+        date_range_end : str
+            End date to subset data paths by. Must be in JASMIN file date format (i.e. YYYYMMDD)
+        date_format : str
+            Format of date_range_start and date_range_end (default: JASMIN_DATE_FORMAT)
+
+        Returns
+        ----------
+        grouped_data_paths : list
+            List of lists of paths, each sorted by start date, in the order the groups were found
+            (without data paths in CAVEATS_IN_DATA)
+        """
+        query = """
+            SELECT files.path, files.group_key FROM files
+            JOIN (
+                SELECT group_key, MIN(crawl_order) AS group_order FROM files
+                WHERE %s GROUP BY group_key
+            ) AS groups ON files.group_key = groups.group_key
+            WHERE %s
+            ORDER BY groups.group_order, files.start_date, files.crawl_order
+        """ % (
+            DATE_RANGE_CONDITION,
+            DATE_RANGE_CONDITION,
+        )
+        rows = self._connection.execute(
+            query,
+            make_date_range_parameters(date_range_start, date_range_end, date_format),
+        )
+        rows = list(rows)
+        #  leave out the same data paths as get_data_paths (i.e. CAVEATS_IN_DATA)
+        kept_data_paths = set(
+            get_data.filter_data_paths([row[0] for row in rows], one_realisation=False)
+        )
+        grouped_data_paths = []
+        for _, group_rows in itertools.groupby(rows, key=lambda row: row[1]):
+            data_path_group = [row[0] for row in group_rows if row[0] in kept_data_paths]
+            if data_path_group:
+                grouped_data_paths.append(data_path_group)
+        return grouped_data_paths
+
+    def save_data_paths(self, save_filepath, **kwargs):
+        """
+        Saves data paths (see get_data_paths for kwargs) to a data list file
+        """
+        data_path_retriever = get_data.GlobDataPathRetriever(
+            "", data_paths=self.get_data_paths(**kwargs)
+        )
+        data_path_retriever.save_data_paths(save_filepath)
+
+
+def make_date_range_parameters(date_range_start, date_range_end, date_format):
+    """
+    Query parameters for DATE_RANGE_CONDITION from a date range in date_format
+    """
+    return {
+        "range_start": str(
+            get_data.convert_to_datetime64(date_range_start, date_format).astype(
+                "datetime64[D]"
+            )
+        ),
+        "range_end": str(
+            get_data.convert_to_datetime64(date_range_end, date_format).astype(
+                "datetime64[D]"
+            )
+        ),
+    }
+
+
+def get_catalog_dates_from_data_paths(data_paths):
+    """
+    Get the start and end date and the path without its date range for each data path,
+    trying each date format in get_data.JASMIN_DATE_RANGE_PATTERNS in turn
+    (e.g. YYYYMMDD for historical and YYYYMM for SSP files).
+    Dates are parsed in the same way as get_data.DataPathDateIndex
+
+    Returns
+    ----------
+    catalog_dates : list
+        (start_date, end_date, group_key) for each data path. Dates are YYYY-MM-DD strings,
+        or None (with the full path as the group key) if the file name has no date range
+    """
+    catalog_dates = [(None, None, data_path) for data_path in data_paths]
+    unparsed_inds = numpy.arange(len(data_paths))
+    for date_format, date_range_pattern in get_data.JASMIN_DATE_RANGE_PATTERNS.items():
+        if not len(unparsed_inds):
+            break
+        start_dates, end_dates = get_data.get_start_end_dates_from_data_paths(
+            [data_paths[ind] for ind in unparsed_inds], date_format
+        )
+        parsed = ~(numpy.isnat(start_dates) | numpy.isnat(end_dates))
+        date_range_regex = re.compile(date_range_pattern)
+        for ind, start_date, end_date in zip(
+            unparsed_inds[parsed], start_dates[parsed], end_dates[parsed]
+        ):
+            catalog_dates[ind] = (
+                str(start_date),
+                str(end_date),
+                date_range_regex.sub("", data_paths[ind], count=1),
+            )
+        unparsed_inds = unparsed_inds[~parsed]
+    return catalog_dates
+
+
+def make_file_rows(data_paths, known_files=None):
+    """
+    Make the rows for the files table of the catalog
+
+    Parameters
+    ----------
+    data_paths : list
+        Paths to data files in the order they were found
+    known_files : dict
+        Path -> (size, mtime_ns) for files which do not need to be stat-ed again
+
+    Returns
+    ----------
+    rows : list
+        Tuple of values in the order of FILE_COLUMNS for each data path
+    """
+    if not known_files:
+        known_files = {}
+    catalog_dates = get_catalog_dates_from_data_paths(data_paths)
+    return [
+        make_file_row(
+            data_path, crawl_order, *catalog_dates[crawl_order], known_files.get(data_path)
+        )
+        for crawl_order, data_path in enumerate(data_paths)
+    ]
+
+
+def make_file_row(
+    data_path, crawl_order, start_date, end_date, group_key, known_size_and_mtime=None
+):
+    """
+    Make a row for the files table of the catalog
+
+    Parameters
+    ----------
+    data_path : str
+        Path to data file
+    crawl_order : int
+        Position the data file was found in the crawl
+    start_date : str
+        Start date of the file as YYYY-MM-DD (or None)
+    end_date : str
+        End date of the file as YYYY-MM-DD (or None)
+    group_key : str
+        Path without its date range (files with the same key are opened together)
+    known_size_and_mtime : tuple
+        (size, mtime_ns) if already known, otherwise the file will be stat-ed
+
+    Returns
+    ----------
+    row : tuple
+        Values in the order of FILE_COLUMNS
+    """
+    directory, file_name = os.path.split(data_path)
+    facets = get_data.get_drs_facets_from_path(data_path)
+    if known_size_and_mtime:
+        size, mtime_ns = known_size_and_mtime
+    else:
+        try:
+            stat_result = os.stat(data_path)
+            size, mtime_ns = stat_result.st_size, stat_result.st_mtime_ns
+        except OSError:
+            size, mtime_ns = None, None
+    return (
+        data_path,
+        crawl_order,
+        directory,
+        file_name,
+        group_key,
+        facets["institution"],
+        facets["model"],
+        facets["experiment"],
+        facets["member"],
+        facets["table"],
+        facets["variable"],
+        facets["grid"],
+        facets["version"],
+        start_date,
+        end_date,
+        size,
+        mtime_ns,
+    )
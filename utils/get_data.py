@@ -10,7 +10,12 @@ import glob
 import os
 import re
 import datetime
+import fnmatch
 import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
 
 #  docs
 __author__ = "Thomas Keel"
@@ -20,16 +25,37 @@ __status__ = "Development"
 
 #  globals -> TODO: this needs to be passed as an argument 
 # JASMIN_DATE_FORMAT = "%Y%m"  # YYYYMM for SSP585
-# JASMIN_DATE_RANGE_PATTERN = r"\d{6}-\d{6}" # for SSP585
 
 JASMIN_DATE_FORMAT = "%Y%m%d"  # YYYYMMDD
-JASMIN_DATE_RANGE_PATTERN = r"\d{8}-\d{8}"
+
+#  date range pattern in file names for each supported JASMIN_DATE_FORMAT
+JASMIN_DATE_RANGE_PATTERNS = {
+    "%Y%m%d": r"\d{8}-\d{8}",  # YYYYMMDD
+    "%Y%m": r"\d{6}-\d{6}",  # YYYYMM for SSP585
+}
+#  date range and extension at the end of a file name in any of JASMIN_DATE_RANGE_PATTERNS
+FILE_NAME_DATE_RANGE_PATTERN = r"_(%s)\.nc$" % ("|".join(JASMIN_DATE_RANGE_PATTERNS.values()))
 
 CAVEATS_IN_DATA = ["ua_day_CESM2_historical_r10i1p1f1_gn",\
                   "ua_day_CESM2_historical_r4i1p1f1_gn"] 
 # ua_day_CESM2_historical_r10i1p1f1_gn -> not all dates and first one
 # ua_day_CESM2_historical_r4i1p1f1_gn -> being included in CESM2-FV2 for some reason
 
+log = logging.getLogger(__name__)
+
+#  Directory levels below the activity directory (e.g. /badc/cmip6/data/CMIP6/CMIP/) in the CMIP6 DRS
+CMIP6_DRS_FACETS = [
+    "institution",
+    "model",
+    "experiment",
+    "member",
+    "table",
+    "variable",
+    "grid",
+    "version",
+]
+CRAWLER_MAX_WORKERS = 16  # number of threads listing directories at once
+
 
 class GlobDataPathRetriever:
     """
@@ -80,7 +106,9 @@ class GlobDataPathRetriever:
         if not sum(1 for _ in one_val) == 1:
             raise ValueError("No data exists in given data_directory")
 
-    def retrieve_data_paths(self, inplace=False, one_realisation=True):
+    def retrieve_data_paths(
+        self, inplace=False, one_realisation=True, use_crawler=False, max_workers=None
+    ):
         """
         Will retrieve relevant data files or paths given a root directory
         and string pattern with wildcards (using glob).
@@ -91,29 +119,26 @@ class GlobDataPathRetriever:
         ----------
         inplace : Boolean
             Will ovewrite current objects value for data_paths
+        one_realisation : Boolean
+            Will only keep the first realisation found for each model
+        use_crawler : Boolean
+            Will use ScandirDataPathCrawler to list directories level by level
+            in parallel rather than glob.iglob (same paths are returned)
+        max_workers : int
+            Number of threads used by the crawler (default: CRAWLER_MAX_WORKERS)
 
         Returns
         ----------
         data_paths : list
             List of data files from the given data directory
         """
-        #  create output list
-        data_path_iterator = glob.iglob(self.pathname)
-        data_paths = []
-        if one_realisation: # TODO: move to new func
-            run_models_list = [] 
-        for data_file in data_path_iterator:
-            file_name = data_file.split("/")[-1]
-            file_no_date = re.sub("_\d{8}-\d{8}.nc", "", file_name)
-            if file_no_date in CAVEATS_IN_DATA:
-                continue
-            if one_realisation:
-                current_model_name =  re.sub('r\d{1,2}i\d{1,2}p\d{1,2}f\d{1,2}', '', file_name)
-                if current_model_name in run_models_list:
-                    continue
-                else:
-                    run_models_list.append(current_model_name)
-            data_paths.append(data_file)
+        if use_crawler:
+            data_path_iterator = ScandirDataPathCrawler(
+                self.pathname, max_workers=max_workers
+            ).crawl()
+        else:
+            data_path_iterator = glob.iglob(self.pathname)
+        data_paths = filter_data_paths(data_path_iterator, one_realisation)
 
         #  return or overwrite
         if inplace:
@@ -161,6 +186,214 @@ class GlobDataPathRetriever:
         self.save_data_paths(new_save_filepath)
 
 
+def filter_data_paths(data_paths, one_realisation=True):
+    """
+    Removes data paths listed in CAVEATS_IN_DATA and (optionally) keeps only the
+    first realisation found for each model
+
+    Parameters
+    ----------
+    data_paths : iterable
+        Paths to data files
+    one_realisation : Boolean
+        Will only keep the first realisation found for each model
+
+    Returns
+    ----------
+    filtered_data_paths : list
+        Paths to data files in the order they were given
+    """
+    filtered_data_paths = []
+    if one_realisation:
+        run_models_list = set()
+    for data_file in data_paths:
+        file_name = data_file.split("/")[-1]
+        file_no_date = re.sub(FILE_NAME_DATE_RANGE_PATTERN, "", file_name)
+        if file_no_date in CAVEATS_IN_DATA:
+            continue
+        if one_realisation:
+            current_model_name = re.sub(r"r\d{1,2}i\d{1,2}p\d{1,2}f\d{1,2}", "", file_name)
+            if current_model_name in run_models_list:
+                continue
+            run_models_list.add(current_model_name)
+        filtered_data_paths.append(data_file)
+    return filtered_data_paths
+
+
+class ScandirDataPathCrawler:
+    """
+    Will crawl a directory tree laid out like the CMIP6 DRS
+    (i.e. institution/model/experiment/member/table/variable/grid/version, see CMIP6_DRS_FACETS)
+    for paths matching a glob pathname. Each component of the pathname is matched one
+    directory level at a time so that only matching directories are listed at the next level,
+    and the listings for each level are fanned out over a thread pool using os.scandir.
+    Returns the same paths, in the same order, as glob.iglob(pathname).
+    """
+
+    def __init__(self, pathname, max_workers=None):
+        """
+        Parameters
+        ----------
+        pathname : str
+            Path to data directory for data files search (including wildcards for glob)
+        max_workers : int
+            Number of threads used to list directories (default: CRAWLER_MAX_WORKERS)
+
+        Raises
+        ----------
+        TypeError
+            When 'pathname' is not a str
+        """
+        if not isinstance(pathname, str):
+            raise TypeError("'pathname' input needs to be string type")
+        if not max_workers:
+            max_workers = CRAWLER_MAX_WORKERS
+        self.pathname = pathname
+        self.max_workers = max_workers
+        self.root_dir, self.level_patterns = split_pathname_into_levels(pathname)
+
+    def crawl(self):
+        """
+        Will list each level of the directory tree in parallel, keeping only the entries
+        matching the pattern for that level.
+
+        Returns
+        ----------
+        data_paths : list
+            Paths matching pathname (in glob.iglob order)
+        """
+        if not self.level_patterns:
+            return [self.root_dir] if os.path.lexists(self.root_dir) else []
+
+        current_paths = [self.root_dir]
+        last_level = len(self.level_patterns) - 1
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for level_ind, level_pattern in enumerate(self.level_patterns):
+                dironly = level_ind != last_level
+                #  map keeps the order of the parent directories so output matches glob order
+                listings = executor.map(
+                    lambda directory: self._list_matching_paths(
+                        directory, level_pattern, dironly
+                    ),
+                    current_paths,
+                )
+                current_paths = [path for listing in listings for path in listing]
+                if not current_paths:
+                    break
+        return current_paths
+
+    def _list_matching_paths(self, directory, pattern, dironly):
+        """
+        Lists the entries of one directory that match a pattern (following glob's rules
+        for hidden files and literal path components)
+
+        Parameters
+        ----------
+        directory : str
+            Directory to list
+        pattern : str
+            Pattern for the names in this directory (may include wildcards)
+        dironly : Boolean
+            Will only keep entries which are directories
+
+        Returns
+        ----------
+        matching_paths : list
+            Paths in directory that match pattern
+        """
+        if not glob.has_magic(pattern):
+            path = os.path.join(directory, pattern)
+            path_exists = os.path.isdir(path) if dironly else os.path.lexists(path)
+            return [path] if path_exists else []
+        include_hidden = pattern.startswith(".")
+        matching_paths = []
+        for name, is_dir in self._scandir(directory):
+            if not include_hidden and name.startswith("."):
+                continue
+            if dironly and not is_dir:
+                continue
+            if fnmatch.fnmatch(name, pattern):
+                matching_paths.append(os.path.join(directory, name))
+        return matching_paths
+
+    def _scandir(self, directory):
+        """
+        Returns (name, is_dir) for each entry in directory (empty if it cannot be listed)
+        """
+        entries = []
+        try:
+            with os.scandir(directory or os.curdir) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    entries.append((entry.name, is_dir))
+        except OSError:
+            return []
+        return entries
+
+
+def split_pathname_into_levels(pathname):
+    """
+    Splits a glob pathname into the leading directory without wildcards and the pattern
+    for each directory level below it
+
+    Parameters
+    ----------
+    pathname : str
+        Path including wildcards for glob e.g. /badc/cmip6/data/CMIP6/CMIP/*/*/historical/r*/day/ua/*/latest/*.nc
+
+    Returns
+    ----------
+    root_dir : str
+        Leading part of pathname without wildcards
+    level_patterns : list
+        Pattern for each directory level below root_dir
+    """
+    components = [component for component in pathname.split("/") if component]
+    root_components = []
+    for component in components:
+        if glob.has_magic(component):
+            break
+        root_components.append(component)
+    level_patterns = components[len(root_components) :]
+    root_dir = "/".join(root_components)
+    if pathname.startswith("/"):
+        root_dir = "/" + root_dir
+    return root_dir, level_patterns
+
+
+def make_cmip6_drs_pathname(data_dir, file_pattern="*.nc", **facets):
+    """
+    Builds a glob pathname following the CMIP6 DRS directory layout.
+    Any facet (see CMIP6_DRS_FACETS) not given is matched with a wildcard.
+
+    Parameters
+    ----------
+    data_dir : str
+        Activity directory e.g. /badc/cmip6/data/CMIP6/CMIP/
+    file_pattern : str
+        Pattern for file names (default: '*.nc')
+    facets : str
+        Values or patterns for each DRS facet e.g. experiment='historical', member='r*'
+
+    Returns
+    ----------
+    pathname : str
+        Path including wildcards for glob or ScandirDataPathCrawler
+
+    Usage
+    ----------
+    pathname = make_cmip6_drs_pathname("/badc/cmip6/data/CMIP6/CMIP/", experiment="historical", table="day")
+    """
+    unknown_facets = set(facets).difference(CMIP6_DRS_FACETS)
+    if unknown_facets:
+        raise KeyError("%s not in CMIP6_DRS_FACETS" % (sorted(unknown_facets)))
+    drs_levels = [facets.get(facet, "*") for facet in CMIP6_DRS_FACETS]
+    return os.path.join(data_dir, *drs_levels, file_pattern)
+
+
 def check_output_file_extension(output_file_name, extension):
     """
     Parameters
@@ -196,7 +429,7 @@ class GlobDataPathRetrieverFromJASMIN(GlobDataPathRetriever):
         super().__init__(pathname, data_paths)
 
     def subset_data_paths_by_date_range(
-        self, date_range_start, date_range_end, inplace=False
+        self, date_range_start, date_range_end, inplace=False, date_format=JASMIN_DATE_FORMAT
     ):
         """
         Subsets the data path list/file by a given date range
@@ -208,6 +441,8 @@ class GlobDataPathRetrieverFromJASMIN(GlobDataPathRetriever):
             End data to subset data_paths by. Must be in JASMIN file date format (i.e. YYYYMMDD)
         inplace : Boolean
             Will ovewrite current objects value for data_paths
+        date_format : str
+            Format of dates in file names, one of JASMIN_DATE_RANGE_PATTERNS (default: JASMIN_DATE_FORMAT)
 
         Returns
         ----------
@@ -218,22 +453,10 @@ class GlobDataPathRetrieverFromJASMIN(GlobDataPathRetriever):
             raise KeyError(
                 "No 'data_paths' found yet, please add data paths to object or run '.retrieve_data_paths(inplace=True)'"
             )
-        new_data_paths = []
-        for path in self.data_paths:
-            start_date_in_range = False
-            end_date_in_range = False
-            try:
-                path_obj = FilePathFromJASMIN.with_check_file_start_end_date_in_range(
-                    path, date_range_start, date_range_end
-                )
-                start_date_in_range, end_date_in_range = (
-                    path_obj.start_date_in_range,
-                    path_obj.end_date_in_range,
-                )
-            except Exception as e:
-                print(e)
-            if start_date_in_range or end_date_in_range:
-                new_data_paths.append(path)
+        date_index = DataPathDateIndex(self.data_paths, date_format=date_format)
+        new_data_paths = date_index.get_data_paths_in_date_range(
+            date_range_start, date_range_end
+        )
 
         if inplace:
             self.data_paths = new_data_paths
@@ -282,7 +505,7 @@ class DataPathGrouperForJASMIN:
             raise TypeError("'data_paths' input needs to be list type")
         self._data_paths = data_paths
 
-    def group_data_paths(self, date_range_start, date_range_end):
+    def group_data_paths(self, date_range_start, date_range_end, date_format=JASMIN_DATE_FORMAT):
         """
         Will group data in the data path list/file in a given date range
         Parameters
@@ -291,215 +514,128 @@ class DataPathGrouperForJASMIN:
             Start date to subset data_paths by. Must be in JASMIN file date format (i.e. YYYYMMDD)
         date_range_end : int or float
             End data to subset data_paths by. Must be in JASMIN file date format (i.e. YYYYMMDD)
+        date_format : str
+            Format of dates in file names, one of JASMIN_DATE_RANGE_PATTERNS (default: JASMIN_DATE_FORMAT)
 
         Returns
         ----------
         new_data_paths : list
             Paths to data within the date range
         """
-        iterable_data_paths = iter(self.data_paths)
-        grouped_data_paths = []
-        grouped_data_paths = group_data_paths_from_iterable(
-            iterable_data_paths, grouped_data_paths, date_range_start, date_range_end
+        date_index = DataPathDateIndex(self.data_paths, date_format=date_format)
+        in_date_range = date_index.overlaps(date_range_start, date_range_end)
+        grouped_data_paths = group_data_paths_by_identity(
+            date_index, in_date_range
         )
         return grouped_data_paths
 
-        
-def group_data_paths_from_iterable(
-    data_path_iteratable,
-    output_data_paths_list,
-    date_range_start,
-    date_range_end,
-    current_grouped_data_paths=None,
-):
-    data_path_iterable_main, data_path_iterable_copy  = itertools.tee(data_path_iteratable)
-    if not current_grouped_data_paths:
-        current_grouped_data_paths = []
-    try:
-        first_data_path = next(data_path_iterable_main)
-        _ = next(data_path_iterable_copy)
-        in_date_range = check_data_path_in_date_range(
-            first_data_path, date_range_start, date_range_end
-        )
-        if in_date_range:
-            current_grouped_data_paths.append(first_data_path)
-            current_data_path_no_date = remove_date_from_path_name_JASMIN(
-                first_data_path
-            )
-            try:
-                next_data_path = next(data_path_iterable_main)
-            except StopIteration:
-                output_data_paths_list.append(current_grouped_data_paths)
-                raise StopIteration
-            next_data_path_no_date = remove_date_from_path_name_JASMIN(next_data_path)
-            to_append_to_group = (
-                difference_between_two_strings(
-                    current_data_path_no_date, next_data_path_no_date
-                )
-                == 0
-            )  
-            while to_append_to_group:
-                if check_data_path_in_date_range(
-                    next_data_path, date_range_start, date_range_end
-                ):
-                    _ = next(data_path_iterable_copy)
-                    current_grouped_data_paths.append(next_data_path)
-                try:
-                    next_data_path = next(data_path_iterable_main)
-                except StopIteration:
-                    output_data_paths_list.append(current_grouped_data_paths)
-                    raise StopIteration
-                next_data_path_no_date = remove_date_from_path_name_JASMIN(
-                    next_data_path
-                )
-                to_append_to_group = (
-                    difference_between_two_strings(
-                        current_data_path_no_date, next_data_path_no_date
-                    )
-                    == 0
-                )
-            output_data_paths_list.append(current_grouped_data_paths)
-            current_grouped_data_paths = []
-        return group_data_paths_from_iterable(
-            data_path_iterable_copy,
-            output_data_paths_list,
-            date_range_start,
-            date_range_end,
-            current_grouped_data_paths=current_grouped_data_paths,
-        )
-    except StopIteration:
-        return output_data_paths_list
-
 
-def remove_date_from_path_name_JASMIN(path_name):
-    date_range = re.findall(pattern=JASMIN_DATE_RANGE_PATTERN, string=path_name)
-    path_name_w_removed_date = path_name.replace(date_range[0], "")
-    return path_name_w_removed_date
+def group_data_paths_by_identity(date_index, in_date_range):
+    """
+    Will group data paths in a single pass using their path without the date range
+    (i.e. the same model, member, grid etc.) as a dictionary key
 
+    Parameters
+    ----------
+    date_index : DataPathDateIndex
+        Data paths and their start and end dates
+    in_date_range : numpy.ndarray
+        Boolean array of which data paths to include (e.g. from DataPathDateIndex.overlaps)
 
-def difference_between_two_strings(seq1, seq2):
+    Returns
+    ----------
+    grouped_data_paths : list
+        List of lists of paths, each sorted by start date, in the order each group is first found
     """
-    https://stackoverflow.com/questions/28423448/counting-differences-between-two-strings
+    date_range_pattern = re.compile(JASMIN_DATE_RANGE_PATTERNS[date_index.date_format])
+    start_dates = date_index.start_dates.astype(numpy.int64)
+    groups = {}
+    for ind in numpy.flatnonzero(in_date_range):
+        data_path = date_index.data_paths[ind]
+        data_path_no_date = date_range_pattern.sub("", data_path, count=1)
+        groups.setdefault(data_path_no_date, []).append(ind)
+
+    grouped_data_paths = []
+    for group_inds in groups.values():
+        group_inds.sort(key=lambda ind: start_dates[ind])
+        grouped_data_paths.append([date_index.data_paths[ind] for ind in group_inds])
+    return grouped_data_paths
+
+
+def get_drs_facets_from_path(path_name):
     """
-    count = 0
-    for i in range(len(seq1)):
-        try:
-            if seq1[i] != seq2[i]:
-                count += 1
-        except IndexError:
-            break
-    return count
+    Gets the CMIP6 DRS facets (see CMIP6_DRS_FACETS) from the directories above a data file
 
+    Parameters
+    ----------
+    path_name : str
+        Path to data file e.g. /badc/cmip6/data/CMIP6/CMIP/<institution>/<model>/.../<version>/<file>
 
-def check_data_path_in_date_range(data_path_name, date_range_start, date_range_end):
-    fp = FilePathFromJASMIN.with_check_file_start_end_date_in_range(
-        data_path_name,
-        date_range_start,
-        date_range_end,
-    )
-    return fp.start_date_in_range or fp.end_date_in_range
+    Returns
+    ----------
+    facets : dict
+        Value of each DRS facet (None if the path is too short to contain it)
+    """
+    directories = path_name.split("/")[:-1]
+    drs_directories = directories[-len(CMIP6_DRS_FACETS) :]
+    drs_directories = [None] * (
+        len(CMIP6_DRS_FACETS) - len(drs_directories)
+    ) + drs_directories
+    return dict(zip(CMIP6_DRS_FACETS, drs_directories))
 
 
-class FilePathFromJASMIN:
+class DataPathDateIndex:
     """
-    File path from NERC's JASMIN supercomputer with methods to check for whether it exists, its size, and subsetting options
+    Start and end dates of a list of data paths (from JASMIN file names) parsed all at once
+    into numpy.datetime64 arrays, so a whole list can be checked against a date range
+    in one vectorised expression
     """
 
-    def __init__(self, file_name):
-        """
-        Parameters
-        ----------
-        file_name : str
-            Name of file or filepath to extract start and end date from
-        """
-        self.file_name = file_name
-        self.file_dir, self.file_name = self._split_path_from_file()
-
-    @classmethod
-    def with_start_end_date_values(cls, file_name):
-        """
-        Extracts start and end date values from file in JASMIN file format (i.e. YYYYMMDD)
-
-        Parameters
-        ----------
-        file_name : str
-            Name of file or filepath to extract start and end date from
-        """
-        obj = cls(file_name)
-        obj.start_date, obj.end_date = obj.get_start_end_date_from_file_name()
-        return obj
-
-    @classmethod
-    def with_check_file_start_end_date_in_range(
-        cls, file_name, date_range_start, date_range_end
-    ):
+    def __init__(self, data_paths, date_format=JASMIN_DATE_FORMAT):
         """
-        Extracts start and end values from file and checks if these are within a given date range in JASMIN file format (i.e. YYYYMMDD)
-
         Parameters
         ----------
-        file_name : str
-            Name of file or filepath to extract start and end date from
-        date_range_start : str or datetime.datetime
-            Start date of date range
-        date_range_end : str or datetime.datetime
-            End date of date range
-
-        Returns
-        ----------
-        obj : FilePathFromJASMIN
-            File path object with start_date_in_range and end_date_in_range values
-
-        """
-        obj = cls(file_name)
-        obj.start_date, obj.end_date = obj.get_start_end_date_from_file_name()
-        (
-            obj.start_date_in_range,
-            obj.end_date_in_range,
-        ) = obj.check_file_start_end_date_in_range(date_range_start, date_range_end)
-        return obj
-
-    def _split_path_from_file(self):
-        """
-        Will split file path from file name if necessary
+        data_paths : list
+            Paths to data files with a date range in the file name (i.e. YYYYMMDD-YYYYMMDD)
+        date_format : str
+            Format of dates in file names, one of JASMIN_DATE_RANGE_PATTERNS (default: JASMIN_DATE_FORMAT)
 
-        Returns
+        Raises
         ----------
-        file_dir : str
-            Directory where the file is located
-        file_name : str
-            File name with out the directory
+        ValueError
+            When 'date_format' is not in JASMIN_DATE_RANGE_PATTERNS
         """
-        file_dir, file_name = os.path.split(self.file_name)
-        return file_dir, file_name
-
-    def get_start_end_date_from_file_name(self):
-        """
-        Get the start and end date from a filename.
-        Format is specific to how data is stored in /badc/cmip6 on NERC's JASMIN supercomputer
-
-        Returns
-        ----------
-        start_date : datetime.datetime
-            Start datetime in filename
-        end_date : datetime.datetime
-            End datetime in filename
-        """
-        #  Find all date_date pattern
-        date_range = re.findall(
-            pattern=JASMIN_DATE_RANGE_PATTERN, string=self.file_name
+        if date_format not in JASMIN_DATE_RANGE_PATTERNS:
+            raise ValueError(
+                "'date_format' needs to be one of %s" % (list(JASMIN_DATE_RANGE_PATTERNS))
+            )
+        self.data_paths = list(data_paths)
+        self.date_format = date_format
+        self.start_dates, self.end_dates = get_start_end_dates_from_data_paths(
+            self.data_paths, date_format
         )
-        assert (
-            len(date_range) == 1
-        ), "Only one start and end date required in filename and needs to be in the style of 00000000-00000000"
+        invalid_dates = numpy.isnat(self.start_dates) | numpy.isnat(self.end_dates)
+        self.invalid_data_paths = [
+            self.data_paths[ind] for ind in numpy.flatnonzero(invalid_dates)
+        ]
+        if self.invalid_data_paths:
+            log.warning(
+                "Cannot get start and end date from %s data paths e.g. %s"
+                % (len(self.invalid_data_paths), self.invalid_data_paths[0])
+            )
+
+    def __len__(self):
+        return len(self.data_paths)
 
-        #  Get startdate and enddate from date_range
-        start_date, end_date = date_range[0].split("-")
-        return start_date, end_date
+    def _convert_date_range(self, date_range_start, date_range_end):
+        date_range_start = convert_to_datetime64(date_range_start, self.date_format)
+        date_range_end = convert_to_datetime64(date_range_end, self.date_format)
+        return date_range_start, date_range_end
 
-    def check_file_start_end_date_in_range(self, date_range_start, date_range_end):
+    def overlaps(self, date_range_start, date_range_end):
         """
-        Checks if the given file is within a given date range in JASMIN file format (i.e. YYYYMMDD)
+        Whether the start date or end date of each file is in a date range,
+        or the file covers the whole date range
 
         Parameters
         ----------
@@ -508,65 +644,28 @@ class FilePathFromJASMIN:
         date_range_end : str or datetime.datetime
             End date of date range
 
-        Return
-        ---------
-        start_date_in_range : Boolean
-            Whether or not start date is within given date range
-        end_date_in_range : Boolean
-            Whether or not end date is within given date range
+        Returns
+        ----------
+        in_date_range : numpy.ndarray
+            Boolean array with one value per data path (False if the dates could not be parsed)
         """
-        if not hasattr(self, "start_date") and not hasattr(self, "end_date"):
-            raise KeyError(
-                "'start_date' and 'end_date' not found in object. Please run '.get_start_end_date_from_file_name()'"
-            )
-
-        start_date_in_range = self._check_file_start_date_in_range(
+        date_range_start, date_range_end = self._convert_date_range(
             date_range_start, date_range_end
         )
-        end_date_in_range = self._check_file_end_date_in_range(
-            date_range_start, date_range_end
+        start_date_in_range = (self.start_dates >= date_range_start) & (
+            self.start_dates <= date_range_end
         )
-        
-        if self._check_file_start_and_end_range_is_in_range(
-            date_range_start, date_range_end
-        ):
-            ##  Will overwrite the values if the range is includes the range the func is looking for
-            start_date_in_range = True
-            end_date_in_range = True
-        
-        return start_date_in_range, end_date_in_range
-    def _check_file_start_date_in_range(self, date_range_start, date_range_end):
-        """
-        Checks if the start date in a given file is within a given date range in JASMIN file format (i.e. YYYYMMDD)
-
-        Parameters
-        ----------
-        date_range_start : str or datetime.datetime
-            Start date of date range
-        date_range_end : str or datetime.datetime
-            End date of date range
-
-        Return
-        ---------
-        start_date_in_range : Boolean
-            Whether or not start date is within given date range
-        """
-        if not hasattr(self, "start_date"):
-            raise KeyError(
-                "'start_date' not found in object. Please run '.get_start_end_date_from_file_name()'"
-            )
-
-        start_date_in_range = check_date_in_range(
-            self.start_date,
-            date_range_start,
-            date_range_end,
-            date_format=JASMIN_DATE_FORMAT,
+        end_date_in_range = (self.end_dates >= date_range_start) & (
+            self.end_dates <= date_range_end
+        )
+        covers_range = (self.start_dates <= date_range_start) & (
+            self.end_dates >= date_range_end
         )
-        return start_date_in_range
+        return start_date_in_range | end_date_in_range | covers_range
 
-    def _check_file_end_date_in_range(self, date_range_start, date_range_end):
+    def contained_in(self, date_range_start, date_range_end):
         """
-        Checks if the end date in a given file is within a given date range in JASMIN file format (i.e. YYYYMMDD)
+        Whether each file starts and ends within a date range
 
         Parameters
         ----------
@@ -575,108 +674,139 @@ class FilePathFromJASMIN:
         date_range_end : str or datetime.datetime
             End date of date range
 
-        Return
-        ---------
-        end_date_in_range : Boolean
-            Whether or not start date is within given date range
+        Returns
+        ----------
+        in_date_range : numpy.ndarray
+            Boolean array with one value per data path (False if the dates could not be parsed)
         """
-        if not hasattr(self, "end_date"):
-            raise KeyError(
-                "'end_date' not found in object. Please run '.get_start_end_date_from_file_name()'"
-            )
-
-        end_date_in_range = check_date_in_range(
-            self.end_date,
-            date_range_start,
-            date_range_end,
-            date_format=JASMIN_DATE_FORMAT,
+        date_range_start, date_range_end = self._convert_date_range(
+            date_range_start, date_range_end
+        )
+        return (self.start_dates >= date_range_start) & (
+            self.end_dates <= date_range_end
         )
-        return end_date_in_range
 
-    def _check_file_start_and_end_range_is_in_range(self, date_range_start, date_range_end):
+    def get_data_paths_in_date_range(self, date_range_start, date_range_end):
         """
-        Checks if the start date and end date passes over the range in a given file is within a given date range in JASMIN file format
-
-        Parameters
-        ----------
-        date_range_start : str or datetime.datetime
-            Start date of date range
-        date_range_end : str or datetime.datetime
-            End date of date range
-
-        Return
-        ---------
-        start_date_in_range : Boolean
-            Whether or not start date is within given date range
+        Data paths (in the order given) where the file overlaps a date range (see overlaps)
         """
-        if not hasattr(self, "start_date"):
-            raise KeyError(
-                "'start_date' not found in object. Please run '.get_start_end_date_from_file_name()'"
-            )
+        in_date_range = self.overlaps(date_range_start, date_range_end)
+        return [self.data_paths[ind] for ind in numpy.flatnonzero(in_date_range)]
 
-        if not hasattr(self, "end_date"):
-            raise KeyError(
-                "'end_date' not found in object. Please run '.get_start_end_date_from_file_name()'"
-            )
-        
-        date_format=JASMIN_DATE_FORMAT
-        start_date = convert_to_datetime_no_error(self.start_date, date_format)
-        end_date = convert_to_datetime_no_error(self.end_date, date_format)
-        date_range_start = convert_to_datetime_no_error(date_range_start, date_format)
-        date_range_end = convert_to_datetime_no_error(date_range_end, date_format)
-        
-        if start_date <= date_range_start and end_date >= date_range_end:
-            return True
-        else:
-            return False
-            
 
-def check_date_in_range(date_to_check, date_range_start, date_range_end, date_format):
+def get_start_end_dates_from_data_paths(data_paths, date_format=JASMIN_DATE_FORMAT):
     """
+    Get the start and end date of each data path from the date range in its file name
+
     Parameters
     ----------
-    date_to_check : str or datetime.datetime
-        Date to check if within range
-    date_range_start : str or datetime.datetime
-        Start date of date range
-    date_range_end : str or datetime.datetime
-        End date of date range
+    data_paths : list
+        Paths to data files with a date range in the file name (i.e. YYYYMMDD-YYYYMMDD)
     date_format : str
-        Format of date for datetime.datetime.strptime
+        Format of dates in file names, one of JASMIN_DATE_RANGE_PATTERNS (default: JASMIN_DATE_FORMAT)
 
     Returns
     ----------
-    output : boolean
-        True or False if date is in range given
-    """
-    #  Convert to datetime
-    date_to_check = convert_to_datetime_no_error(date_to_check, date_format)
-    date_range_start = convert_to_datetime_no_error(date_range_start, date_format)
-    date_range_end = convert_to_datetime_no_error(date_range_end, date_format)
-
-    #  Check all can be used for date range comparison
-    if not all([date_to_check, date_range_start, date_range_end]):
-        raise ValueError("Some dates could not be converted to datetime")
-    if date_to_check >= date_range_start and date_to_check <= date_range_end:
-        return True
+    start_dates : numpy.ndarray
+        datetime64[D] start dates (NaT where the file name has no valid date range)
+    end_dates : numpy.ndarray
+        datetime64[D] end dates (NaT where the file name has no valid date range)
+    """
+    date_range_pattern = re.compile(JASMIN_DATE_RANGE_PATTERNS[date_format])
+    n_digits = len(
+        date_format.replace("%Y", "YYYY").replace("%m", "MM").replace("%d", "DD")
+    )
+    n_chars = 2 * n_digits + 1
+    #  the date range is usually at the end of the file name i.e. ..._gn_19500101-19591231.nc
+    date_ranges = [data_path[-n_chars - 3 : -3] for data_path in data_paths]
+    digits = get_digits_from_date_ranges(date_ranges, n_chars)
+    #  fall back to searching the whole file name with a regex if not
+    for ind in numpy.flatnonzero(~check_digits_are_date_range(digits, n_digits)):
+        file_name = data_paths[ind].rsplit("/", 1)[-1]
+        found_date_ranges = date_range_pattern.findall(file_name)
+        if len(found_date_ranges) == 1:
+            digits[ind] = get_digits_from_date_ranges(found_date_ranges, n_chars)[0]
+    digits[~check_digits_are_date_range(digits, n_digits)] = 0
+    start_dates = convert_digits_to_datetime64(digits[:, :n_digits])
+    end_dates = convert_digits_to_datetime64(digits[:, n_digits + 1 :])
+    return start_dates, end_dates
+
+
+def get_digits_from_date_ranges(date_ranges, n_chars):
+    """
+    Views each character of each date range (e.g. '19500101-19591231') as an integer
+    (digits become 0-9) so all date ranges can be parsed at once. Date ranges that are
+    not n_chars long are returned as -1.
+    """
+    wrong_length = numpy.array(
+        [len(date_range) != n_chars for date_range in date_ranges], dtype=bool
+    )
+    digits = (
+        numpy.array(date_ranges, dtype="U%s" % (n_chars))
+        .view(numpy.uint32)
+        .reshape(len(date_ranges), n_chars)
+        .astype(numpy.int64)
+        - ord("0")
+    )
+    digits[wrong_length] = -1
+    return digits
+
+
+def check_digits_are_date_range(digits, n_digits):
+    """
+    Whether each row of digits (from get_digits_from_date_ranges) is a date range
+    i.e. n_digits digits, '-', n_digits digits
+    """
+    is_digit = (digits >= 0) & (digits <= 9)
+    is_digit[:, n_digits] = digits[:, n_digits] == ord("-") - ord("0")
+    return is_digit.all(axis=1)
+
+
+def convert_digits_to_datetime64(digits):
+    """
+    Converts an array of YYYYMMDD or YYYYMM digits (one row per date) to datetime64[D]
+    Invalid dates (e.g. month 13 or 31st of June) become NaT
+    """
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    if digits.shape[1] == 8:
+        day = digits[:, 6] * 10 + digits[:, 7]
     else:
-        return False
+        day = numpy.ones_like(year)
+    valid = (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1)
+    month_start = (year - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (
+        numpy.clip(month, 1, 12) - 1
+    )
+    days_in_month = (month_start + 1).astype("datetime64[D]") - month_start.astype(
+        "datetime64[D]"
+    )
+    valid &= day <= days_in_month.astype(numpy.int64)
+    dates = month_start.astype("datetime64[D]") + (day - 1)
+    dates[~valid] = numpy.datetime64("NaT")
+    return dates
 
 
-def convert_to_datetime_no_error(date, date_format):
+def convert_to_datetime64(date, date_format):
     """
-    Convert date to datetime without throwing error
+    Convert a date to numpy.datetime64
+
     Parameters
     ----------
-    date : str or datetime.datetime
+    date : str or datetime.datetime or numpy.datetime64
         Date to convert
     date_format : str
         Format of date for datetime.datetime.strptime
+
+    Raises
+    ----------
+    ValueError
+        When date cannot be converted
     """
+    if isinstance(date, numpy.datetime64):
+        return date
     if not isinstance(date, datetime.datetime):
         try:
-            date = datetime.datetime.strptime(date, date_format)
-        except Exception as e:
-            print("Cannot convert %s to datetime.datetime" % (date), e)
-            return
-    return date
+            date = datetime.datetime.strptime(str(date), date_format)
+        except ValueError as e:
+            raise ValueError("Cannot convert %s to datetime.datetime: %s" % (date, e))
+    return numpy.datetime64(date)
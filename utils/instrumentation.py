@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Timing of each stage of a run (i.e. opening data, subsetting, running and saving each metric).
+    Each stage is saved as a line of JSON (one file per process, so workers never share a file)
+    with its wall time, CPU time and bytes read. The events can be exported as a Chrome trace
+    (open in chrome://tracing or https://ui.perfetto.dev) or summarised by model and metric.
+    The peak memory of each stage is recorded too (see utils.memory_usage), and can be collected
+    for a group without tracing (see collect_peak_memory).
+"""
+
+#  imports
+import collections
+import contextlib
+import contextvars
+import glob
+import json
+import os
+import socket
+import threading
+import time
+
+from utils import memory_usage
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+#  set by start_tracing so worker processes (which inherit the environment) record stages too
+TRACE_DIR_ENV_VAR = "JSMETRICS_TRACE_DIR"
+EVENTS_FILE_NAME = "events-%s-%s.jsonl"  # % (host name, pid)
+CHROME_TRACE_FILE_NAME = "trace.json"
+PROC_IO_FILE = "/proc/self/io"
+
+#  stages summarised by summarise_events (other stages are nested inside these)
+GROUP_STAGE = "group"
+METRIC_STAGES = ["subset", "derive", "run metric", "save"]
+
+#  context variables so threads running different groups at once (see utils.pipeline) each
+#  have their own. Threads start without them (copy_context().run passes them to a thread)
+_context = contextvars.ContextVar("stage_context", default={})  # attributes added to every stage recorded (see stage_context)
+_peak_memory_record = contextvars.ContextVar("peak_memory_record", default=None)  # filled by stages inside collect_peak_memory
+_peak_memory_record_lock = threading.Lock()  # stages may end in several threads at once
+
+
+def start_tracing(trace_dir):
+    """
+    Records stages in this process and any worker processes started after it to trace_dir
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+    os.environ[TRACE_DIR_ENV_VAR] = os.path.abspath(trace_dir)
+
+
+def stop_tracing():
+    os.environ.pop(TRACE_DIR_ENV_VAR, None)
+
+
+def get_trace_dir():
+    return os.environ.get(TRACE_DIR_ENV_VAR)
+
+
+@contextlib.contextmanager
+def stage_context(**attributes):
+    """
+    Adds attributes (e.g. group and model) to every stage recorded inside this context
+    """
+    token = _context.set(dict(_context.get(), **attributes))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+@contextlib.contextmanager
+def collect_peak_memory(peak_memory_record=None):
+    """
+    Collects the highest peak memory of each stage (and metric) recorded inside this context,
+    whether or not tracing has been started
+
+    Parameters
+    ----------
+    peak_memory_record : dict
+        Record to add to (i.e. from an earlier stage of the same group run in another thread)
+        instead of starting a new one
+
+    Yields
+    ----------
+    peak_memory_record : dict
+        'stages' and 'metrics' with the peak RSS and peak traced memory (MB) of each, and
+        attributes added with add_to_peak_memory_record
+    """
+    if peak_memory_record is None:
+        peak_memory_record = {"stages": {}, "metrics": {}}
+    token = _peak_memory_record.set(peak_memory_record)
+    try:
+        yield peak_memory_record
+    finally:
+        _peak_memory_record.reset(token)
+
+
+def add_to_peak_memory_record(**attributes):
+    """
+    Adds attributes (e.g. the size of the data) to the record of collect_peak_memory (if collecting)
+    """
+    peak_memory_record = _peak_memory_record.get()
+    if peak_memory_record is not None:
+        peak_memory_record.update(attributes)
+
+
+@contextlib.contextmanager
+def time_stage(stage, **attributes):
+    """
+    Records the wall time, CPU time (of all threads in this process), bytes read and peak
+    memory of the code inside this context. Does nothing unless start_tracing has been called
+    or the stage is inside collect_peak_memory.
+
+    Parameters
+    ----------
+    stage : str
+        Name of stage e.g. 'subset'
+    **attributes
+        Added to the event e.g. metric="Woollings et al. 2010"
+
+    Yields
+    ----------
+    event_attributes : dict
+        Attributes of the event which can be added to inside the context (e.g. output size)
+    """
+    trace_dir = get_trace_dir()
+    event_attributes = dict(_context.get(), **attributes)
+    peak_memory_record = _peak_memory_record.get()
+    if trace_dir is None and peak_memory_record is None:
+        yield event_attributes
+        return
+    start_time_ns = time.time_ns()
+    start_cpu_time = time.process_time()
+    start_bytes_read = get_bytes_read()
+    memory_usage.start_peak_tracking()
+    try:
+        yield event_attributes
+    except BaseException as e:
+        event_attributes["error"] = repr(e)
+        raise
+    finally:
+        peak_rss, peak_traced = memory_usage.end_peak_tracking()
+        if peak_memory_record is not None:
+            record_peak_memory(
+                peak_memory_record, stage, event_attributes.get("metric"), peak_rss, peak_traced
+            )
+        end_bytes_read = get_bytes_read()
+        event = {
+            "stage": stage,
+            "start_ns": start_time_ns,
+            "wall_time": (time.time_ns() - start_time_ns) / 1e9,
+            "cpu_time": time.process_time() - start_cpu_time,
+            "bytes_read": (
+                end_bytes_read - start_bytes_read
+                if start_bytes_read is not None and end_bytes_read is not None
+                else None
+            ),
+            "peak_rss": peak_rss,
+            "peak_traced": peak_traced,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        event.update(event_attributes)
+        if trace_dir is not None:
+            write_event(event, trace_dir)
+
+
+def record_peak_memory(peak_memory_record, stage, metric, peak_rss, peak_traced):
+    with _peak_memory_record_lock:
+        peak_memory_records = [peak_memory_record["stages"].setdefault(stage, [None, None])]
+        if metric is not None:
+            peak_memory_records.append(
+                peak_memory_record["metrics"].setdefault(metric, [None, None])
+            )
+        for peaks in peak_memory_records:
+            memory_usage.update_peaks(peaks, [peak_rss, peak_traced])
+
+
+def write_event(event, trace_dir):
+    events_file = os.path.join(
+        trace_dir, EVENTS_FILE_NAME % (socket.gethostname(), os.getpid())
+    )
+    with open(events_file, "a") as events:
+        events.write(json.dumps(event, default=str) + "\n")
+
+
+def get_bytes_read():
+    """
+    Bytes this process has read so far (from /proc/self/io 'rchar', so includes reads
+    from the page cache). None when not available (i.e. not on Linux)
+    """
+    try:
+        with open(PROC_IO_FILE, "r") as proc_io:
+            for line in proc_io:
+                if line.startswith("rchar:"):
+                    return int(line.split(":")[1])
+    except OSError:
+        return None
+    return None
+
+
+def load_events(trace_dir):
+    """
+    Events of every process in trace_dir (and its subdirectories, i.e. shards)
+
+    Returns
+    ----------
+    events : list
+        Dict of each event sorted by start time
+    """
+    events = []
+    events_files = glob.glob(
+        os.path.join(trace_dir, "**", EVENTS_FILE_NAME % ("*", "*")), recursive=True
+    )
+    for events_file in events_files:
+        with open(events_file, "r") as events_lines:
+            for line in events_lines:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue  # last line of a process that was killed mid write
+    return sorted(events, key=lambda event: event["start_ns"])
+
+
+def write_chrome_trace(events, trace_file_path):
+    """
+    Writes events in the Chrome trace event format, with one row per process and thread
+    """
+    trace_events = []
+    for event in events:
+        name = event["stage"]
+        if "metric" in event:
+            name = "%s: %s" % (name, event["metric"])
+        elif "group" in event and event["stage"] == GROUP_STAGE:
+            name = "%s: %s" % (name, event["group"])
+        trace_events.append(
+            {
+                "name": name,
+                "cat": event["stage"],
+                "ph": "X",
+                "ts": event["start_ns"] / 1e3,
+                "dur": event["wall_time"] * 1e6,
+                "pid": event["pid"],
+                "tid": event["tid"],
+                "args": {
+                    key: value
+                    for key, value in event.items()
+                    if key not in ["stage", "start_ns", "pid", "tid"]
+                },
+            }
+        )
+    with open(trace_file_path, "w") as trace_file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+    return trace_file_path
+
+
+def summarise_events(events, by, stages):
+    """
+    Total wall time, CPU time and bytes read of events grouped by an attribute
+
+    Parameters
+    ----------
+    events : list
+        From load_events
+    by : str
+        Attribute to group events by e.g. 'model' or 'metric'
+    stages : list
+        Stages to include (so nested stages are not counted twice)
+
+    Returns
+    ----------
+    summary : list
+        (value of 'by', number of events, wall time, CPU time, bytes read) sorted by
+        wall time (slowest first)
+    """
+    totals = collections.defaultdict(lambda: [0, 0.0, 0.0, 0])
+    for event in events:
+        if event["stage"] not in stages or by not in event:
+            continue
+        total = totals[event[by]]
+        total[0] += 1
+        total[1] += event["wall_time"]
+        total[2] += event["cpu_time"]
+        total[3] += event["bytes_read"] or 0
+    return sorted(
+        [(key,) + tuple(total) for key, total in totals.items()],
+        key=lambda row: row[2],
+        reverse=True,
+    )
+
+
+def make_summary_text(events, n_rows=10):
+    """
+    Slowest models, groups, metrics and stages as text tables
+    """
+    tables = [
+        ("model", [GROUP_STAGE]),
+        ("group", [GROUP_STAGE]),
+        ("metric", METRIC_STAGES),
+        ("stage", sorted(set(event["stage"] for event in events) - {GROUP_STAGE})),
+    ]
+    lines = []
+    for by, stages in tables:
+        summary = summarise_events(events, by, stages)
+        if not summary:
+            continue
+        lines.append("Slowest %ss (%s):" % (by, ", ".join(stages)))
+        lines.append(
+            "  %-60s %6s %10s %10s %10s" % (by, "count", "wall (s)", "cpu (s)", "read (MB)")
+        )
+        for key, count, wall_time, cpu_time, bytes_read in summary[:n_rows]:
+            lines.append(
+                "  %-60s %6s %10.1f %10.1f %10.1f"
+                % (key[:60], count, wall_time, cpu_time, bytes_read / 1e6)
+            )
+        lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Peak memory of each stage of a group (from the kernel's RSS high-water mark and, optionally,
+    tracemalloc, which numpy reports its array allocations to), saved as one JSON record per group
+    next to the outputs. A report relates the peaks to the grid size and time length of each group
+    and recommends a SLURM --mem value and memory classes of groups for future jobs.
+"""
+
+#  imports
+import glob
+import json
+import math
+import os
+import threading
+import tracemalloc
+
+import numpy
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+PROC_STATUS_FILE = "/proc/self/status"
+PROC_CLEAR_REFS_FILE = "/proc/self/clear_refs"  # writing "5" resets VmHWM (Linux 4.0+)
+MEMORY_USAGE_DIR = "memory_usage"  # records of each group are saved in [output path]/memory_usage/
+MEMORY_REPORT_FILE_NAME = "memory_report.json"
+
+MEMORY_HEADROOM = 0.2  # fraction added to peaks when recommending memory
+MAIN_PROCESS_MEMORY = 4000  # MB kept for the main process (same as run_cmip6_historical_npac)
+MEMORY_CLASS_BOUNDS = [4000, 8000, 16000, 32000, 64000, 128000, 256000]  # MB per worker of each memory class
+
+#  [peak RSS, peak traced] (MB) of each stage being tracked by each thread of this process (innermost last)
+_peak_stacks = {}
+_peak_lock = threading.Lock()
+
+
+def read_proc_status_mb(field):
+    """
+    Value of a kB field of /proc/self/status (e.g. 'VmRSS') in MB. None when not available
+    """
+    try:
+        with open(PROC_STATUS_FILE, "r") as proc_status:
+            for line in proc_status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def get_rss():
+    return read_proc_status_mb("VmRSS")
+
+
+def get_peak_rss():
+    """
+    Highest RSS (MB) since the peak was last reset (or since the process started)
+    """
+    return read_proc_status_mb("VmHWM")
+
+
+def reset_peak_rss():
+    """
+    Sets the RSS high-water mark to the current RSS
+
+    Returns
+    ----------
+    reset : bool
+        False if it cannot be reset, so get_peak_rss is the peak of the whole process
+    """
+    try:
+        with open(PROC_CLEAR_REFS_FILE, "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def start_tracing_allocations():
+    """
+    Traces Python (and numpy) allocations in this process so stages record a peak traced memory
+    too. Slows down code making many small Python objects.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def get_traced():
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0] / 1024**2
+
+
+def get_peak_traced():
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[1] / 1024**2
+
+
+def start_peak_tracking():
+    """
+    Starts tracking the peak memory of a stage. Stages can be nested (the peaks of a stage
+    include the stages inside it) and tracked from several threads at once, in which case the
+    peak is of the whole process so includes the stages running in other threads.
+    """
+    with _peak_lock:
+        #  the peak so far is kept by every stage being tracked before it is reset
+        peaks = [get_peak_rss(), get_peak_traced()]
+        for peak_stack in _peak_stacks.values():
+            if peak_stack:
+                update_peaks(peak_stack[-1], peaks)
+        reset_peak_rss()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        _peak_stacks.setdefault(threading.get_ident(), []).append([get_rss(), get_traced()])
+
+
+def end_peak_tracking():
+    """
+    Returns
+    ----------
+    peaks : list
+        Peak RSS and peak traced memory (MB, None when not available) since the matching
+        start_peak_tracking
+    """
+    with _peak_lock:
+        peak_stack = _peak_stacks[threading.get_ident()]
+        peaks = peak_stack.pop()
+        update_peaks(peaks, [get_peak_rss(), get_peak_traced()])
+        if peak_stack:
+            update_peaks(peak_stack[-1], peaks)
+        else:
+            del _peak_stacks[threading.get_ident()]
+    return peaks
+
+
+def update_peaks(peaks, new_peaks):
+    for ind, new_peak in enumerate(new_peaks):
+        if new_peak is not None and (peaks[ind] is None or new_peak > peaks[ind]):
+            peaks[ind] = new_peak
+
+
+def get_data_sizes(data):
+    """
+    Time length, grid size and bytes of opened (not loaded) data for a memory record
+    """
+    sizes = {
+        "n_time": data.sizes.get("time"),
+        "n_lat": data.sizes.get("lat", data.sizes.get("latitude")),
+        "n_lon": data.sizes.get("lon", data.sizes.get("longitude")),
+        "n_plev": data.sizes.get("plev"),
+        "data_nbytes": data.nbytes,
+    }
+    sizes["n_grid_points"] = int(
+        numpy.prod([sizes[dim] or 1 for dim in ["n_lat", "n_lon", "n_plev"]])
+    )
+    return sizes
+
+
+def save_memory_record(memory_record, output_path, group_name):
+    """
+    Saves the memory record of a group to [output_path]/memory_usage/[group_name].json
+    """
+    memory_usage_path = os.path.join(output_path, MEMORY_USAGE_DIR)
+    os.makedirs(memory_usage_path, exist_ok=True)
+    record_file_path = os.path.join(memory_usage_path, group_name + ".json")
+    temp_file_path = "%s.%s.tmp" % (record_file_path, os.getpid())
+    with open(temp_file_path, "w") as record_file:
+        json.dump(memory_record, record_file, indent=1, default=str)
+    os.replace(temp_file_path, record_file_path)
+    return record_file_path
+
+
+def load_memory_records(output_path):
+    memory_records = []
+    for record_file_path in sorted(
+        glob.glob(os.path.join(output_path, MEMORY_USAGE_DIR, "*.json"))
+    ):
+        with open(record_file_path, "r") as record_file:
+            memory_records.append(json.load(record_file))
+    return memory_records
+
+
+def recommend_mem(peak_memory_per_worker, n_workers, headroom=MEMORY_HEADROOM):
+    """
+    SLURM --mem (MB, rounded up to 1000) for n_workers with this peak each plus the main process
+    """
+    return int(
+        math.ceil(
+            (peak_memory_per_worker * (1 + headroom) * n_workers + MAIN_PROCESS_MEMORY)
+            / 1000
+        )
+        * 1000
+    )
+
+
+def get_memory_class_bound(peak_memory, headroom=MEMORY_HEADROOM):
+    """
+    Smallest bound in MEMORY_CLASS_BOUNDS with room for peak_memory (None if over all of them)
+    """
+    for bound in MEMORY_CLASS_BOUNDS:
+        if peak_memory * (1 + headroom) <= bound:
+            return bound
+    return None
+
+
+def get_correlation(values, other_values):
+    values = numpy.asarray(values, dtype=float)
+    other_values = numpy.asarray(other_values, dtype=float)
+    if values.size < 2 or values.std() == 0 or other_values.std() == 0:
+        return None
+    return float(numpy.corrcoef(values, other_values)[0, 1])
+
+
+def make_memory_report(memory_records, n_workers=1, headroom=MEMORY_HEADROOM):
+    """
+    Relates the peak RSS of each group to its size and recommends SLURM memory
+
+    Parameters
+    ----------
+    memory_records : list
+        From load_memory_records
+    n_workers : int
+        Groups run at once on a node
+    headroom : float
+        Fraction added to peaks for the recommendations
+
+    Returns
+    ----------
+    memory_report : dict
+        Correlation of peak RSS with grid points, time length and data size, a linear fit
+        of peak RSS to data size, the recommended --mem for every group and memory classes
+        (groups which fit in each bound of MEMORY_CLASS_BOUNDS per worker and their --mem)
+    """
+    memory_records = [
+        memory_record
+        for memory_record in memory_records
+        if memory_record.get("peak_rss") is not None
+    ]
+    if not memory_records:
+        return {"n_groups": 0}
+    peaks = [memory_record["peak_rss"] for memory_record in memory_records]
+    memory_report = {
+        "n_groups": len(memory_records),
+        "n_workers": n_workers,
+        "headroom": headroom,
+        "max_peak_rss": max(peaks),
+        "median_peak_rss": float(numpy.median(peaks)),
+        "largest_group": memory_records[int(numpy.argmax(peaks))]["group"],
+        "correlation_with_peak_rss": {
+            size: get_correlation(
+                peaks, [memory_record.get(size) or 0 for memory_record in memory_records]
+            )
+            for size in ["n_grid_points", "n_time", "data_nbytes"]
+        },
+        "recommended_mem": recommend_mem(max(peaks), n_workers, headroom),
+    }
+    data_nbytes = [memory_record.get("data_nbytes") or 0 for memory_record in memory_records]
+    if memory_report["correlation_with_peak_rss"]["data_nbytes"] is not None:
+        slope, intercept = numpy.polyfit(numpy.asarray(data_nbytes) / 1024**2, peaks, 1)
+        memory_report["peak_rss_fit"] = {
+            "mb_per_mb_of_data": float(slope),
+            "intercept": float(intercept),
+        }
+    memory_classes = {}
+    for memory_record in memory_records:
+        bound = get_memory_class_bound(memory_record["peak_rss"], headroom)
+        memory_classes.setdefault(bound, []).append(memory_record)
+    memory_report["memory_classes"] = []
+    for bound, class_records in sorted(
+        memory_classes.items(), key=lambda item: math.inf if item[0] is None else item[0]
+    ):
+        class_peak = max(memory_record["peak_rss"] for memory_record in class_records)
+        memory_report["memory_classes"].append(
+            {
+                "max_memory_per_worker": bound,
+                "max_peak_rss": class_peak,
+                #  the bound already has room for the headroom
+                "recommended_mem": (
+                    recommend_mem(class_peak, n_workers, headroom)
+                    if bound is None
+                    else recommend_mem(bound, n_workers, headroom=0)
+                ),
+                "groups": sorted(memory_record["group"] for memory_record in class_records),
+            }
+        )
+    return memory_report
+
+
+def make_memory_report_text(memory_report):
+    if not memory_report["n_groups"]:
+        return "No memory records with a peak RSS"
+    lines = [
+        "Peak RSS of %s groups: max %.0f MB (%s), median %.0f MB"
+        % (
+            memory_report["n_groups"],
+            memory_report["max_peak_rss"],
+            memory_report["largest_group"],
+            memory_report["median_peak_rss"],
+        ),
+        "Correlation of peak RSS with: %s"
+        % (
+            ", ".join(
+                "%s %s" % (size, "n/a" if correlation is None else "%.2f" % (correlation))
+                for size, correlation in memory_report["correlation_with_peak_rss"].items()
+            )
+        ),
+    ]
+    if "peak_rss_fit" in memory_report:
+        lines.append(
+            "Peak RSS ~ %.0f MB + %.2f x data size (MB)"
+            % (
+                memory_report["peak_rss_fit"]["intercept"],
+                memory_report["peak_rss_fit"]["mb_per_mb_of_data"],
+            )
+        )
+    lines.append(
+        "Recommended for all groups with %s workers (%.0f%% headroom): sbatch --mem=%s"
+        % (
+            memory_report["n_workers"],
+            memory_report["headroom"] * 100,
+            memory_report["recommended_mem"],
+        )
+    )
+    lines.append("Memory classes:")
+    for memory_class in memory_report["memory_classes"]:
+        if memory_class["max_memory_per_worker"] is None:
+            class_name = "> %s MB" % (MEMORY_CLASS_BOUNDS[-1])
+        else:
+            class_name = "<= %s MB" % (memory_class["max_memory_per_worker"])
+        lines.append(
+            "  %s per worker: %s groups (max peak %.0f MB), sbatch --mem=%s"
+            % (
+                class_name,
+                len(memory_class["groups"]),
+                memory_class["max_peak_rss"],
+                memory_class["recommended_mem"],
+            )
+        )
+    return "\n".join(lines)
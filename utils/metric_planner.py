@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Work out which metrics in a metric dict can be run on a dataset, and the isel indexers of
+    each metric's subset, from an index of the dataset's coords built once (rather than rounding
+    and searching the coords of the data again for every metric and coord)
+"""
+
+# imports
+import numpy
+
+# docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+ROUNDING_THRESHOLD = 3  # number of decimal places to round for coord check. Previously had a problem with 70000.00001
+SUBSET_TOLERANCE = 0.01  # added to the upper bound of each subset so values are never cut (i.e. 70000.00001)
+
+
+class CoordIndex:
+    """
+    Rounded values, min and max of each coord of a dataset. Only coord values already held
+    in memory (indexes and scalar coords) are read and the dataset is never changed. Indexers
+    for each range asked for are kept, so metrics with the same coords share them.
+    """
+
+    def __init__(self, data, decimals=ROUNDING_THRESHOLD):
+        """
+        Parameters
+        ----------
+        data : xarray.Dataset
+            Data to index (coords with more than one dimension are left out)
+        decimals : int
+            Decimal places coord values and ranges are rounded to before comparing them
+        """
+        self.decimals = decimals
+        self.variables = frozenset(data.variables)
+        self.dim_sizes = dict(data.sizes)
+        self._coords = {}
+        for coord in data.coords:
+            if data[coord].ndim > 1 or (data[coord].ndim == 1 and coord not in data.indexes):
+                continue
+            values = numpy.asarray(
+                data.indexes[coord] if coord in data.indexes else data[coord].values
+            ).ravel()
+            if values.dtype.kind not in "iuf" or values.size == 0:
+                continue
+            values = numpy.round(values.astype(float), decimals)
+            values.flags.writeable = False
+            self._coords[coord] = {
+                "dim": data[coord].dims[0] if data[coord].ndim == 1 else None,
+                "values": values,
+                "min": float(values.min()),
+                "max": float(values.max()),
+            }
+        self._indexers = {}
+
+    def __contains__(self, coord):
+        return coord in self._coords
+
+    def __repr__(self):
+        return "CoordIndex(%s)" % (
+            ", ".join(
+                "%s=[%s, %s]" % (coord, coord_info["min"], coord_info["max"])
+                for coord, coord_info in self._coords.items()
+            )
+        )
+
+    def get_values(self, coord):
+        return self._coords[coord]["values"]
+
+    def get_dim(self, coord):
+        return self._coords[coord]["dim"]
+
+    def meets_reqs(self, coord, coord_vals):
+        """
+        Whether the coord has any value in a range (as check_if_coord_vals_meet_reqs)
+
+        Parameters
+        ----------
+        coord : str
+            Coord in the index
+        coord_vals : array-like
+            (min_val, max_val) where min_val > max_val wraps around (i.e. lon of 300 to 60)
+
+        Returns
+        ----------
+        meets_reqs : bool
+        """
+        min_val = round(float(coord_vals[0]), self.decimals)
+        max_val = round(float(coord_vals[1]), self.decimals)
+        coord_info = self._coords[coord]
+        values = coord_info["values"]
+        if min_val > max_val:
+            return coord_info["max"] >= min_val or coord_info["min"] <= max_val
+        elif values.size > 1:
+            return bool(numpy.any((values >= min_val) & (values <= max_val)))
+        return min_val <= coord_info["min"] <= max_val
+
+    def get_indexer(self, coord, min_val, max_val):
+        """
+        isel indexer of the values of a dimension coord in a range (as subset_data_using_metric_coords)
+
+        Parameters
+        ----------
+        coord : str
+            Dimension coord in the index
+        min_val : float
+            Lower bound
+        max_val : float
+            Upper bound (min_val > max_val wraps around i.e. lon of 300 to 60)
+
+        Returns
+        ----------
+        indexer : slice or numpy.ndarray
+            Slice when the values are next to each other (in their order in the data),
+            otherwise their indices in order. None when the coord does not need subsetting
+
+        Raises
+        ----------
+        ValueError
+            When the coord is not a dimension of the data
+        """
+        key = (coord, float(min_val), float(max_val))
+        if key not in self._indexers:
+            self._indexers[key] = self._make_indexer(coord, float(min_val), float(max_val))
+        return self._indexers[key]
+
+    def _make_indexer(self, coord, min_val, max_val):
+        coord_info = self._coords[coord]
+        values = coord_info["values"]
+        if min_val == max_val and values.size == 1 and values[0] == min_val:
+            return None
+        if coord_info["dim"] is None:
+            raise ValueError("cannot subset '%s' as it is not a dimension of the data" % (coord))
+        if min_val > max_val:
+            keep = (values >= min_val) | (values <= max_val + SUBSET_TOLERANCE)
+        else:
+            keep = (values >= min_val) & (values <= max_val + SUBSET_TOLERANCE)
+        inds = numpy.flatnonzero(keep)
+        if len(inds) == 0:
+            return slice(0, 0)
+        if inds[-1] - inds[0] + 1 == len(inds):
+            return slice(int(inds[0]), int(inds[-1]) + 1)
+        return inds
+
+
+def get_wraparound_slices(values, min_val, max_val):
+    """
+    Slices of the values of an ascending cyclic coord in a range which wraps around
+    (i.e. lon of 300 to 60), so it can be subset with two slices instead of rolling the data
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Ascending coord values
+    min_val : float
+        Values from min_val to the end are in the range
+    max_val : float
+        Values from the start up to max_val are in the range (max_val < min_val)
+
+    Returns
+    ----------
+    lower_slice, upper_slice : slice
+        Slice of values <= max_val and slice of values >= min_val (either may be empty)
+    """
+    return (
+        slice(0, int(numpy.searchsorted(values, max_val, side="right"))),
+        slice(int(numpy.searchsorted(values, min_val, side="left")), len(values)),
+    )
+
+
+class MetricPlan:
+    """
+    A metric which can be run on the data and the isel indexers of its subset
+    """
+
+    def __init__(self, metric_info, indexers, subset_key):
+        """
+        Parameters
+        ----------
+        metric_info : dict
+            jetstream metric information about metric name, subsetting, required variables, function location
+        indexers : dict
+            dim -> indexer for .isel() (an int for dims of one value, which are dropped)
+        subset_key : tuple
+            Same for every metric with the same subset (see compute_jsmetrics.make_subset_cache_key)
+        """
+        self.metric_info = metric_info
+        self.indexers = indexers
+        self.subset_key = subset_key
+
+    @property
+    def name(self):
+        return self.metric_info["name"]
+
+    def __repr__(self):
+        return "MetricPlan(%s, indexers=%s)" % (self.name, self.indexers)
+
+
+class MetricExecutionPlan:
+    """
+    Metrics of a metric dict which can be run on the data (in the order of the metric dict),
+    and why each of the others cannot be run
+    """
+
+    def __init__(self, metric_plans, unavailable_metrics):
+        self.metric_plans = metric_plans
+        self.unavailable_metrics = unavailable_metrics
+
+    def __iter__(self):
+        return iter(self.metric_plans.values())
+
+    def __len__(self):
+        return len(self.metric_plans)
+
+    def __contains__(self, metric_name):
+        return metric_name in self.metric_plans
+
+    def __getitem__(self, metric_name):
+        return self.metric_plans[metric_name]
+
+    def __repr__(self):
+        return "MetricExecutionPlan(runnable=%s, unavailable=%s)" % (
+            list(self.metric_plans),
+            list(self.unavailable_metrics),
+        )
+
+
+def get_coords_to_subset(ignore_coords, metric_info):
+    if ignore_coords:
+        return [coord for coord in metric_info["coords"] if coord not in ignore_coords]
+    return list(metric_info["coords"])
+
+
+def get_metric_requirement_errors(coord_index, metric_info):
+    """
+    Variables and coords a metric needs which the data does not have, and coord ranges the
+    data has no values in
+
+    Returns
+    ----------
+    missing : list
+        Variables and coords not in the data
+    unmet_coord_ranges : list
+        (coord, min_val, max_val) of each coord with no values in range
+    """
+    missing = [var for var in metric_info["variables"] if var not in coord_index.variables]
+    if len(metric_info["coords"]) < 1:
+        raise ValueError("Metric has no coordinates to subset")
+    unmet_coord_ranges = []
+    for coord, coord_vals in metric_info["coords"].items():
+        if coord not in coord_index:
+            missing.append(coord)
+        elif not coord_index.meets_reqs(coord, coord_vals):
+            unmet_coord_ranges.append((coord, coord_vals[0], coord_vals[1]))
+    return missing, unmet_coord_ranges
+
+
+def get_subset_indexers(coord_index, metric_info, ignore_coords=None):
+    """
+    isel indexers which subset data to the coords of a metric and drop dims left with
+    one value (the same subset as compute_jsmetrics.subset_data_using_metric_coords)
+
+    Returns
+    ----------
+    indexers : dict
+        dim -> slice, index array or int
+    """
+    coords_to_subset = get_coords_to_subset(ignore_coords, metric_info)
+    if not coords_to_subset:
+        return {}
+    indexers = {}
+    for coord in coords_to_subset:
+        min_val = float(metric_info["coords"][coord][0])
+        max_val = float(metric_info["coords"][coord][1])
+        indexer = coord_index.get_indexer(coord, min_val, max_val)
+        if indexer is not None:
+            indexers[coord_index.get_dim(coord)] = indexer
+    #  flatten dims with one value left (as compute_jsmetrics.flatten_dims)
+    for dim, dim_size in coord_index.dim_sizes.items():
+        if dim in indexers:
+            indexer = indexers[dim]
+            dim_size = len(range(dim_size)[indexer]) if isinstance(indexer, slice) else len(indexer)
+            if dim_size == 1:
+                indexers[dim] = (
+                    indexer.start if isinstance(indexer, slice) else int(indexer[0])
+                )
+        elif dim_size == 1:
+            indexers[dim] = 0
+    return indexers
+
+
+def plan_metrics(coord_index, metric_dict, ignore_coords=None):
+    """
+    Works out which metrics can be run and the subset of each in one pass over a metric dict
+
+    Parameters
+    ----------
+    coord_index : CoordIndex
+        Index of the data the metrics will be run on
+    metric_dict : dict
+        Metric name -> metric info
+    ignore_coords : array-like
+        coordiantes to not subset
+
+    Returns
+    ----------
+    execution_plan : MetricExecutionPlan
+        A MetricPlan for each metric which can be run, and why others cannot
+
+    Usage
+    ----------
+    execution_plan = plan_metrics(CoordIndex(data), METRIC_DICT)
+    for metric_plan in execution_plan:
+        subset = data.isel(metric_plan.indexers)
+    """
+    metric_plans = {}
+    unavailable_metrics = {}
+    subset_indexers = {}
+    for metric_name, metric_info in metric_dict.items():
+        missing, unmet_coord_ranges = get_metric_requirement_errors(coord_index, metric_info)
+        if missing or unmet_coord_ranges:
+            unavailable_metrics[metric_name] = make_requirement_error_message(
+                missing, unmet_coord_ranges
+            )
+            continue
+        subset_key = make_subset_key(metric_info, ignore_coords)
+        if subset_key not in subset_indexers:
+            try:
+                subset_indexers[subset_key] = get_subset_indexers(
+                    coord_index, metric_info, ignore_coords
+                )
+            except ValueError as e:
+                unavailable_metrics[metric_name] = str(e)
+                continue
+        metric_plans[metric_name] = MetricPlan(
+            metric_info, subset_indexers[subset_key], subset_key
+        )
+    return MetricExecutionPlan(metric_plans, unavailable_metrics)
+
+
+def make_subset_key(metric_info, ignore_coords=None):
+    """
+    Sorted (coord, min_val, max_val) for each coord to subset, so it is the same for any
+    metrics that subset the data in the same way (regardless of dict order or int/float values)
+    """
+    return tuple(
+        sorted(
+            (
+                coord,
+                float(metric_info["coords"][coord][0]),
+                float(metric_info["coords"][coord][1]),
+            )
+            for coord in get_coords_to_subset(ignore_coords, metric_info)
+        )
+    )
+
+
+def make_requirement_error_message(missing, unmet_coord_ranges):
+    message = ""
+    if missing:
+        message += " Data does not have %s." % (", ".join("'%s'" % (name) for name in missing))
+    for coord, min_val, max_val in unmet_coord_ranges:
+        message += " '%s' needs to be between %s and %s." % (coord, min_val, max_val)
+    return message.strip()
@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Where metric outputs are saved: a Parquet dataset partitioned by metric and model
+    (one file per partition, read back by model, member, metric and time) or
+    one CSV file per model member and metric (original layout)
+"""
+
+# imports
+import glob
+import logging
+import os
+import re
+import time
+
+import pandas
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+PARQUET_COMPRESSION = "zstd"
+PARQUET_FILE_NAME = "data.parquet"  # one file per metric/model partition
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"  # times are stored as strings so any calendar can be compared
+STAGING_DIR = "_staging"  # groups written by workers before they are compacted into the partitions
+#  columns added to each row of the parquet store so any slice can be read back
+INDEX_COLUMNS = ["model", "member", "experiment", "grid", "group", "metric"]
+
+
+log = logging.getLogger(__name__)
+
+
+class CSVOutputStore:
+    """
+    One CSV file per model member and metric i.e. outputs/[group name][metric name].csv
+    """
+
+    def __init__(self, output_path):
+        """
+        Parameters
+        ----------
+        output_path : str
+            Directory to store outputs in
+        """
+        self.output_path = output_path
+
+    def get_output_file_path(self, group_name, metric_name):
+        return os.path.join(self.output_path, group_name + metric_name + ".csv")
+
+    def exists(self, group_name, metric_name):
+        return os.path.exists(self.get_output_file_path(group_name, metric_name))
+
+    def write(self, output, group_name, metric_name, facets=None):
+        """
+        Parameters
+        ----------
+        output : xarray.DataArray
+            Output of metric to save
+        group_name : str
+            Name of group of data paths (i.e. model member) the output is from
+        metric_name : str
+            Name of metric
+        facets : dict
+            CMIP6 DRS facets of the group (not used for CSV)
+        """
+        output.to_dataframe().to_csv(self.get_output_file_path(group_name, metric_name))
+
+    def flush(self):
+        """
+        Nothing to do as each output is written straight away
+        """
+        return 0
+
+    def get_end_time(self, group_name, metric_name):
+        """
+        Always None as CSV files cannot be appended to safely (e.g. when shards are merged),
+        so outputs are not extended in time
+        """
+        return None
+
+    def compact(self):
+        """
+        Nothing to do as each output has its own file
+        """
+        return 0
+
+    def read(self, group_name, metric_name):
+        return pandas.read_csv(self.get_output_file_path(group_name, metric_name))
+
+
+class ParquetOutputStore:
+    """
+    Parquet dataset partitioned by metric and model i.e.
+    outputs/parquet/[metric]/[model]/data.parquet
+
+    Outputs are written in two steps so that workers and shards can write at the same time:
+        1. write() keeps the outputs of a group in memory and flush() saves them as one file
+           in outputs/parquet/_staging/ (each writer only writes its own files)
+        2. compact() is run once no one is writing (i.e. at the end of main or after shards
+           are merged) and moves staged outputs into the file of each metric/model partition
+    Writing a later period of a group/metric appends it to what is saved (see get_end_time).
+
+    Rows in each partition file are sorted by group and time with one or more row groups per
+    group, so the min/max statistics of each row group let read() skip members and times
+    that were not asked for.
+    """
+
+    def __init__(self, output_path, compression=PARQUET_COMPRESSION):
+        """
+        Parameters
+        ----------
+        output_path : str
+            Directory to store outputs in (parquet files are kept in output_path/parquet/)
+        compression : str
+            Parquet compression codec
+
+        Raises
+        ----------
+        ImportError
+            When pyarrow is not installed
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow needs to be installed to use ParquetOutputStore")
+        self.output_path = output_path
+        self.store_path = os.path.join(output_path, "parquet")
+        self.staging_path = os.path.join(self.store_path, STAGING_DIR)
+        self.compression = compression
+        self.unsaved_tables = []
+
+    def get_partition_file_path(self, metric_name, model):
+        return os.path.join(
+            self.store_path,
+            make_partition_name(metric_name),
+            make_partition_name(model),
+            PARQUET_FILE_NAME,
+        )
+
+    def get_staged_file_paths(self, group_name=None):
+        return sorted(
+            glob.glob(
+                os.path.join(
+                    self.staging_path, "%s.*.parquet" % (group_name if group_name else "*")
+                )
+            )
+        )
+
+    def exists(self, group_name, metric_name):
+        """
+        Whether there is any output of the metric for the group (saved, staged or not yet flushed)
+        """
+        if (group_name, metric_name) in [
+            (unsaved_group_name, unsaved_metric_name)
+            for unsaved_group_name, unsaved_metric_name, _ in self.unsaved_tables
+        ]:
+            return True
+        for file_path in self._get_file_paths_with_group(group_name, metric_name):
+            matching_rows = pyarrow.dataset.dataset(file_path, format="parquet").count_rows(
+                filter=make_group_filter_expression(group_name, metric_name)
+            )
+            if matching_rows:
+                return True
+        return False
+
+    def get_end_time(self, group_name, metric_name):
+        """
+        Last time saved or staged for the metric and group
+
+        Returns
+        ----------
+        end_time : str
+            Time formatted with TIME_FORMAT (None if there is no output with a time)
+        """
+        end_time = None
+        for file_path in self._get_file_paths_with_group(group_name, metric_name):
+            outputs = pyarrow.dataset.dataset(file_path, format="parquet")
+            if "time" not in outputs.schema.names:
+                continue
+            file_end_time = pyarrow.compute.max(
+                outputs.to_table(
+                    columns=["time"],
+                    filter=make_group_filter_expression(group_name, metric_name),
+                )["time"]
+            ).as_py()
+            if file_end_time is not None and (end_time is None or file_end_time > end_time):
+                end_time = file_end_time
+        return end_time
+
+    def _get_file_paths_with_group(self, group_name, metric_name):
+        """
+        Staged files of the group and the partition file it would be compacted into
+        """
+        file_paths = self.get_staged_file_paths(group_name)
+        partition_file_path = self.get_partition_file_path(
+            metric_name, get_model_from_group_name(group_name)
+        )
+        if os.path.exists(partition_file_path):
+            file_paths.append(partition_file_path)
+        return file_paths
+
+    def write(self, output, group_name, metric_name, facets=None):
+        """
+        Keeps output in memory until flush() is called
+
+        Parameters
+        ----------
+        output : xarray.DataArray
+            Output of metric to save
+        group_name : str
+            Name of group of data paths (i.e. model member) the output is from
+        metric_name : str
+            Name of metric
+        facets : dict
+            CMIP6 DRS facets of the group (i.e. from get_data.get_drs_facets_from_path)
+        """
+        if not facets:
+            facets = {}
+        output_dataframe = output.to_dataframe().reset_index()
+        if "time" in output_dataframe:
+            #  works for numpy datetimes and cftime calendars (e.g. noleap)
+            output_dataframe["time"] = [
+                time_value.strftime(TIME_FORMAT) for time_value in output_dataframe["time"]
+            ]
+        index_values = {
+            "model": facets.get("model") or get_model_from_group_name(group_name),
+            "member": facets.get("member"),
+            "experiment": facets.get("experiment"),
+            "grid": facets.get("grid"),
+            "group": group_name,
+            "metric": metric_name,
+        }
+        for column_name in INDEX_COLUMNS:
+            output_dataframe[column_name] = pandas.Series(
+                [index_values[column_name]] * len(output_dataframe), dtype=object
+            )
+        self.unsaved_tables.append(
+            (
+                group_name,
+                metric_name,
+                pyarrow.Table.from_pandas(output_dataframe, preserve_index=False),
+            )
+        )
+
+    def flush(self):
+        """
+        Saves the outputs kept by write() as one file per group in the staging directory
+
+        Returns
+        ----------
+        n_files_written : int
+        """
+        tables_by_group = {}
+        for group_name, _, table in self.unsaved_tables:
+            tables_by_group.setdefault(group_name, []).append(table)
+        os.makedirs(self.staging_path, exist_ok=True)
+        for group_name, tables in tables_by_group.items():
+            #  time (so files of a group sort in the order written) and pid make the name unique
+            file_name = "%s.%s-%s.parquet" % (group_name, time.time_ns(), os.getpid())
+            write_parquet_file(
+                concat_tables(tables),
+                os.path.join(self.staging_path, file_name),
+                self.compression,
+            )
+        self.unsaved_tables = []
+        return len(tables_by_group)
+
+    def compact(self):
+        """
+        Moves all staged outputs into the file of their metric/model partition. Staged outputs
+        of a group replace the rows already in the store from their first time onwards (or all
+        rows of the group for outputs without time), so a group can be extended in time or
+        computed again.
+        Only run this when no one else is writing to the store.
+
+        Returns
+        ----------
+        n_partitions_written : int
+        """
+        staged_file_paths = self.get_staged_file_paths()
+        if not staged_file_paths:
+            return 0
+        #  in the order each group's files were written so later outputs replace earlier ones
+        staged_tables = [pyarrow.parquet.read_table(file_path) for file_path in staged_file_paths]
+        partition_keys = (
+            concat_tables([staged_table.select(["metric", "model"]) for staged_table in staged_tables])
+            .group_by(["metric", "model"])
+            .aggregate([])
+            .to_pylist()
+        )
+        for partition_key in partition_keys:
+            new_tables = [
+                staged_table.filter(
+                    (pyarrow.compute.field("metric") == partition_key["metric"])
+                    & (pyarrow.compute.field("model") == partition_key["model"])
+                )
+                for staged_table in staged_tables
+            ]
+            partition_file_path = self.get_partition_file_path(
+                partition_key["metric"], partition_key["model"]
+            )
+            self._write_partition(
+                [drop_null_columns(new_table) for new_table in new_tables if new_table.num_rows],
+                partition_file_path,
+            )
+        for file_path in staged_file_paths:
+            os.remove(file_path)
+        log.info(
+            "%s staged files compacted into %s partitions of %s"
+            % (len(staged_file_paths), len(partition_keys), self.store_path)
+        )
+        return len(partition_keys)
+
+    def _write_partition(self, new_tables, partition_file_path):
+        outputs = None
+        if os.path.exists(partition_file_path):
+            outputs = pyarrow.parquet.read_table(partition_file_path).to_pandas()
+        for new_table in new_tables:
+            outputs = replace_group_outputs(outputs, new_table.to_pandas())
+        sort_columns = [
+            column_name for column_name in ["group", "time"] if column_name in outputs
+        ]
+        outputs = outputs.sort_values(sort_columns, kind="stable")
+        os.makedirs(os.path.dirname(partition_file_path), exist_ok=True)
+        #  one write per group, so row group statistics can be used to skip other groups
+        write_parquet_file(
+            [
+                pyarrow.Table.from_pandas(group_outputs, preserve_index=False)
+                for _, group_outputs in outputs.groupby("group", sort=True)
+            ],
+            partition_file_path,
+            self.compression,
+        )
+
+    def read(
+        self,
+        metric_name=None,
+        model=None,
+        member=None,
+        group_name=None,
+        time_range=None,
+        columns=None,
+    ):
+        """
+        Read any slice of the store. Only partitions of matching metrics/models are opened and
+        member, group and time are filtered as the files are read (skipping row groups which
+        do not match).
+
+        Parameters
+        ----------
+        metric_name : str
+            Metric to read (default: all)
+        model : str
+            Model to read (default: all)
+        member : str
+            Member to read e.g. r1i1p1f1 (default: all)
+        group_name : str
+            Group of data paths to read (default: all)
+        time_range : tuple
+            (start, end) as strings e.g. ('1950-01-01', '1959-12-31 23:59:59') (default: all times)
+        columns : list
+            Columns to read (default: all)
+
+        Returns
+        ----------
+        outputs : pandas.DataFrame
+            One row per output value with the INDEX_COLUMNS
+        """
+        file_paths = glob.glob(
+            os.path.join(
+                self.store_path,
+                make_partition_name(metric_name) if metric_name else "[!_]*",
+                make_partition_name(model) if model else "*",
+                PARQUET_FILE_NAME,
+            )
+        )
+        file_paths = sorted(file_paths) + self.get_staged_file_paths(group_name)
+        if not file_paths:
+            return pandas.DataFrame(columns=INDEX_COLUMNS)
+        schema = pyarrow.unify_schemas(
+            [pyarrow.parquet.read_schema(file_path) for file_path in file_paths]
+        )
+        outputs = pyarrow.dataset.dataset(file_paths, schema=schema, format="parquet")
+        filter_expression = None
+        for column_name, value in [
+            ("metric", metric_name),
+            ("model", model),
+            ("member", member),
+            ("group", group_name),
+        ]:
+            if value is not None:
+                filter_expression = add_to_filter_expression(
+                    filter_expression, pyarrow.dataset.field(column_name) == value
+                )
+        if time_range and "time" in schema.names:
+            filter_expression = add_to_filter_expression(
+                filter_expression,
+                (pyarrow.dataset.field("time") >= str(time_range[0]))
+                & (pyarrow.dataset.field("time") <= str(time_range[1])),
+            )
+        outputs = drop_null_columns(
+            outputs.to_table(columns=columns, filter=filter_expression)
+        ).to_pandas()
+        sort_columns = [
+            column_name for column_name in ["metric", "group", "time"] if column_name in outputs
+        ]
+        return outputs.sort_values(sort_columns, kind="stable").reset_index(drop=True)
+
+    def read_as_xarray(self, metric_name, variable_name, dims=("group", "time"), **kwargs):
+        """
+        Read one metric's output variable as an xarray.DataArray (see read for kwargs)
+        """
+        outputs = self.read(metric_name=metric_name, **kwargs)
+        return outputs.set_index(list(dims))[variable_name].to_xarray()
+
+
+OUTPUT_STORES = {"csv": CSVOutputStore, "parquet": ParquetOutputStore}
+
+
+def get_output_store(store_type, output_path):
+    """
+    Parameters
+    ----------
+    store_type : str
+        One of OUTPUT_STORES i.e. 'csv' or 'parquet'
+    output_path : str
+        Directory to store outputs in
+
+    Raises
+    ----------
+    ValueError
+        When 'store_type' is not in OUTPUT_STORES
+    """
+    if store_type not in OUTPUT_STORES:
+        raise ValueError("'store_type' needs to be one of %s" % (list(OUTPUT_STORES)))
+    return OUTPUT_STORES[store_type](output_path)
+
+
+def replace_group_outputs(outputs, new_outputs):
+    """
+    Adds new_outputs to outputs, replacing rows of each group in new_outputs from its first
+    time onwards (or all rows of the group for outputs without time)
+
+    Parameters
+    ----------
+    outputs : pandas.DataFrame
+        Outputs already saved (or None)
+    new_outputs : pandas.DataFrame
+        Outputs to add
+    """
+    if outputs is None:
+        return new_outputs
+    if "time" in outputs and "time" in new_outputs:
+        first_new_times = outputs["group"].map(new_outputs.groupby("group")["time"].min())
+        outputs = outputs[first_new_times.isna() | (outputs["time"] < first_new_times)]
+    else:
+        outputs = outputs[~outputs["group"].isin(new_outputs["group"])]
+    return pandas.concat([outputs, new_outputs], ignore_index=True)
+
+
+def write_parquet_file(tables, file_path, compression=PARQUET_COMPRESSION):
+    """
+    Writes table(s) to a temporary file then renames it, so readers never see part of a file.
+    Each table is written as its own row group(s).
+    """
+    if not isinstance(tables, list):
+        tables = [tables]
+    schema = pyarrow.unify_schemas([table.schema for table in tables])
+    temp_file_path = "%s.temp_%s" % (file_path, os.getpid())
+    with pyarrow.parquet.ParquetWriter(
+        temp_file_path, schema, compression=compression
+    ) as parquet_writer:
+        for table in tables:
+            parquet_writer.write_table(table.cast(schema))
+    os.replace(temp_file_path, file_path)
+
+
+def concat_tables(tables):
+    """
+    Concatenate tables with different columns (missing columns are filled with nulls)
+    """
+    try:
+        return pyarrow.concat_tables(tables, promote_options="default")
+    except TypeError:
+        #  pyarrow < 14
+        return pyarrow.concat_tables(tables, promote=True)
+
+
+def drop_null_columns(table):
+    """
+    Drop columns that are only nulls (i.e. columns of other metrics)
+    """
+    return table.drop(
+        [
+            column_name
+            for column_name in table.column_names
+            if table.num_rows and table[column_name].null_count == table.num_rows
+        ]
+    )
+
+
+def make_group_filter_expression(group_name, metric_name):
+    return (pyarrow.dataset.field("group") == group_name) & (
+        pyarrow.dataset.field("metric") == metric_name
+    )
+
+
+def add_to_filter_expression(filter_expression, new_expression):
+    if filter_expression is None:
+        return new_expression
+    return filter_expression & new_expression
+
+
+def make_partition_name(value):
+    """
+    Make a value safe to use as a directory name e.g. 'Barnes & Polvani 2013' -> 'Barnes_Polvani_2013'
+    """
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", str(value)).strip("_")
+
+
+def get_model_from_group_name(group_name):
+    """
+    Model from a group name like ua_day_ACCESS-CM2_historical_r1i1p1f1_gn
+    """
+    name_parts = group_name.split("_")
+    if len(name_parts) >= 3:
+        return name_parts[2]
+    return group_name
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Runs items (i.e. groups of data paths) through three stages at once: the next items are
+    read in a background thread while the current item is computed in the calling thread, and
+    the outputs of earlier items are written by a write-behind thread. Stages are joined by
+    bounded queues, and the data read ahead is capped by a memory budget so reading ahead
+    cannot run out of memory.
+"""
+
+#  imports
+import queue
+import threading
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+PREFETCH_DEPTH = 1  # items read ahead of the item being computed
+WRITE_BEHIND_DEPTH = 2  # computed items waiting to be written
+QUEUE_POLL_TIME = 0.5  # seconds between checks that the pipeline has not been stopped while waiting on a queue
+
+_END = object()  # put on a queue after the last item
+
+
+class MemoryBudget:
+    """
+    Bytes of memory that items between the stages of a pipeline may hold at once. Reading
+    waits until what it needs fits, but an item larger than the whole budget is let through
+    when nothing else is held (so it waits for the items ahead of it rather than never running).
+    """
+
+    def __init__(self, max_mb=None):
+        """
+        Parameters
+        ----------
+        max_mb : float
+            Size of the budget (None for no limit)
+        """
+        self.max_nbytes = None if max_mb is None else int(max_mb * 1024**2)
+        self.nbytes_held = 0
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        return "MemoryBudget(held=%.1fMB, max=%s)" % (
+            self.nbytes_held / 1024**2,
+            "None" if self.max_nbytes is None else "%.1fMB" % (self.max_nbytes / 1024**2),
+        )
+
+    def fits(self, nbytes):
+        """
+        Whether nbytes could ever be held (i.e. when nothing else is)
+        """
+        return self.max_nbytes is None or nbytes <= self.max_nbytes
+
+    def acquire(self, nbytes, block=True, stop_event=None):
+        """
+        Holds nbytes of the budget
+
+        Parameters
+        ----------
+        nbytes : int
+        block : Boolean
+            Wait until nbytes fits in the budget (False holds it straight away, i.e. for
+            memory already in use which reading ahead should wait for)
+        stop_event : threading.Event
+            Stop waiting (without holding nbytes) when this is set
+
+        Returns
+        ----------
+        acquired : Boolean
+            False when stopped before nbytes was held
+        """
+        with self._condition:
+            while block and not self._has_room(nbytes):
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                self._condition.wait(QUEUE_POLL_TIME)
+            self.nbytes_held += nbytes
+        return True
+
+    def release(self, nbytes):
+        with self._condition:
+            self.nbytes_held -= nbytes
+            self._condition.notify_all()
+
+    def _has_room(self, nbytes):
+        return (
+            self.max_nbytes is None
+            or self.nbytes_held == 0
+            or self.nbytes_held + nbytes <= self.max_nbytes
+        )
+
+
+def run_pipeline(
+    items,
+    read_func,
+    compute_func,
+    write_func,
+    on_item_done=None,
+    memory_budget=None,
+    prefetch_depth=PREFETCH_DEPTH,
+    write_behind_depth=WRITE_BEHIND_DEPTH,
+):
+    """
+    Reads, computes and writes each item, with reading and writing in background threads so
+    they overlap computing other items. Items go through each stage in order.
+
+    Parameters
+    ----------
+    items : array-like
+        Items to run (passed to each stage function)
+    read_func : function
+        read_func(item, memory_budget, stop_event) -> (read_value, nbytes_held). Runs in the
+        read thread and should acquire the budget for what it keeps in memory (returning how
+        much, which is released once the item has been computed)
+    compute_func : function
+        compute_func(item, read_value) -> (computed_value, nbytes). Runs in the calling thread.
+        nbytes (i.e. of outputs) is held in the budget until the item is written
+    write_func : function
+        write_func(item, computed_value) -> result. Runs in the write thread
+    on_item_done : function
+        on_item_done(item, result, error) called in the calling thread (so it can use
+        connections made in this thread, i.e. SQLite) once each item is written or has failed
+    memory_budget : MemoryBudget
+        Shared by the stages (default: no limit)
+    prefetch_depth : int
+        Items read ahead of the item being computed
+    write_behind_depth : int
+        Computed items which can wait to be written before computing waits
+
+    Returns
+    ----------
+    n_failed : int
+        Items which raised an error in any stage
+    """
+    if memory_budget is None:
+        memory_budget = MemoryBudget()
+    stop_event = threading.Event()
+    read_queue = queue.Queue(maxsize=max(prefetch_depth, 1))
+    write_queue = queue.Queue(maxsize=max(write_behind_depth, 1))
+    done_queue = queue.Queue()
+    n_failed = 0
+
+    def read_items():
+        for item in items:
+            if stop_event.is_set():
+                return
+            try:
+                read_value, nbytes_held = read_func(item, memory_budget, stop_event)
+                error = None
+            except Exception as e:
+                read_value, nbytes_held, error = None, 0, e
+            if not put_unless_stopped(
+                read_queue, (item, read_value, nbytes_held, error), stop_event
+            ):
+                memory_budget.release(nbytes_held)
+                return
+        put_unless_stopped(read_queue, _END, stop_event)
+
+    def write_items():
+        while True:
+            queued = write_queue.get()
+            if queued is _END:
+                return
+            item, computed_value, nbytes = queued
+            try:
+                result, error = write_func(item, computed_value), None
+            except Exception as e:
+                result, error = None, e
+            finally:
+                del computed_value
+                memory_budget.release(nbytes)
+            done_queue.put((item, result, error))
+
+    def report_done():
+        nonlocal n_failed
+        while True:
+            try:
+                item, result, error = done_queue.get(block=False)
+            except queue.Empty:
+                return
+            if error is not None:
+                n_failed += 1
+            if on_item_done is not None:
+                on_item_done(item, result, error)
+
+    read_thread = threading.Thread(target=read_items, name="pipeline-read", daemon=True)
+    write_thread = threading.Thread(target=write_items, name="pipeline-write", daemon=True)
+    read_thread.start()
+    write_thread.start()
+    try:
+        while True:
+            queued = read_queue.get()
+            if queued is _END:
+                break
+            item, read_value, nbytes_held, error = queued
+            del queued
+            if error is None:
+                try:
+                    computed_value, nbytes = compute_func(item, read_value)
+                except Exception as e:
+                    error = e
+            del read_value
+            memory_budget.release(nbytes_held)
+            if error is None:
+                memory_budget.acquire(nbytes, block=False)
+                write_queue.put((item, computed_value, nbytes))
+                del computed_value
+            else:
+                done_queue.put((item, None, error))
+            report_done()
+    finally:
+        #  stop reading ahead (i.e. on KeyboardInterrupt) but finish writing what was computed
+        stop_event.set()
+        write_queue.put(_END)
+        write_thread.join()
+        report_done()
+    read_thread.join()
+    return n_failed
+
+
+def put_unless_stopped(bounded_queue, value, stop_event):
+    """
+    Puts value on a bounded queue, waiting for room unless stop_event is set
+
+    Returns
+    ----------
+    put : Boolean
+    """
+    while not stop_event.is_set():
+        try:
+            bounded_queue.put(value, timeout=QUEUE_POLL_TIME)
+            return True
+        except queue.Full:
+            continue
+    return False
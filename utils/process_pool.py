@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Run independent tasks (e.g. one group of data paths each) in a pool of processes
+    with logs sent back to the main process and a memory and thread limit for each worker
+"""
+
+# imports
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import resource
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import dask
+except ImportError:
+    dask = None
+
+# docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+log = logging.getLogger(__name__)
+
+_started_tasks = None  # set in each worker by initialise_worker
+
+
+def run_tasks_in_process_pool(
+    task_func,
+    tasks,
+    max_workers,
+    max_memory_per_worker=None,
+    on_task_done=None,
+    threads_per_worker=None,
+):
+    """
+    Runs task_func(*task_args) for each task in a pool of processes. An error in one task
+    is logged and returned rather than raised so that the other tasks keep running.
+    If a worker dies (e.g. killed for running out of memory) the pool is rebuilt and the
+    unfinished tasks are resubmitted. Tasks that were running when the pool broke are
+    rerun one at a time afterwards so that a task which kills its worker again only fails itself.
+
+    Parameters
+    ----------
+    task_func : function
+        Function to run in each worker (needs to be importable at module level)
+    tasks : list
+        Tuple of arguments for each call of task_func
+    max_workers : int
+        Number of worker processes
+    max_memory_per_worker : int
+        Maximum virtual memory (in MB) of each worker before it raises MemoryError (default: no limit).
+        See initialise_worker
+    on_task_done : function
+        Called in the main process as on_task_done(task_index, result, error) as each task finishes
+    threads_per_worker : int
+        Threads dask can use in each worker (default: CPUs available to this process / max_workers)
+
+    Returns
+    ----------
+    results : list
+        (result, error) for each task in the order given (one of them will be None)
+    """
+    results = [(None, None)] * len(tasks)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, get_n_available_cpus() // max_workers)
+
+    def record_result(task_ind, result, error):
+        results[task_ind] = (result, error)
+        if on_task_done:
+            on_task_done(task_ind, result, error)
+
+    manager = multiprocessing.Manager()
+    log_queue = manager.Queue()
+    started_tasks = manager.dict()
+    root_logger = logging.getLogger()
+    log_listener = logging.handlers.QueueListener(
+        log_queue, *root_logger.handlers, respect_handler_level=True
+    )
+    log_listener.start()
+    initargs = (
+        log_queue,
+        started_tasks,
+        root_logger.level,
+        max_memory_per_worker,
+        threads_per_worker,
+    )
+    try:
+        pending_tasks = list(range(len(tasks)))
+        suspect_tasks = []
+        while pending_tasks:
+            unfinished_tasks = run_tasks_until_pool_breaks(
+                task_func, tasks, pending_tasks, max_workers, initargs, record_result
+            )
+            if not unfinished_tasks:
+                break
+            new_suspect_tasks = [
+                task_ind for task_ind in unfinished_tasks if task_ind in started_tasks
+            ]
+            log.warning(
+                "process pool broke with %s tasks unfinished (%s were running), restarting pool"
+                % (len(unfinished_tasks), len(new_suspect_tasks))
+            )
+            if len(unfinished_tasks) == len(pending_tasks) and not new_suspect_tasks:
+                #  pool broke before any task started (e.g. the worker initializer failed)
+                for task_ind in unfinished_tasks:
+                    record_result(task_ind, None, BrokenProcessPool("worker failed to start"))
+                break
+            suspect_tasks.extend(new_suspect_tasks)
+            pending_tasks = [
+                task_ind for task_ind in unfinished_tasks if task_ind not in started_tasks
+            ]
+        for task_ind in suspect_tasks:
+            log.info("rerunning task %s on its own" % (task_ind))
+            if run_tasks_until_pool_breaks(
+                task_func, tasks, [task_ind], 1, initargs, record_result
+            ):
+                error = BrokenProcessPool("worker running task %s died" % (task_ind))
+                log.error("task %s failed: %s" % (task_ind, repr(error)))
+                record_result(task_ind, None, error)
+    finally:
+        log_listener.stop()
+        manager.shutdown()
+    return results
+
+
+def run_tasks_until_pool_breaks(
+    task_func, tasks, task_indices, max_workers, initargs, record_result
+):
+    """
+    Runs the tasks in task_indices in a new pool and records each result as it finishes
+
+    Returns
+    ----------
+    unfinished_tasks : list
+        Indices of tasks with no result because a worker died and broke the pool
+    """
+    unfinished_tasks = []
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=initialise_worker, initargs=initargs
+    ) as executor:
+        futures = {
+            executor.submit(run_task, task_func, task_ind, tasks[task_ind]): task_ind
+            for task_ind in task_indices
+        }
+        for future in as_completed(futures):
+            task_ind = futures[future]
+            try:
+                result, error = future.result(), None
+            except BrokenProcessPool:
+                unfinished_tasks.append(task_ind)
+                continue
+            except Exception as e:
+                log.error("task %s failed: %s" % (task_ind, repr(e)))
+                result, error = None, e
+            record_result(task_ind, result, error)
+    return sorted(unfinished_tasks)
+
+
+def run_task(task_func, task_ind, task_args):
+    """
+    Runs one task in a worker after noting that it has started
+    """
+    _started_tasks[task_ind] = os.getpid()
+    return task_func(*task_args)
+
+
+def initialise_worker(
+    log_queue, started_tasks, log_level, max_memory_per_worker=None, threads_per_worker=None
+):
+    """
+    Sends all logging in a worker process to the main process and sets the worker's memory
+    and thread limits.
+
+    The memory limit is RLIMIT_AS, which caps the worker's virtual address space (VSZ),
+    not its resident memory (RSS). VSZ is always larger than RSS (shared libraries, thread
+    stacks and a malloc arena per thread: ~0.5 GB + ~0.1 GB per dask thread for xarray, dask
+    and netCDF4), so a worker hits the limit before its RSS does. Size the limit with that
+    headroom on top of the data a task needs. As RSS <= VSZ, workers given an equal share of
+    a job's memory can never use more than the job has between them.
+
+    Parameters
+    ----------
+    log_queue : multiprocessing.Queue
+        Queue read by a logging.handlers.QueueListener in the main process
+    started_tasks : dict
+        Shared dict the worker adds each task index to as it starts the task
+    log_level : int
+        Logging level of the main process
+    max_memory_per_worker : int
+        Maximum virtual memory (in MB) of the worker (default: no limit)
+    threads_per_worker : int
+        Threads dask can use in the worker so that workers do not oversubscribe the CPUs
+        (default: dask's default of one per CPU)
+    """
+    global _started_tasks
+    _started_tasks = started_tasks
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(log_level)
+    if max_memory_per_worker:
+        max_memory_bytes = int(max_memory_per_worker) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+    if threads_per_worker and dask is not None:
+        dask.config.set(scheduler="threads", num_workers=threads_per_worker)
+
+
+def get_n_available_cpus():
+    """
+    CPUs this process can run on (i.e. those given to a SLURM job, unlike os.cpu_count)
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
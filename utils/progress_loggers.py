@@ -6,6 +6,8 @@
 
 # imports
 import os
+import sqlite3
+import time
 
 
 # docs
@@ -14,6 +16,52 @@ __email__ = "thomas.keel.18@ucl.ac.uk"
 __status__ = "Development"
 
 
+#  bump when the journal tables change so old journals are rebuilt
+JOURNAL_VERSION = 1
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    data_list_file TEXT,
+    started_at REAL
+);
+CREATE TABLE IF NOT EXISTS data_paths (
+    line_index INTEGER PRIMARY KEY,
+    data_path TEXT
+);
+CREATE INDEX IF NOT EXISTS data_paths_by_data_path ON data_paths (data_path);
+CREATE TABLE IF NOT EXISTS journal (
+    entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER,
+    data_path TEXT,
+    state TEXT,
+    info TEXT,
+    pid INTEGER,
+    logged_at REAL
+);
+CREATE INDEX IF NOT EXISTS journal_by_data_path ON journal (run_id, data_path, entry_id);
+"""
+
+#  state of each data path in a JournaledProgressLogger (paths with no journal entry in a run are queued)
+QUEUED = "queued"
+LOADED = "loaded"
+METRIC_RUN = "metric run"
+SAVED = "saved"
+DONE = "done"
+FAILED = "failed"
+
+#  states each state can move to. LOADED can follow the metric states as a group is run
+#  again when its worker dies, and DONE/FAILED are final for a run
+ALLOWED_TRANSITIONS = {
+    QUEUED: {LOADED, DONE, FAILED},
+    LOADED: {LOADED, METRIC_RUN, DONE, FAILED},
+    METRIC_RUN: {LOADED, METRIC_RUN, SAVED, DONE, FAILED},
+    SAVED: {LOADED, METRIC_RUN, SAVED, DONE, FAILED},
+    DONE: set(),
+    FAILED: set(),
+}
+
+
 class DataListProgressLogger:
     def __init__(self, path_to_data_list_file):
         if not os.path.isfile(path_to_data_list_file):
@@ -68,6 +116,57 @@ class DataListProgressLogger:
                 counter += 1
         return counter
 
+    def get_line_indices(self, data_paths):
+        """
+        data_paths : list
+            Paths to look for in the data list
+
+        Returns
+        ----------
+        line_indices : list
+            Index of the line of each path found in the data list
+        """
+        data_paths = set(data_paths)
+        with open(self._input_data_list_file, "r") as data_list_file:
+            return [
+                line_index
+                for line_index, line in enumerate(data_list_file)
+                if line.strip() in data_paths
+            ]
+
+    def get_data_paths(self):
+        """
+        Paths in the data list in line order
+        """
+        with open(self._input_data_list_file, "r") as data_list_file:
+            return [line.strip() for line in data_list_file]
+
+    def write_lines(self, info_to_add_by_line_index):
+        """
+        Same as write_line for many lines, rewriting the log file once
+
+        info_to_add_by_line_index : dict
+            Line index -> information to append to that line
+        """
+        for info_to_add in info_to_add_by_line_index.values():
+            if not isinstance(info_to_add, str):
+                raise TypeError("'info_to_add' needs to be string")
+        path, file = os.path.split(self.path_to_progress_log_file)
+        temp_file = os.path.join(path, "temp" + file)
+        with self._open_log_file("r") as log_file:
+            with open(temp_file, "w") as updated_log_file:
+                for line_index, line in enumerate(log_file):
+                    if line_index in info_to_add_by_line_index:
+                        line = line.split("...")[0]
+                        line = (
+                            line.split(os.linesep)[0]
+                            + "..."
+                            + info_to_add_by_line_index[line_index]
+                            + os.linesep
+                        )
+                    updated_log_file.write(line)
+        os.replace(temp_file, self.path_to_progress_log_file)
+
     def write_line(self, line_index_to_change, info_to_add):
         """
         TODO: make sure that info_to_add not already in string
@@ -99,8 +198,290 @@ class DataListProgressLogger:
         os.rename(temp_file, self.path_to_progress_log_file)
 
 
+class JournaledProgressLogger(DataListProgressLogger):
+    """
+    Progress logger which appends each change of state to a journal (a SQLite table next to
+    the progress log) instead of rewriting the progress log, so each update only touches the
+    paths it changes and workers in other processes can record progress at the same time.
+    The progress log is only written by render_progress_log_file.
+    """
+
+    def __init__(self, path_to_data_list_file, new_run=True):
+        """
+        Parameters
+        ----------
+        path_to_data_list_file : str
+            Path to data list in the 'data_lists' directory of an experiment
+        new_run : bool
+            Start a new run with every data path queued (False records progress to the
+            latest run, i.e. from a worker process)
+        """
+        self._new_run = new_run
+        super().__init__(path_to_data_list_file)
+
+    def _make_progress_log_file(self):
+        self.path_to_journal_file = get_progress_journal_file_path(self._input_data_list_file)
+        #  transactions are started by _begin_transaction so they can take the write lock at once
+        self._connection = sqlite3.connect(
+            self.path_to_journal_file, timeout=60, isolation_level=None
+        )
+        user_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if user_version != JOURNAL_VERSION:
+            self._connection.executescript(
+                "DROP TABLE IF EXISTS runs; DROP TABLE IF EXISTS data_paths; DROP TABLE IF EXISTS journal;"
+            )
+            self._connection.execute("PRAGMA user_version = %s" % (JOURNAL_VERSION))
+        self._connection.executescript(JOURNAL_SCHEMA)
+        if self._new_run:
+            self._start_run()
+            self.render_progress_log_file()
+        else:
+            self._run_id = self._connection.execute("SELECT MAX(run_id) FROM runs").fetchone()[0]
+            if self._run_id is None:
+                raise ValueError(
+                    "'%s' has no runs to record progress to" % (self.path_to_journal_file)
+                )
+
+    def _start_run(self):
+        with open(self._input_data_list_file, "r") as data_list_file:
+            data_paths = [line.strip() for line in data_list_file if line.strip()]
+        self._begin_transaction()
+        try:
+            self._connection.execute("DELETE FROM data_paths")
+            self._connection.executemany(
+                "INSERT INTO data_paths VALUES (?, ?)", enumerate(data_paths)
+            )
+            self._run_id = self._connection.execute(
+                "INSERT INTO runs (data_list_file, started_at) VALUES (?, ?)",
+                (self._input_data_list_file, time.time()),
+            ).lastrowid
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def _begin_transaction(self):
+        #  IMMEDIATE takes the write lock before reading, so no other process can change
+        #  the states read until the transaction ends
+        self._connection.execute("BEGIN IMMEDIATE")
+
+    def close(self):
+        self._connection.close()
+
+    def get_length_of_data_list(self):
+        return self._connection.execute("SELECT COUNT(*) FROM data_paths").fetchone()[0]
+
+    def get_line_indices(self, data_paths):
+        """
+        data_paths : list
+            Paths to look for in the data list
+
+        Returns
+        ----------
+        line_indices : list
+            Index of the line of each path found in the data list
+        """
+        line_indices = []
+        for data_path in set(data_paths):
+            line_indices.extend(
+                row[0]
+                for row in self._connection.execute(
+                    "SELECT line_index FROM data_paths WHERE data_path = ?", (data_path,)
+                )
+            )
+        return sorted(line_indices)
+
+    def get_data_paths(self):
+        """
+        Paths in the data list in line order
+        """
+        return [
+            row[0]
+            for row in self._connection.execute(
+                "SELECT data_path FROM data_paths ORDER BY line_index"
+            )
+        ]
+
+    def _get_latest_entry(self, data_path):
+        return self._connection.execute(
+            "SELECT state, info FROM journal WHERE run_id = ? AND data_path = ? "
+            "ORDER BY entry_id DESC LIMIT 1",
+            (self._run_id, data_path),
+        ).fetchone()
+
+    def get_state(self, data_path):
+        latest_entry = self._get_latest_entry(data_path)
+        if latest_entry is None:
+            return QUEUED
+        return latest_entry[0]
+
+    def get_states(self):
+        """
+        Latest state and information of each path in this run
+
+        Returns
+        ----------
+        states : dict
+            Path -> (state, info) (queued paths are not included)
+        """
+        return {
+            data_path: (state, info)
+            for data_path, state, info in self._connection.execute(
+                "SELECT data_path, state, info FROM journal WHERE entry_id IN "
+                "(SELECT MAX(entry_id) FROM journal WHERE run_id = ? GROUP BY data_path)",
+                (self._run_id,),
+            )
+        }
+
+    def record_state(self, data_paths, state, info=""):
+        """
+        Appends a change of state for each path to the journal. Either every path is moved
+        to the new state or none are.
+
+        Parameters
+        ----------
+        data_paths : list
+            Paths in the data list to change the state of
+        state : str
+            One of LOADED, METRIC_RUN, SAVED, DONE or FAILED
+        info : str
+            Information to show after the path in the progress log (default: the state)
+
+        Raises
+        ----------
+        ValueError
+            When a path cannot move from its current state to 'state' (see ALLOWED_TRANSITIONS)
+        """
+        if state not in ALLOWED_TRANSITIONS or state == QUEUED:
+            raise ValueError("'%s' is not a state paths can move to" % (state))
+        if not isinstance(info, str):
+            raise TypeError("'info' needs to be string")
+        logged_at = time.time()
+        self._begin_transaction()
+        try:
+            for data_path in data_paths:
+                current_state = self.get_state(data_path)
+                if state not in ALLOWED_TRANSITIONS[current_state]:
+                    raise ValueError(
+                        "'%s' cannot move from %s to %s" % (data_path, current_state, state)
+                    )
+            self._connection.executemany(
+                "INSERT INTO journal (run_id, data_path, state, info, pid, logged_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (self._run_id, data_path, state, info, os.getpid(), logged_at)
+                    for data_path in data_paths
+                ],
+            )
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def write_lines(self, info_to_add_by_line_index):
+        """
+        Same as DataListProgressLogger.write_lines, with the state of each line taken from
+        the start of its information (i.e. 'done! ...' or 'failed: ...')
+        """
+        data_paths = self.get_data_paths()
+        for line_index, info_to_add in info_to_add_by_line_index.items():
+            if not isinstance(info_to_add, str):
+                raise TypeError("'info_to_add' needs to be string")
+            self.record_state(
+                [data_paths[line_index]], get_state_from_info(info_to_add), info_to_add
+            )
+
+    def write_line(self, line_index_to_change, info_to_add):
+        self.write_lines({line_index_to_change: info_to_add})
+
+    def merge(self, other_journal_path):
+        """
+        Copies the journal entries of the latest run of another journal (i.e. of a shard)
+        into this run, for paths in this data list
+
+        Returns
+        ----------
+        n_entries_merged : int
+        """
+        other_connection = sqlite3.connect(other_journal_path)
+        try:
+            entries = other_connection.execute(
+                "SELECT data_path, state, info, pid, logged_at FROM journal "
+                "WHERE run_id = (SELECT MAX(run_id) FROM runs) ORDER BY entry_id"
+            ).fetchall()
+        finally:
+            other_connection.close()
+        self._begin_transaction()
+        try:
+            entries = [
+                (self._run_id,) + entry
+                for entry in entries
+                if self._connection.execute(
+                    "SELECT 1 FROM data_paths WHERE data_path = ?", (entry[0],)
+                ).fetchone()
+            ]
+            self._connection.executemany(
+                "INSERT INTO journal (run_id, data_path, state, info, pid, logged_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                entries,
+            )
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+        return len(entries)
+
+    def render_progress_log_file(self):
+        """
+        Writes the progress log from the journal, with the latest information of each path
+        after '...' (in the same format as DataListProgressLogger)
+        """
+        states = self.get_states()
+        path, file = os.path.split(self.path_to_progress_log_file)
+        temp_file = os.path.join(path, "temp%s-%s" % (os.getpid(), file))
+        with open(temp_file, "w") as log_file:
+            for data_path in self.get_data_paths():
+                if data_path in states:
+                    state, info = states[data_path]
+                    data_path = data_path + "..." + (info or state)
+                log_file.write(data_path + os.linesep)
+        os.replace(temp_file, self.path_to_progress_log_file)
+        return self.path_to_progress_log_file
+
+
 def make_duplicate_file(path_to_file1, path_to_duplicate):
     with open(path_to_file1, "r") as file1:
         with open(path_to_duplicate, "w") as duplicate:
             for line in file1:
                 duplicate.write(line)
+
+
+def get_progress_log_file_path(path_to_data_list_file):
+    """
+    Path of the progress log DataListProgressLogger makes for a data list
+    (without making it) i.e. [experiment]/progress_logs/progress_log_[data list file name]
+    """
+    path, file_name = os.path.split(path_to_data_list_file)
+    return os.path.join(
+        os.path.dirname(path), "progress_logs", "progress_log_" + file_name
+    )
+
+
+def get_progress_journal_file_path(path_to_data_list_file):
+    """
+    Path of the journal JournaledProgressLogger keeps for a data list
+    i.e. [experiment]/progress_logs/progress_log_[data list file name without extension].sqlite
+    """
+    return (
+        os.path.splitext(get_progress_log_file_path(path_to_data_list_file))[0] + ".sqlite"
+    )
+
+
+def get_state_from_info(info):
+    """
+    State of the information added to a line of a progress log (i.e. 'done! 3 metrics saved' is DONE)
+    """
+    for state in [FAILED, DONE, SAVED, METRIC_RUN, LOADED]:
+        if info.startswith(state):
+            return state
+    raise ValueError("no state found at the start of '%s'" % (info))
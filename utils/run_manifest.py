@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Manifest of which metric outputs are up to date, stored in SQLite.
+    Each (group, metric) output is saved with a fingerprint of the metric (its METRIC_DICT
+    entry, function and the jsmetrics version) and of the input files (paths, sizes and
+    mtimes), so a rerun can tell exactly which outputs need computing again before any data is opened.
+"""
+
+#  imports
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+try:
+    import jsmetrics
+except ImportError:
+    jsmetrics = None
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+#  bump when the outputs table changes so old manifests are rebuilt
+MANIFEST_VERSION = 1
+
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    group_name TEXT,
+    metric_name TEXT,
+    metric_fingerprint TEXT,
+    inputs_fingerprint TEXT,
+    input_files TEXT,
+    jsmetrics_version TEXT,
+    error TEXT,
+    updated_at REAL,
+    PRIMARY KEY (group_name, metric_name)
+);
+"""
+
+#  state of each (group, metric) output from SQLiteRunManifest.get_output_states
+UP_TO_DATE = "up to date"
+FAILED = "failed"  # metric raised an error with the same metric and input files
+NEW_INPUT_FILES = "new input files"  # same metric and input files, plus new input files
+STALE = "stale"  # metric or input files changed (or removed)
+
+
+class SQLiteRunManifest:
+    """
+    Manifest with one row per (group, metric) output holding the fingerprints it was computed with
+    """
+
+    def __init__(self, manifest_path):
+        """
+        Parameters
+        ----------
+        manifest_path : str
+            Path to SQLite database file (will be created if it does not exist)
+
+        Raises
+        ----------
+        TypeError
+            When 'manifest_path' is not a str
+        """
+        if not isinstance(manifest_path, str):
+            raise TypeError("'manifest_path' input needs to be string type")
+        self.manifest_path = manifest_path
+        self._connection = sqlite3.connect(manifest_path, timeout=60)
+        user_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if user_version != MANIFEST_VERSION:
+            self._connection.executescript("DROP TABLE IF EXISTS outputs;")
+            self._connection.execute("PRAGMA user_version = %s" % (MANIFEST_VERSION))
+        self._connection.executescript(MANIFEST_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+
+    def get_output_states(self, group_name, input_files, metric_fingerprints):
+        """
+        Compares the fingerprints each output of a group was saved with to the current ones
+
+        Parameters
+        ----------
+        group_name : str
+            Name of group of data paths (i.e. model member)
+        input_files : list
+            (path, size, mtime_ns) of each input file of the group (from get_input_files)
+        metric_fingerprints : dict
+            Fingerprint of each metric by metric name (from make_metric_fingerprint)
+
+        Returns
+        ----------
+        output_states : dict
+            UP_TO_DATE, FAILED, NEW_INPUT_FILES or STALE for each metric in the manifest
+            (metrics not in the manifest are left out)
+        """
+        inputs_fingerprint = make_inputs_fingerprint(input_files)
+        output_states = {}
+        for (
+            metric_name,
+            saved_metric_fingerprint,
+            saved_inputs_fingerprint,
+            saved_input_files,
+            error,
+        ) in self._connection.execute(
+            "SELECT metric_name, metric_fingerprint, inputs_fingerprint, input_files, error "
+            "FROM outputs WHERE group_name = ?",
+            (group_name,),
+        ):
+            if metric_name not in metric_fingerprints:
+                continue
+            if saved_metric_fingerprint != metric_fingerprints[metric_name]:
+                output_states[metric_name] = STALE
+            elif saved_inputs_fingerprint == inputs_fingerprint:
+                output_states[metric_name] = FAILED if error else UP_TO_DATE
+            elif set(
+                tuple(input_file) for input_file in json.loads(saved_input_files)
+            ).issubset(tuple(input_file) for input_file in input_files):
+                output_states[metric_name] = NEW_INPUT_FILES
+            else:
+                output_states[metric_name] = STALE
+        return output_states
+
+    def record_outputs(self, group_name, input_files, metric_fingerprints, errors=None):
+        """
+        Records that the outputs of each metric in metric_fingerprints have been saved for a group
+        (or that the metric raised an error)
+
+        Parameters
+        ----------
+        group_name : str
+            Name of group of data paths (i.e. model member)
+        input_files : list
+            (path, size, mtime_ns) of each input file used (from get_input_files)
+        metric_fingerprints : dict
+            Fingerprint of each metric saved by metric name (from make_metric_fingerprint)
+        errors : dict
+            Error message of each metric which failed by metric name (default: no errors)
+        """
+        if not errors:
+            errors = {}
+        inputs_fingerprint = make_inputs_fingerprint(input_files)
+        updated_at = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        group_name,
+                        metric_name,
+                        metric_fingerprint,
+                        inputs_fingerprint,
+                        json.dumps([list(input_file) for input_file in input_files]),
+                        get_jsmetrics_version(),
+                        errors.get(metric_name),
+                        updated_at,
+                    )
+                    for metric_name, metric_fingerprint in metric_fingerprints.items()
+                ],
+            )
+
+    def merge(self, other_manifest_path):
+        """
+        Copies every row of another manifest (i.e. of a shard) into this one
+
+        Returns
+        ----------
+        n_outputs_merged : int
+        """
+        other_connection = sqlite3.connect(other_manifest_path)
+        try:
+            rows = other_connection.execute("SELECT * FROM outputs").fetchall()
+        finally:
+            other_connection.close()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        return len(rows)
+
+
+def get_input_files(data_paths):
+    """
+    Path, size and mtime of each data path (only the file metadata is read)
+
+    Returns
+    ----------
+    input_files : list
+        (path, size, mtime_ns) of each data path, sorted by path
+    """
+    input_files = []
+    for data_path in sorted(data_paths):
+        file_stat = os.stat(data_path)
+        input_files.append((data_path, file_stat.st_size, file_stat.st_mtime_ns))
+    return input_files
+
+
+def make_inputs_fingerprint(input_files):
+    return make_fingerprint([list(input_file) for input_file in sorted(input_files)])
+
+
+def make_metric_fingerprint(metric_info):
+    """
+    Fingerprint of everything that decides a metric's output: its METRIC_DICT entry
+    (e.g. coords, plev_units), the qualified name of its function and the jsmetrics version
+
+    Parameters
+    ----------
+    metric_info : dict
+        jetstream metric information about metric name, subsetting, required variables, function location
+    """
+    metric_func = metric_info.get("metric")
+    return make_fingerprint(
+        {
+            "metric_info": {
+                key: value for key, value in metric_info.items() if key != "metric"
+            },
+            "metric": "%s.%s"
+            % (
+                getattr(metric_func, "__module__", None),
+                getattr(metric_func, "__qualname__", repr(metric_func)),
+            ),
+            "jsmetrics_version": get_jsmetrics_version(),
+        }
+    )
+
+
+def make_fingerprint(value):
+    """
+    sha256 of value as JSON (with sorted keys so dict order does not matter)
+    """
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def get_jsmetrics_version():
+    if jsmetrics is None:
+        return None
+    return getattr(jsmetrics, "__version__", None)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Split groups of data paths into shards (e.g. one per task of a SLURM job array)
+    and merge the outputs of each shard back together
+"""
+
+# imports
+import logging
+import os
+
+from utils import progress_loggers
+
+# docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+SHARD_NAME_FORMAT = "shard_%03d_of_%03d"
+SHARD_OUTPUT_DIR = "shards"  # shard outputs are kept in OUTPUT_PATH/shards/ until merged
+
+
+log = logging.getLogger(__name__)
+
+
+def get_shard_index_and_count(shard_index=None, shard_count=None):
+    """
+    Get which shard to run, using SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT if not given
+
+    Parameters
+    ----------
+    shard_index : int
+        Index of shard to run (starting at 0)
+    shard_count : int
+        Total number of shards
+
+    Returns
+    ----------
+    shard_index : int
+        Index of shard to run (0 if not sharded)
+    shard_count : int
+        Total number of shards (1 if not sharded)
+
+    Raises
+    ----------
+    ValueError
+        When shard_index is not between 0 and shard_count - 1
+    """
+    if shard_index is None and "SLURM_ARRAY_TASK_ID" in os.environ:
+        #  array indices can start from any number e.g. --array=1-20
+        shard_index = int(os.environ["SLURM_ARRAY_TASK_ID"]) - int(
+            os.environ.get("SLURM_ARRAY_TASK_MIN", 0)
+        )
+    if shard_count is None and "SLURM_ARRAY_TASK_COUNT" in os.environ:
+        shard_count = int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+    if shard_count is None:
+        shard_count = 1
+    if shard_index is None:
+        shard_index = 0
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(
+            "'shard_index' needs to be between 0 and %s, not %s"
+            % (shard_count - 1, shard_index)
+        )
+    return shard_index, shard_count
+
+
+def get_shard_name(shard_index, shard_count):
+    return SHARD_NAME_FORMAT % (shard_index, shard_count)
+
+
+def get_shard_data_list_file(data_list_file, shard_index, shard_count):
+    """
+    Path to the data list of one shard e.g. data_lists/ua_subset_JASMIN_shard_000_of_020.txt
+    """
+    file_name, extension = os.path.splitext(data_list_file)
+    return "%s_%s%s" % (file_name, get_shard_name(shard_index, shard_count), extension)
+
+
+def get_shard_output_path(output_path, shard_index, shard_count):
+    return os.path.join(output_path, SHARD_OUTPUT_DIR, get_shard_name(shard_index, shard_count))
+
+
+def get_group_sizes(grouped_data_paths):
+    """
+    Total size in bytes of the files in each group (missing files count as 0)
+    """
+    group_sizes = []
+    for data_path_group in grouped_data_paths:
+        group_size = 0
+        for data_path in data_path_group:
+            try:
+                group_size += os.path.getsize(data_path)
+            except OSError:
+                pass
+        group_sizes.append(group_size)
+    return group_sizes
+
+
+def assign_groups_to_shards(group_sizes, shard_count):
+    """
+    Assigns each group to a shard so that each shard has a similar total size, by giving
+    the largest remaining group to the shard with the least data so far.
+    Ties are broken by group and shard index, so the same sizes always give the same shards.
+
+    Parameters
+    ----------
+    group_sizes : list
+        Size of each group (e.g. from get_group_sizes)
+    shard_count : int
+        Number of shards
+
+    Returns
+    ----------
+    shard_of_groups : list
+        Shard index of each group
+    """
+    shard_sizes = [0] * shard_count
+    shard_of_groups = [None] * len(group_sizes)
+    for group_ind in sorted(range(len(group_sizes)), key=lambda ind: (-group_sizes[ind], ind)):
+        shard_index = min(range(shard_count), key=lambda ind: (shard_sizes[ind], ind))
+        shard_of_groups[group_ind] = shard_index
+        shard_sizes[shard_index] += group_sizes[group_ind]
+    return shard_of_groups
+
+
+def split_groups_into_shards(grouped_data_paths, shard_count):
+    """
+    Split groups of data paths into size-balanced shards (see assign_groups_to_shards)
+
+    Returns
+    ----------
+    sharded_groups : list
+        List of groups for each shard, in the order the groups were given
+    """
+    shard_of_groups = assign_groups_to_shards(get_group_sizes(grouped_data_paths), shard_count)
+    sharded_groups = [[] for _ in range(shard_count)]
+    for shard_index, data_path_group in zip(shard_of_groups, grouped_data_paths):
+        sharded_groups[shard_index].append(data_path_group)
+    return sharded_groups
+
+
+def save_shard_data_lists(grouped_data_paths, data_list_file, shard_count):
+    """
+    Saves a data list for each shard next to data_list_file so that every task in a
+    job array reads the same plan
+
+    Returns
+    ----------
+    shard_data_list_files : list
+        Path to the data list of each shard
+    """
+    shard_data_list_files = []
+    for shard_index, shard_groups in enumerate(
+        split_groups_into_shards(grouped_data_paths, shard_count)
+    ):
+        shard_data_list_file = get_shard_data_list_file(
+            data_list_file, shard_index, shard_count
+        )
+        with open(shard_data_list_file, "w") as shard_file:
+            for data_path_group in shard_groups:
+                for data_path in data_path_group:
+                    shard_file.write(data_path + os.linesep)
+        log.info(
+            "%s: %s groups saved to %s"
+            % (get_shard_name(shard_index, shard_count), len(shard_groups), shard_data_list_file)
+        )
+        shard_data_list_files.append(shard_data_list_file)
+    return shard_data_list_files
+
+
+def merge_shard_outputs(output_path):
+    """
+    Moves the outputs (and metadata) of every shard in output_path/shards/ into output_path
+    and removes the empty shard directories. Shards are merged in name order so the result
+    does not depend on when each shard finished.
+
+    Returns
+    ----------
+    n_files_merged : int
+        Number of files moved into output_path
+    """
+    shards_path = os.path.join(output_path, SHARD_OUTPUT_DIR)
+    if not os.path.isdir(shards_path):
+        return 0
+    n_files_merged = 0
+    for shard_name in sorted(os.listdir(shards_path)):
+        shard_output_path = os.path.join(shards_path, shard_name)
+        for dir_path, _, file_names in sorted(os.walk(shard_output_path)):
+            merged_dir_path = os.path.join(
+                output_path, os.path.relpath(dir_path, shard_output_path)
+            )
+            os.makedirs(merged_dir_path, exist_ok=True)
+            for file_name in sorted(file_names):
+                os.replace(
+                    os.path.join(dir_path, file_name),
+                    os.path.join(merged_dir_path, file_name),
+                )
+                n_files_merged += 1
+        for dir_path, _, _ in os.walk(shard_output_path, topdown=False):
+            os.rmdir(dir_path)
+        log.info("merged outputs of %s" % (shard_name))
+    return n_files_merged
+
+
+def merge_shard_progress_logs(data_list_file, shard_count):
+    """
+    Copies the progress journal of every shard into a new run of the journal of the
+    full data list and renders its progress log
+
+    Returns
+    ----------
+    progress_logger : progress_loggers.JournaledProgressLogger
+        Progress logger of the full data list
+    """
+    progress_logger = progress_loggers.JournaledProgressLogger(data_list_file)
+    for shard_index in range(shard_count):
+        shard_journal_file = progress_loggers.get_progress_journal_file_path(
+            get_shard_data_list_file(data_list_file, shard_index, shard_count)
+        )
+        if not os.path.isfile(shard_journal_file):
+            log.warning("no progress journal for %s" % (get_shard_name(shard_index, shard_count)))
+            continue
+        progress_logger.merge(shard_journal_file)
+    progress_logger.render_progress_log_file()
+    return progress_logger
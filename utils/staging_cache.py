@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Copies of data files on node-local disk (i.e. $TMPDIR), so a group of files read from a
+    shared filesystem (i.e. /badc) is only read from it once per node: reruns and retries open
+    the local copies. Files are copied in parallel, a copy is only used while the size and mtime
+    of its source are unchanged, and the least recently used copies are removed to keep the
+    staged files under a disk quota. Which files are staged is kept in a SQLite index in the
+    staging directory, so worker processes on the same node share the copies.
+"""
+
+#  imports
+import concurrent.futures
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+#  docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+#  logger
+log = logging.getLogger(__name__)
+
+
+STAGING_QUOTA = 100000  # MB of staged files kept in a staging directory
+COPY_WORKERS = 4  # files copied at once
+STAGING_INDEX_FILE_NAME = "staging_index.sqlite"
+STAGED_FILES_DIR_NAME = "files"
+
+STAGING_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS staged_files (
+    source_path TEXT PRIMARY KEY,
+    staged_path TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    last_used REAL
+);
+"""
+
+
+class StagingCache:
+    """
+    Directory of local copies of data files, with an index of the size and mtime of the source
+    each copy was made from and when it was last used
+    """
+
+    def __init__(self, staging_dir, quota_mb=STAGING_QUOTA, copy_workers=COPY_WORKERS):
+        """
+        Parameters
+        ----------
+        staging_dir : str
+            Node-local directory to copy files to (will be created if it does not exist)
+        quota_mb : float
+            Size of the staged files to keep (least recently used are removed first)
+        copy_workers : int
+            Files copied at once
+
+        Raises
+        ----------
+        TypeError
+            When 'staging_dir' is not a str
+        """
+        if not isinstance(staging_dir, str):
+            raise TypeError("'staging_dir' input needs to be string type")
+        self.staging_dir = staging_dir
+        self.quota_nbytes = int(quota_mb * 1024**2)
+        self.copy_workers = max(copy_workers, 1)
+        self.n_files_copied = 0
+        self.nbytes_copied = 0
+        os.makedirs(os.path.join(staging_dir, STAGED_FILES_DIR_NAME), exist_ok=True)
+        self._connection = sqlite3.connect(
+            os.path.join(staging_dir, STAGING_INDEX_FILE_NAME), timeout=60
+        )
+        self._connection.executescript(STAGING_INDEX_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM staged_files").fetchone()[0]
+
+    @property
+    def size_mb(self):
+        return self._get_staged_nbytes() / 1024**2
+
+    def stage(self, data_paths):
+        """
+        Copies each data path not staged already (or whose source has changed) to the staging
+        directory, removing the least recently used copies of other files to make room
+
+        Parameters
+        ----------
+        data_paths : list
+            Paths of files to stage (i.e. a group of data paths)
+
+        Returns
+        ----------
+        staged_paths : list
+            Local path of each data path in the same order. A data path is given back as it is
+            when it could not be staged (i.e. the group is larger than the quota, there is not
+            enough free disk or the copy failed)
+        """
+        source_stats = {data_path: os.stat(data_path) for data_path in set(data_paths)}
+        nbytes_needed = sum(source_stat.st_size for source_stat in source_stats.values())
+        if nbytes_needed > self.quota_nbytes:
+            log.warning(
+                "Not staging %s files (%.1fMB) as they are larger than the staging quota (%.1fMB)"
+                % (len(source_stats), nbytes_needed / 1024**2, self.quota_nbytes / 1024**2)
+            )
+            return list(data_paths)
+        staged_paths = {}
+        paths_to_copy = []
+        for data_path, source_stat in sorted(source_stats.items()):
+            staged_path = self._get_valid_staged_path(data_path, source_stat)
+            if staged_path is None:
+                paths_to_copy.append(data_path)
+            else:
+                staged_paths[data_path] = staged_path
+        nbytes_to_copy = sum(source_stats[data_path].st_size for data_path in paths_to_copy)
+        self.evict(nbytes_to_copy, paths_to_keep=source_stats.keys())
+        if paths_to_copy and shutil.disk_usage(self.staging_dir).free < nbytes_to_copy:
+            log.warning(
+                "Not enough free disk in %s to stage %.1fMB, opening %s files from their source"
+                % (self.staging_dir, nbytes_to_copy / 1024**2, len(paths_to_copy))
+            )
+            paths_to_copy = []
+        copied_paths = self._copy_files(paths_to_copy, source_stats)
+        staged_paths.update(copied_paths)
+        last_used = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO staged_files VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        data_path,
+                        staged_path,
+                        source_stats[data_path].st_size,
+                        source_stats[data_path].st_mtime_ns,
+                        last_used,
+                    )
+                    for data_path, staged_path in staged_paths.items()
+                ],
+            )
+        return [staged_paths.get(data_path, data_path) for data_path in data_paths]
+
+    def evict(self, nbytes_needed, paths_to_keep=()):
+        """
+        Removes the least recently used staged files until nbytes_needed more fit in the quota
+
+        Parameters
+        ----------
+        nbytes_needed : int
+        paths_to_keep : array-like
+            Source paths whose copies are not removed (i.e. the group being staged)
+
+        Returns
+        ----------
+        n_evicted : int
+        """
+        paths_to_keep = set(paths_to_keep)
+        staged_nbytes = self._get_staged_nbytes()
+        n_evicted = 0
+        if staged_nbytes + nbytes_needed <= self.quota_nbytes:
+            return n_evicted
+        for source_path, staged_path, size in self._connection.execute(
+            "SELECT source_path, staged_path, size FROM staged_files ORDER BY last_used"
+        ).fetchall():
+            if staged_nbytes + nbytes_needed <= self.quota_nbytes:
+                break
+            if source_path in paths_to_keep:
+                continue
+            self._remove(source_path, staged_path)
+            staged_nbytes -= size
+            n_evicted += 1
+        log.info(
+            "Removed %s staged files to make room for %.1fMB"
+            % (n_evicted, nbytes_needed / 1024**2)
+        )
+        return n_evicted
+
+    def get_staged_path(self, data_path):
+        """
+        Where data_path is copied to (a directory per source path keeps the file name)
+        """
+        source_hash = hashlib.sha1(os.path.abspath(data_path).encode("utf-8")).hexdigest()
+        return os.path.join(
+            self.staging_dir, STAGED_FILES_DIR_NAME, source_hash, os.path.basename(data_path)
+        )
+
+    def _get_valid_staged_path(self, data_path, source_stat):
+        """
+        Staged path of data_path if it was copied from a source with the same size and mtime
+        (otherwise the old copy is removed and None returned)
+        """
+        row = self._connection.execute(
+            "SELECT staged_path, size, mtime_ns FROM staged_files WHERE source_path = ?",
+            (data_path,),
+        ).fetchone()
+        if row is None:
+            return None
+        staged_path, size, mtime_ns = row
+        if (
+            size == source_stat.st_size
+            and mtime_ns == source_stat.st_mtime_ns
+            and is_same_size(staged_path, size)
+        ):
+            return staged_path
+        log.info("Staged copy of %s is out of date, copying it again" % (data_path))
+        self._remove(data_path, staged_path)
+        return None
+
+    def _copy_files(self, data_paths, source_stats):
+        """
+        Copies data paths in copy_workers threads
+
+        Returns
+        ----------
+        copied_paths : dict
+            Staged path of each data path copied (data paths that failed are left out)
+        """
+        copied_paths = {}
+        if not data_paths:
+            return copied_paths
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self.copy_workers, len(data_paths))
+        ) as executor:
+            futures = {
+                executor.submit(
+                    copy_file,
+                    data_path,
+                    self.get_staged_path(data_path),
+                    source_stats[data_path],
+                ): data_path
+                for data_path in data_paths
+            }
+            for future in concurrent.futures.as_completed(futures):
+                data_path = futures[future]
+                try:
+                    copied_paths[data_path] = future.result()
+                except OSError as e:
+                    log.warning("Unable to stage %s, opening it from its source" % (data_path))
+                    log.warning(e)
+                    continue
+                self.n_files_copied += 1
+                self.nbytes_copied += source_stats[data_path].st_size
+        return copied_paths
+
+    def _get_staged_nbytes(self):
+        return self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM staged_files"
+        ).fetchone()[0]
+
+    def _remove(self, source_path, staged_path):
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM staged_files WHERE source_path = ?", (source_path,)
+            )
+        try:
+            os.remove(staged_path)
+            os.rmdir(os.path.dirname(staged_path))
+        except OSError:
+            pass
+
+
+def copy_file(source_path, staged_path, source_stat):
+    """
+    Copies source_path to staged_path through a temporary file (so a copy is never seen half
+    written), giving the copy the mtime of its source
+
+    Parameters
+    ----------
+    source_path : str
+    staged_path : str
+    source_stat : os.stat_result
+        Stat of source_path before copying, to check it did not change while being copied
+
+    Returns
+    ----------
+    staged_path : str
+
+    Raises
+    ----------
+    OSError
+        When the copy failed or the source changed while being copied
+    """
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    temporary_path = "%s.tmp-%s-%s" % (staged_path, os.getpid(), threading.get_ident())
+    try:
+        shutil.copyfile(source_path, temporary_path)
+        copied_stat = os.stat(source_path)
+        if (
+            copied_stat.st_size != source_stat.st_size
+            or copied_stat.st_mtime_ns != source_stat.st_mtime_ns
+        ):
+            raise OSError("%s changed while being copied" % (source_path))
+        if not is_same_size(temporary_path, source_stat.st_size):
+            raise OSError("copy of %s is not the same size as the source" % (source_path))
+        os.utime(temporary_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(temporary_path, staged_path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return staged_path
+
+
+def is_same_size(path, size):
+    try:
+        return os.path.getsize(path) == size
+    except OSError:
+        return False
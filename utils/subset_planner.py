@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Work out the smallest subset of data needed by all metrics in a metric dict
+    so it can be applied to each file as it is opened (rather than after combining them)
+"""
+
+# imports
+import logging
+
+import numpy
+
+# docs
+__author__ = "Thomas Keel"
+__email__ = "thomas.keel.18@ucl.ac.uk"
+__status__ = "Development"
+
+
+#  other names used for coords in some model outputs
+COORD_ALIASES = {
+    "lat": ["lat", "latitude"],
+    "lon": ["lon", "longitude"],
+    "plev": ["plev"],
+}
+#  extra room around each bound so values subset by metrics are never cut (i.e. 70000.00001)
+COORD_TOLERANCE = 0.01
+
+
+log = logging.getLogger(__name__)
+
+
+class DataSubsetPlan:
+    """
+    Coord bounds and time range covering every metric in a metric dict. The preprocess
+    method can be given to xarray.open_mfdataset so each file only contributes this subset.
+    """
+
+    def __init__(self, coord_bounds, time_range=None, variables=None):
+        """
+        Parameters
+        ----------
+        coord_bounds : dict
+            coord -> (min_val, max_val) to keep. For lon, min_val > max_val wraps around 360
+        time_range : tuple
+            (start, end) given to .sel(time=slice(start, end)) e.g. ('1950', '2015')
+        variables : list
+            Data variables to keep (bounds variables are always kept). None keeps all
+        """
+        self.coord_bounds = coord_bounds
+        self.time_range = time_range
+        self.variables = variables
+
+    @classmethod
+    def from_metric_dict(cls, metric_dict, time_range=None):
+        return cls(
+            get_union_of_metric_coord_bounds(metric_dict),
+            time_range=time_range,
+            variables=get_union_of_metric_variables(metric_dict),
+        )
+
+    def __repr__(self):
+        return "DataSubsetPlan(coord_bounds=%s, time_range=%s, variables=%s)" % (
+            self.coord_bounds,
+            self.time_range,
+            self.variables,
+        )
+
+    def preprocess(self, data):
+        """
+        Subset one file's data (for open_mfdataset(..., preprocess=plan.preprocess))
+
+        Parameters
+        ----------
+        data : xarray.Dataset
+            Data from one file
+
+        Returns
+        ----------
+        subset : xarray.Dataset
+            Data within the coord bounds and time range of the plan
+        """
+        if self.variables is not None:
+            data = data[
+                [
+                    var
+                    for var in data.data_vars
+                    if var in self.variables or "_bnds" in var or "_bounds" in var
+                ]
+            ]
+        indexers = {}
+        for coord, (min_val, max_val) in self.coord_bounds.items():
+            data_coord = get_coord_name_in_data(data, coord)
+            if data_coord is None or data[data_coord].ndim != 1:
+                continue
+            indexers[data[data_coord].dims[0]] = get_indexer_for_bounds(
+                data[data_coord].values, min_val, max_val, wraps=coord == "lon"
+            )
+        if indexers:
+            data = data.isel(indexers)
+        if self.time_range is not None and "time" in data.dims:
+            data = data.sel(time=slice(*self.time_range))
+        return data
+
+
+def get_union_of_metric_coord_bounds(metric_dict):
+    """
+    Bounds of each coord that covers the coords of every metric in a metric dict.
+    Coords not subset by every metric are not included (so are kept whole).
+
+    Parameters
+    ----------
+    metric_dict : dict
+        Metric name -> metric info (with 'coords' e.g. {"lat": [20, 70], ...})
+
+    Returns
+    ----------
+    coord_bounds : dict
+        coord -> (min_val, max_val). For lon, min_val > max_val means it wraps around 360
+    """
+    all_metric_coords = [metric_info["coords"] for metric_info in metric_dict.values()]
+    if not all_metric_coords:
+        return {}
+    coords_in_all_metrics = set.intersection(
+        *[set(metric_coords) for metric_coords in all_metric_coords]
+    )
+    coord_bounds = {}
+    for coord in sorted(coords_in_all_metrics):
+        bounds = [
+            (float(metric_coords[coord][0]), float(metric_coords[coord][1]))
+            for metric_coords in all_metric_coords
+        ]
+        if coord == "lon":
+            lon_bounds = get_union_of_lon_bounds(bounds)
+            if lon_bounds is not None:
+                coord_bounds[coord] = lon_bounds
+        else:
+            coord_bounds[coord] = (
+                min(min(bound) for bound in bounds),
+                max(max(bound) for bound in bounds),
+            )
+    return coord_bounds
+
+
+def get_union_of_metric_variables(metric_dict):
+    """
+    Data variables needed by all metrics in metric_dict. Returns None (keep all variables)
+    if any metric does not list its variables, so no variable a metric needs is dropped.
+    """
+    variables = []
+    for metric_info in metric_dict.values():
+        if not metric_info.get("variables"):
+            return None
+        for var in metric_info["variables"]:
+            if var not in variables:
+                variables.append(var)
+    return variables or None
+
+
+def get_union_of_lon_bounds(lon_bounds):
+    """
+    Smallest arc of longitude (0-360) covering all lon bounds, where a bound with
+    min_val > max_val wraps around 360 (i.e. (300, 60) is 60W-60E)
+
+    Parameters
+    ----------
+    lon_bounds : list
+        (min_val, max_val) for each metric
+
+    Returns
+    ----------
+    lon_bounds : tuple
+        (min_val, max_val) in 0-360 (min_val > max_val if it wraps), or None for all longitudes
+    """
+    intervals = []
+    for min_val, max_val in lon_bounds:
+        if max_val - min_val >= 360:
+            return None
+        min_val, max_val = min_val % 360, max_val % 360
+        if min_val <= max_val:
+            intervals.append((min_val, max_val))
+        else:
+            intervals.extend([(min_val, 360.0), (0.0, max_val)])
+    intervals.sort()
+    merged_intervals = [list(intervals[0])]
+    for min_val, max_val in intervals[1:]:
+        if min_val <= merged_intervals[-1][1]:
+            merged_intervals[-1][1] = max(merged_intervals[-1][1], max_val)
+        else:
+            merged_intervals.append([min_val, max_val])
+    #  the arc covering everything is the circle minus the largest gap between intervals
+    gaps = [
+        (
+            (merged_intervals[(ind + 1) % len(merged_intervals)][0] - max_val) % 360,
+            ind,
+        )
+        for ind, (_, max_val) in enumerate(merged_intervals)
+    ]
+    largest_gap, gap_ind = max(gaps)
+    if largest_gap == 0:
+        return None
+    return (
+        merged_intervals[(gap_ind + 1) % len(merged_intervals)][0],
+        merged_intervals[gap_ind][1],
+    )
+
+
+def get_coord_name_in_data(data, coord):
+    for coord_name in COORD_ALIASES.get(coord, [coord]):
+        if coord_name in data.coords:
+            return coord_name
+    return None
+
+
+def get_indexer_for_bounds(values, min_val, max_val, wraps=False):
+    """
+    Indices of values within bounds (as a slice when they are next to each other)
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Coord values (in any order)
+    min_val : float
+        Lower bound
+    max_val : float
+        Upper bound
+    wraps : Boolean
+        Whether values are longitudes (compared in 0-360, min_val > max_val wraps around 360)
+
+    Returns
+    ----------
+    indexer : slice or numpy.ndarray
+        For use in .isel()
+    """
+    values = numpy.asarray(values, dtype=float)
+    if wraps:
+        values = values % 360
+    if wraps and min_val > max_val:
+        keep = (values >= min_val - COORD_TOLERANCE) | (values <= max_val + COORD_TOLERANCE)
+    else:
+        keep = (values >= min_val - COORD_TOLERANCE) & (values <= max_val + COORD_TOLERANCE)
+    inds = numpy.flatnonzero(keep)
+    if len(inds) and inds[-1] - inds[0] + 1 == len(inds):
+        return slice(int(inds[0]), int(inds[-1]) + 1)
+    return inds